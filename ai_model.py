@@ -2,36 +2,813 @@
 """
 AI Model for Calculus Detection
 This script processes uploaded images using the YOLO + U-Net pipeline
+
+Usage:
+    python ai_model.py <image_path>    Process a single image and print JSON
+    python ai_model.py <path|dir|glob> ...
+                                       Process many images, one JSON line per image
+    python ai_model.py --pipeline [--threads N] <path|dir|glob> ...
+                                       Same, overlapping decode, inference and rendering
+    python ai_model.py --serve         Run a persistent worker (JSON lines on stdin/stdout)
+    python ai_model.py --check         Check packages and model files without loading them
+    python ai_model.py --profile [--trace cprofile|torch] ...
+                                       Add detailed timings, optionally dumping a trace
 """
 
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import sys
 import os
 import json
-import torch
-import cv2
-import numpy as np
+import glob
+import re
+import shutil
+import copy
+import hashlib
+import mmap
+import uuid
+import tempfile
+import queue
+import logging
+import argparse
+import threading
+import multiprocessing
+import importlib
+import importlib.util
+from importlib import metadata
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from pathlib import Path
-from ultralytics import YOLO
-import segmentation_models_pytorch as smp
-import yaml
 import base64
 import io
-from PIL import Image
+
+class _LazyModule:
+    """Stand-in for a module that is imported on first attribute access.
+    
+    Keeps argument errors, ``--check`` and cache hits from paying for the
+    torch / ultralytics import.
+    """
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+torch = _LazyModule('torch')
+cv2 = _LazyModule('cv2')
+np = _LazyModule('numpy')
+yaml = _LazyModule('yaml')
+smp = _LazyModule('segmentation_models_pytorch')
+ultralytics = _LazyModule('ultralytics')
+Image = _LazyModule('PIL.Image')
 
 # Add the parent directory to the path to import from the main project
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Configuration
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+REQUIRED_PACKAGES = (  # (distribution, import name) checked by --check
+    ('torch', 'torch'),
+    ('opencv-python', 'cv2'),
+    ('ultralytics', 'ultralytics'),
+    ('segmentation-models-pytorch', 'segmentation_models_pytorch'),
+    ('numpy', 'numpy'),
+    ('pillow', 'PIL'),
+    ('pyyaml', 'yaml')
+)
 IMG_SIZE = (256, 256)
 PADDING = 20
+YOLO_IMGSZ = 640
+YOLO_CONF = 0.25
+YOLO_BATCH_SIZE = 4  # Images per YOLO forward pass in batch mode
+BACKENDS = ('torch', 'torchscript', 'onnx', 'onnx-int8')  # Model runtimes, see export_models.py
+EXPORT_DIR_NAME = 'exported'  # Default export directory, next to the YOLO weights
+EXPORT_MANIFEST = 'manifest.json'
+MASK_MODES = ('raster', 'polygon')  # Tooth masks from YOLO's mask tensor or its polygons
+INFERENCE_MODES = ('full', 'tiled')  # YOLO on the whole image, or on overlapping tiles
+TILE_SIZE = 1280  # Tile side in image pixels for tiled inference
+TILE_OVERLAP = 0.25  # Fraction of a tile shared with its neighbour
+TILE_MERGE_THRESHOLD = 0.5  # Mask overlap (of the smaller tooth) at which tile detections are merged
+DECODE_SCALES = {1: 'IMREAD_COLOR', 2: 'IMREAD_REDUCED_COLOR_2',
+                 4: 'IMREAD_REDUCED_COLOR_4', 8: 'IMREAD_REDUCED_COLOR_8'}
+OUTPUT_MODES = ('overlay', 'preview', 'masks', 'none')  # What a result carries besides the per-tooth data
+PREVIEW_SIZE = 1280  # Longest side of a preview overlay in pixels
+PREVIEW_QUALITY = 80
+PREVIEW_FORMATS = {'jpg': ('.jpg', 'IMWRITE_JPEG_QUALITY'), 'webp': ('.webp', 'IMWRITE_WEBP_QUALITY')}
+MASK_ENCODINGS = ('polygon', 'rle')  # Shape encoding in masks output mode
+DECODE_WORKERS = min(4, os.cpu_count() or 1)
+PIPELINE_IO_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))  # Decode / encode threads per pool
+CACHE_MAX_MB = 512
+CACHE_VERSION = 6  # Bump when the result format changes
+CACHE_EXCLUDED_FIELDS = ('processed_image_path', 'original_image_path', 'processed_image_base64',
+                         'timings', 'memory', 'cached', 'reanalysed')
+ARTIFACT_MAX_MB = 2048
+ARTIFACT_VERSION = 1  # Bump when the artifact layout changes
+REQUEST_SETTINGS = ('IMGSZ', 'CONF', 'PADDING', 'UNET_THRESHOLD', 'MASK_MODE', 'INFERENCE', 'TILE_SIZE',
+                    'TILE_OVERLAP', 'DECODE_SCALE', 'OUTPUT', 'PREVIEW_SIZE', 'PREVIEW_QUALITY',
+                    'PREVIEW_FORMAT', 'MASK_ENCODING', 'UNET')  # Settings a worker request may override
+JOB_QUEUE_SIZE = 16  # Waiting jobs before submissions are refused
+JOB_MEMORY_MB = 1024  # Rough peak memory of one running detection on a large photo
+JOB_RESULT_TTL = 600  # Seconds a finished job waits to be fetched
+POOL_THREADS = 2  # Cores (and torch threads) per pool worker process when sizing automatically
+DEGRADATION_LEVELS = ('full', 'reduced', 'no_unet', 'masks')  # Cumulative, see degradation_overrides
+MAX_DEGRADATION = 'no_unet'  # Deepest automatic level; 'masks' drops the overlay, so callers must ask for it
+DEGRADATION_COSTS = (1.0, 0.6, 0.45, 0.35)  # Assumed latency relative to full until a level is measured
+DEGRADED_IMGSZ = 480  # YOLO input size from the reduced level on
+DEADLINE_HEADROOM = 0.8  # Share of the time left that a level's estimated latency may use
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+UNET_BATCH_SIZE = 8  # Tooth crops per U-Net forward pass
+UNET_THRESHOLD = 0.5
+PROFILE_MODES = ('timings', 'cprofile', 'torch')  # Detailed timings, plus a trace dump for the last two
+PROFILE_DIR = os.path.join('.cache', 'profiles')
+
+BASE64_PATTERN = re.compile(r'^[A-Za-z0-9+/=\s]+$')
+ERROR_INPUT_CHARS = 120  # Longest input quoted in an error message
+
+_PIPELINE_DONE = object()
+_inference_started = False  # Set by the first forward pass, see assert_fork_safe
+_requests_lock = threading.Lock()  # Guards the counters of request_peak_rss
+_requests_running = 0
+_requests_started = 0
+
+@lru_cache(maxsize=None)
+def get_device():
+    """The torch device to run on; importing torch is deferred until it is needed"""
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def assert_fork_safe():
+    """Raise RuntimeError once this process has run a forward pass.
+    
+    torch's OpenMP runtime (libgomp) starts its thread pool on the first
+    multi-threaded op, and a child forked after that deadlocks in its first
+    parallel region. Worker processes must be forked after the models are
+    loaded but before anything is inferred.
+    """
+    if _inference_started:
+        raise RuntimeError('Cannot fork model workers once inference has run in this process')
+
+def load_yolo_class():
+    """Import Ultralytics and route its stdout logging to stderr.
+    
+    Ultralytics logs to stdout, which carries our JSON results.
+    """
+    yolo_class = ultralytics.YOLO
+    for handler in logging.getLogger('ultralytics').handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+            handler.setStream(sys.stderr)
+    return yolo_class
+
+def startup_ms():
+    """Milliseconds since this module started importing"""
+    return round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+
+def unet_batch(tooth_crops):
+    """Stack tooth crops into a (N, 3, H, W) float32 U-Net input batch"""
+    batch = np.stack([cv2.resize(crop, IMG_SIZE) for crop in tooth_crops]).astype(np.float32) / 255.0
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+def padded_box(box, h, w, padding=PADDING):
+    """Grow a tight (x1, y1, x2, y2) box by ``padding``, clipped to the image"""
+    bx1, by1, bx2, by2 = box
+    y1, y2 = max(by1 - padding, 0), min(by2 + padding, h)
+    x1, x2 = max(bx1 - padding, 0), min(bx2 + padding, w)
+    return x1, y1, x2, y2
+
+def mask_boxes(masks):
+    """Tight (x1, y1, x2, y2) box of every mask in an (N, H, W) tensor.
+    
+    On a GPU the boxes are reduced on the device and copied back in one
+    transfer; on the CPU OpenCV is faster. Empty masks give ``None``.
+    """
+    if len(masks) == 0:
+        return []
+    
+    if masks.device.type == 'cpu':
+        boxes = []
+        for mask in masks.numpy():
+            bx, by, bw, bh = cv2.boundingRect(mask.astype(np.uint8))
+            boxes.append((bx, by, bx + bw - 1, by + bh - 1) if bw and bh else None)
+        return boxes
+    
+    rows = masks.amax(dim=2) > 0
+    cols = masks.amax(dim=1) > 0
+    height, width = rows.shape[1], cols.shape[1]
+    rows, cols = rows.float(), cols.float()
+    boxes = torch.stack([
+        cols.argmax(dim=1),
+        rows.argmax(dim=1),
+        width - 1 - cols.flip(1).argmax(dim=1),
+        height - 1 - rows.flip(1).argmax(dim=1),
+        rows.amax(dim=1).long()
+    ], dim=1).cpu().tolist()
+    return [tuple(box[:4]) if box[4] else None for box in boxes]
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter (Linux only); ``False`` where it can't be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, ``None`` where unavailable"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+@contextmanager
+def request_peak_rss():
+    """Measure the peak resident memory of the enclosed request.
+    
+    The kernel keeps one peak per process, so resetting it for one request
+    would wipe the peak of another one still running. The counter is only
+    reset when no other request is in flight, and the yielded dict only gets
+    ``peak_rss_mb`` when no other request started before this one finished.
+    """
+    global _requests_running, _requests_started
+    with _requests_lock:
+        _requests_running += 1
+        _requests_started += 1
+        started = _requests_started
+        alone = _requests_running == 1 and reset_peak_rss()
+    measurement = {}
+    try:
+        yield measurement
+    finally:
+        with _requests_lock:
+            _requests_running -= 1
+            if alone and _requests_started == started:
+                measurement['peak_rss_mb'] = peak_rss_mb()
+
+def source_path(image):
+    """The file path of an image given by path, ``None`` for in-memory input.
+    
+    A string is a path when the file exists or when it has characters base64
+    never uses (a dot, for one); anything else is base64 image data.
+    """
+    if isinstance(image, Path):
+        return str(image)
+    if isinstance(image, str) and not image.startswith('data:'):
+        if os.path.exists(image) or not BASE64_PATTERN.match(image):
+            return image
+    return None
+
+def shorten(value, limit=ERROR_INPUT_CHARS):
+    """``value`` cut to ``limit`` characters for error messages"""
+    value = str(value)
+    return value if len(value) <= limit else f"{value[:limit]}... ({len(value)} chars)"
+
+def overlay_path(image_path, output_path=None):
+    """Where the overlay goes: ``output_path`` or ``<name>_processed<ext>`` next to the image"""
+    if output_path is None and image_path is not None:
+        base_path, ext = os.path.splitext(image_path)
+        output_path = f"{base_path}_processed{ext}"
+    return output_path
+
+def copy_overlay(source, output_path):
+    """Copy an overlay image, re-encoding it when ``output_path`` has another format's extension"""
+    formats = [os.path.splitext(path)[1].lower().replace('.jpeg', '.jpg') for path in (source, output_path)]
+    if formats[0] == formats[1]:
+        shutil.copyfile(source, output_path)
+        return
+    image = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+    try:
+        written = image is not None and cv2.imwrite(output_path, image)
+    except cv2.error:
+        written = False
+    if not written:
+        raise OSError(f"Could not convert {source} to {output_path}")
+
+def mask_polygons(mask, x1, y1):
+    """Outer contours of a crop mask as ``[[x, y], ...]`` polygons in image coordinates"""
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    polygons = []
+    for contour in contours:
+        # One pixel of simplification keeps the outline exact to the eye at a fraction of the points
+        contour = cv2.approxPolyDP(contour, 1.0, True).reshape(-1, 2)
+        if len(contour) >= 3:
+            polygons.append((contour + (x1, y1)).tolist())
+    return polygons
+
+def mask_rle(mask):
+    """Row-major run lengths of a crop mask, alternating background and mask, background first"""
+    flat = mask.ravel() > 0
+    if not flat.size:
+        return []
+    edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], edges, [flat.size]))).tolist()
+    return [0] + counts if flat[0] else counts
+
+def decode_base64_image(data):
+    """Return the raw bytes of a base64 string, with or without a data: URL prefix"""
+    if data.startswith('data:'):
+        data = data.split(',', 1)[1]
+    return base64.b64decode(data)
+
+def decode_image(image, scale=1):
+    """Decode an in-memory image into a BGR array.
+    
+    Accepts a numpy array (already BGR), a PIL image, encoded bytes
+    (bytes/bytearray/memoryview), a file-like object or a base64 string.
+    With ``scale`` > 1 the image is reduced by that factor, during JPEG
+    decoding where possible.
+    """
+    if isinstance(image, np.ndarray):
+        array = image
+    elif isinstance(image, Image.Image):
+        array = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+    else:
+        if isinstance(image, str):
+            image = decode_base64_image(image)
+        elif hasattr(image, 'read'):
+            image = image.read()
+        array = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), getattr(cv2, DECODE_SCALES[scale]))
+        if array is None:
+            raise ValueError("Could not decode image data")
+        scale = 1
+    
+    if scale > 1:
+        h, w = array.shape[:2]
+        array = cv2.resize(array, (max(1, w // scale), max(1, h // scale)), interpolation=cv2.INTER_AREA)
+    if array.ndim == 2:
+        array = cv2.cvtColor(array, cv2.COLOR_GRAY2BGR)
+    elif array.shape[2] == 4:
+        array = cv2.cvtColor(array, cv2.COLOR_BGRA2BGR)
+    return array
+
+def _error_result(image_path, error):
+    """Result for one image of a batch run that could not be processed"""
+    return {
+        'success': False,
+        'error': str(error),
+        'original_image_path': image_path
+    }
+
+class StageTimer:
+    """Accumulate wall-clock time (in milliseconds) per pipeline stage.
+    
+    A ``detailed`` timer also records time per tooth. With ``record_functions``
+    every stage shows up as a named range in torch.profiler traces. An
+    ``observer(stage, teeth_done, teeth_total)`` is told when a stage starts and
+    as teeth are processed; it may raise to abort the image.
+    """
+    
+    def __init__(self, detailed=False, record_functions=False, observer=None):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.detailed = detailed
+        self.record_functions = record_functions
+        self.observer = observer
+        self.teeth = {}
+    
+    def progress(self, stage, teeth_done=None, teeth_total=None):
+        if self.observer is not None:
+            self.observer(stage, teeth_done, teeth_total)
+    
+    @contextmanager
+    def stage(self, name):
+        self.progress(name)
+        start = time.perf_counter()
+        try:
+            if self.record_functions:
+                with torch.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.add(name, elapsed)
+    
+    def add(self, name, ms):
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+    
+    @contextmanager
+    def tooth_stage(self, index, name):
+        """Time one tooth's share of a stage (no-op unless ``detailed``)"""
+        if not self.detailed:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_tooth(index, name, (time.perf_counter() - start) * 1000)
+    
+    def add_tooth(self, index, name, ms):
+        if self.detailed:
+            tooth = self.teeth.setdefault(index, {})
+            tooth[name] = tooth.get(name, 0.0) + ms
+    
+    def as_dict(self):
+        timings = {name: round(ms, 2) for name, ms in self.stages.items()}
+        timings['total'] = round((time.perf_counter() - self.started) * 1000, 2)
+        if self.detailed:
+            timings['teeth'] = [
+                dict({'tooth_id': index + 1}, **{name: round(ms, 3) for name, ms in stages.items()})
+                for index, stages in sorted(self.teeth.items())
+            ]
+        return timings
+
+def profile_mode(value):
+    """Normalize a profiling switch: off, ``1``/``true`` for timings, or a PROFILE_MODES entry"""
+    value = (value or '').strip().lower()
+    if value in ('', '0', 'false', 'off', 'no'):
+        return None
+    if value in ('1', 'true', 'on', 'yes'):
+        return 'timings'
+    if value not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {value!r}, expected one of {', '.join(PROFILE_MODES)}")
+    return value
+
+@contextmanager
+def profiled(mode, directory, name):
+    """Dump a cProfile or torch.profiler trace of the enclosed block.
+    
+    Yields a dict whose ``trace`` entry is set to the written file afterwards;
+    any other mode profiles nothing.
+    """
+    trace = {}
+    if mode not in ('cprofile', 'torch'):
+        yield trace
+        return
+    
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield trace
+        finally:
+            profiler.disable()
+            trace['trace'] = stem + '.prof'
+            profiler.dump_stats(trace['trace'])
+    else:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if get_device().type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, profile_memory=True) as profiler:
+            yield trace
+        trace['trace'] = stem + '.trace.json'
+        profiler.export_chrome_trace(trace['trace'])
+
+def read_image_content(image):
+    """Return the encoded bytes of a path, base64 string or file object.
+    
+    Arrays, PIL images and bytes-like objects are returned unchanged.
+    """
+    if source_path(image) is not None:
+        with open(image, 'rb') as f:
+            return f.read()
+    if isinstance(image, str):
+        return decode_base64_image(image)
+    if hasattr(image, 'read'):
+        return image.read()
+    return image
+
+def content_digest(content):
+    """SHA-256 of encoded image bytes or of a decoded image's pixels"""
+    digest = hashlib.sha256()
+    if isinstance(content, Image.Image):
+        content = np.asarray(content)
+    if isinstance(content, np.ndarray):
+        digest.update(f'{content.shape}{content.dtype}'.encode())
+        digest.update(np.ascontiguousarray(content).data)
+    else:
+        digest.update(content)
+    return digest.hexdigest()
+
+def file_fingerprint(path):
+    """Cheap identity of a weights file: path, size and modification time"""
+    try:
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        return [os.path.abspath(path), None, None]
+
+class ResultCache:
+    """On-disk cache of detection results keyed by image content and model settings.
+    
+    Each entry is a directory holding ``result.json`` and the overlay image, if
+    the output mode produced one.
+    A hit refreshes the entry's modification time; once the cache grows beyond
+    ``max_bytes`` the least recently used entries are deleted.
+    """
+    
+    def __init__(self, directory, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+    
+    @classmethod
+    def from_config(cls, config):
+        """Build the cache from CALCULUS_CACHE_* variables or the CACHE config block"""
+        cache_config = config.get('CACHE') or {}
+        directory = os.environ.get('CALCULUS_CACHE_DIR') or cache_config.get('DIR')
+        if not directory:
+            return None
+        max_mb = float(os.environ.get('CALCULUS_CACHE_MAX_MB') or cache_config.get('MAX_MB', CACHE_MAX_MB))
+        return cls(directory, int(max_mb * 1024 * 1024))
+    
+    @staticmethod
+    def key(digest, fingerprint):
+        settings = json.dumps(fingerprint, sort_keys=True).encode()
+        return hashlib.sha256(settings + digest.encode()).hexdigest()
+    
+    def get(self, key, output_path=None):
+        """Return the cached result for ``key`` or ``None``.
+        
+        The stored overlay is copied to ``output_path``, converted to the format
+        its extension names, or returned as ``processed_image_base64`` when there
+        is no output path.
+        """
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'result.json'), 'r') as f:
+                stored = json.load(f)
+            overlay_file = stored.pop('overlay_file')
+            if overlay_file is None:
+                # Masks or none output: there is no image to hand back
+                output_path = None
+            elif output_path is not None:
+                # A PNG source caches a PNG overlay, but a shared-memory request asks for .jpg
+                copy_overlay(os.path.join(entry, overlay_file), output_path)
+            else:
+                with open(os.path.join(entry, overlay_file), 'rb') as f:
+                    stored['processed_image_base64'] = base64.b64encode(f.read()).decode('ascii')
+            os.utime(os.path.join(entry, 'result.json'))
+        except (OSError, ValueError, KeyError):
+            return None
+        
+        stored['processed_image_path'] = output_path
+        stored['cached'] = True
+        return stored
+    
+    def put(self, key, result):
+        """Store a successful result together with its overlay image"""
+        entry = os.path.join(self.directory, key)
+        if os.path.exists(entry):
+            return
+        
+        stored = {
+            name: value for name, value in result.items()
+            if name not in CACHE_EXCLUDED_FIELDS
+        }
+        staging = f"{entry}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(staging)
+            if result.get('processed_image_path'):
+                overlay_file = 'overlay' + os.path.splitext(result['processed_image_path'])[1]
+                shutil.copyfile(result['processed_image_path'], os.path.join(staging, overlay_file))
+            elif result.get('processed_image_base64'):
+                overlay_file = 'overlay.' + result.get('settings', {}).get('preview_format', 'jpg')
+                with open(os.path.join(staging, overlay_file), 'wb') as f:
+                    f.write(base64.b64decode(result['processed_image_base64']))
+            else:
+                overlay_file = None
+            stored['overlay_file'] = overlay_file
+            with open(os.path.join(staging, 'result.json'), 'w') as f:
+                json.dump(stored, f)
+            # Publish atomically; a concurrent writer for the same key wins
+            os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        
+        self.evict()
+    
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            try:
+                last_used = os.stat(os.path.join(entry, 'result.json')).st_mtime
+                size = sum(
+                    os.path.getsize(os.path.join(entry, file_name))
+                    for file_name in os.listdir(entry)
+                )
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+            total_bytes += size
+        
+        for last_used, size, entry in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_bytes -= size
+
+class ArtifactStore:
+    """On-disk store of the network outputs per image, for re-analysis without the models.
+    
+    Each entry is ``<key>.npz`` holding the YOLO scores and tooth masks (as
+    packed bits, or polygons) and the U-Net probability maps, written by
+    ``CalculusDetector.pack_artifacts``. Like the result cache, entries beyond
+    ``max_bytes`` are deleted least recently used first.
+    """
+    
+    def __init__(self, directory, max_bytes=ARTIFACT_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+    
+    @classmethod
+    def from_config(cls, config):
+        """Build the store from CALCULUS_ARTIFACT_* variables or the ARTIFACTS config block"""
+        artifact_config = config.get('ARTIFACTS') or {}
+        directory = os.environ.get('CALCULUS_ARTIFACT_DIR') or artifact_config.get('DIR')
+        if not directory:
+            return None
+        max_mb = float(os.environ.get('CALCULUS_ARTIFACT_MAX_MB') or artifact_config.get('MAX_MB', ARTIFACT_MAX_MB))
+        return cls(directory, int(max_mb * 1024 * 1024))
+    
+    def get(self, key):
+        """Return the stored arrays for ``key`` or ``None``"""
+        path = os.path.join(self.directory, f'{key}.npz')
+        try:
+            with np.load(path) as stored:
+                arrays = {name: stored[name] for name in stored.files}
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays
+    
+    def put(self, key, arrays):
+        """Store (or replace) the arrays for ``key``"""
+        path = os.path.join(self.directory, f'{key}.npz')
+        staging = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(staging, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(staging, path)
+        except OSError:
+            try:
+                os.remove(staging)
+            except OSError:
+                pass
+            return
+        
+        self.evict()
+    
+    def evict(self):
+        """Delete least recently used entries until the store fits in max_bytes"""
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+        
+        for last_used, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+def tile_origins(length, tile, stride):
+    """Start offsets of tiles covering ``length``, the last one flush with the end"""
+    origins = list(range(0, max(length - tile, 0) + 1, stride))
+    if origins[-1] + tile < length:
+        origins.append(length - tile)
+    return origins
+
+def polygon_mask(polygon, x1, y1, width, height):
+    """Rasterize an image-coordinate polygon into a (height, width) window at (x1, y1)"""
+    mask = np.zeros((height, width), dtype=np.uint8)
+    points = np.round(polygon - np.array([x1, y1], dtype=polygon.dtype)).astype(np.int32)
+    cv2.fillPoly(mask, [points], 1)
+    return mask
+
+def merge_tile_detections(detections, threshold):
+    """Greedy mask NMS across tiles.
+    
+    Whole detections are preferred to ones cut by a tile edge, then higher
+    scores. A detection is dropped when its mask overlaps a kept one by more
+    than ``threshold`` of the smaller mask, so a tooth cut in one tile is
+    absorbed by its whole copy from the neighbouring tile.
+    """
+    kept = []
+    for detection in sorted(detections, key=lambda d: (d['cut'], -d['score'])):
+        ax1, ay1, ax2, ay2 = detection['box']
+        duplicate = False
+        for other in kept:
+            bx1, by1, bx2, by2 = other['box']
+            if ax1 > bx2 or bx1 > ax2 or ay1 > by2 or by1 > ay2:
+                continue
+            x1, y1 = int(min(ax1, bx1)), int(min(ay1, by1))
+            width, height = int(max(ax2, bx2)) - x1 + 2, int(max(ay2, by2)) - y1 + 2
+            mask_a = polygon_mask(detection['polygon'], x1, y1, width, height)
+            mask_b = polygon_mask(other['polygon'], x1, y1, width, height)
+            smaller = min(cv2.countNonZero(mask_a), cv2.countNonZero(mask_b))
+            if smaller and cv2.countNonZero(mask_a & mask_b) > threshold * smaller:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(detection)
+    return kept
+
+class TiledResult:
+    """Stand-in for a YOLO result holding merged tile detections"""
+    
+    class Masks:
+        def __init__(self, polygons):
+            self.xy = polygons
+    
+    def __init__(self, polygons, scores, tiles):
+        self.masks = self.Masks(polygons) if polygons else None
+        self.scores = scores
+        self.tiles = tiles
+
+class StoredResult:
+    """Stand-in for a YOLO result restored from saved artifacts.
+    
+    ``probabilities`` maps tooth indices to saved U-Net probability maps that
+    are still valid for the current crops.
+    """
+    
+    class Masks:
+        def __init__(self, data=None, polygons=None):
+            self.data = data
+            self.xy = polygons
+    
+    def __init__(self, masks, scores, probabilities):
+        self.masks = masks
+        self.scores = scores
+        self.probabilities = probabilities
+
+class ImageJob:
+    """One image moving through a batch run"""
+    
+    def __init__(self, image_path, timer=None):
+        self.image_path = image_path
+        self.image = None
+        self.timer = timer or StageTimer()
+        self.cache_key = None
+        self.artifact_key = None
+        self.stored = None  # StoredResult that replaces YOLO for this image
 
 class CalculusDetector:
-    def __init__(self, config_path="../default.yaml"):
-        """Initialize the calculus detector with YOLO and U-Net models"""
+    def __init__(self, config_path="../default.yaml", cache=None, lazy=False, backend=None,
+                 profile=None, overrides=None, artifacts=None):
+        """Initialize the calculus detector with YOLO and U-Net models
+        
+        With ``lazy`` the models are loaded when the first image needs them, so
+        results served from the cache never touch them. ``backend`` overrides the
+        configured model runtime (see ``BACKENDS``) and ``profile`` the
+        ``CALCULUS_PROFILE`` instrumentation mode (see ``PROFILE_MODES``).
+        ``overrides`` replaces ``MODEL`` settings such as ``IMGSZ`` or
+        ``INFERENCE``, taking precedence over their ``CALCULUS_*`` variables.
+        With an ``artifacts`` store (see ``ArtifactStore``) the network outputs
+        are saved, so a later run with a higher ``CONF``, another ``PADDING``,
+        U-Net threshold or output style skips the networks.
+        """
         self.config_path = config_path
+        self.requested_backend = backend
+        self.overrides = {key.upper(): value for key, value in (overrides or {}).items()
+                          if value is not None}
+        self.models_loaded = False
+        self.unet_session = None
+        self.model_load_ms = None
+        self._models_lock = threading.Lock()
+        # Ultralytics predictors are not thread-safe; concurrent jobs take turns on YOLO
+        self._yolo_lock = threading.Lock()
         self.load_config()
-        self.load_models()
+        self.cache = cache if cache is not None else ResultCache.from_config(self.config)
+        self.artifacts = artifacts if artifacts is not None else ArtifactStore.from_config(self.config)
+        self.profile = profile_mode(profile if profile is not None else os.environ.get('CALCULUS_PROFILE'))
+        self.profile_dir = os.environ.get('CALCULUS_PROFILE_DIR') or PROFILE_DIR
+        if not lazy:
+            self.load_models()
     
     def load_config(self):
         """Load configuration from YAML file"""
@@ -44,276 +821,2306 @@ class CalculusDetector:
                 'MODEL': {'WEIGHTS': '../segmentyolo.pt'},
                 'UNET': {'WEIGHTS': '../best_model.pth'}
             }
+        
+        # Resolve weight paths, falling back to the parent directory
+        self.yolo_path = self.config['MODEL']['WEIGHTS']
+        if not os.path.exists(self.yolo_path):
+            self.yolo_path = os.path.join('..', self.yolo_path)
+        self.unet_path = self.config['UNET']['WEIGHTS']
+        if not os.path.exists(self.unet_path):
+            self.unet_path = os.path.join('..', self.unet_path)
+        
+        model_config = self.config.get('MODEL', {})
+        self.backend = (self.requested_backend or os.environ.get('CALCULUS_BACKEND')
+                        or model_config.get('BACKEND', 'torch')).lower()
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {self.backend!r}, expected one of {', '.join(BACKENDS)}")
+        self.export_dir = (os.environ.get('CALCULUS_EXPORT_DIR') or model_config.get('EXPORT_DIR')
+                           or os.path.join(os.path.dirname(self.yolo_path), EXPORT_DIR_NAME))
+        self.yolo_batch_size = max(1, int(model_config.get('BATCH_SIZE', YOLO_BATCH_SIZE)))
+        
+        # The U-Net output is only used once it is enabled in the config;
+        # until then the demo calculus masks are shown
+        unet_config = self.config.get('UNET', {})
+        self.unet_configured = bool(unet_config.get('ENABLED', False))
+        self.unet_batch_size = max(1, int(unet_config.get('BATCH_SIZE', UNET_BATCH_SIZE)))
+        self.apply_settings()
+    
+    def apply_settings(self):
+        """Resolve the ``MODEL`` settings that can change without reloading the models"""
+        self.imgsz = int(self.model_setting('IMGSZ', YOLO_IMGSZ))
+        self.conf = float(self.model_setting('CONF', YOLO_CONF))
+        self.padding = max(0, int(self.model_setting('PADDING', PADDING)))
+        self.unet_threshold = float(self.model_setting(
+            'UNET_THRESHOLD', (self.config.get('UNET') or {}).get('THRESHOLD', UNET_THRESHOLD)
+        ))
+        # UNET=off skips a configured U-Net, e.g. to meet a deadline
+        self.unet_enabled = (self.unet_configured and
+                             str(self.model_setting('UNET', 'on')).lower() not in ('0', 'false', 'off', 'no'))
+        self.mask_mode = str(self.model_setting('MASK_MODE', 'raster')).lower()
+        if self.mask_mode not in MASK_MODES:
+            raise ValueError(f"Unknown mask mode {self.mask_mode!r}, expected one of {', '.join(MASK_MODES)}")
+        
+        # Resolution trade-offs: tiled inference for small teeth in large photos,
+        # reduced JPEG decoding for speed
+        self.inference = str(self.model_setting('INFERENCE', 'full')).lower()
+        if self.inference not in INFERENCE_MODES:
+            raise ValueError(f"Unknown inference mode {self.inference!r}, expected one of {', '.join(INFERENCE_MODES)}")
+        if self.inference == 'tiled':
+            # Tile results are merged in image coordinates, which only polygons provide
+            self.mask_mode = 'polygon'
+        self.tile_size = max(32, int(self.model_setting('TILE_SIZE', TILE_SIZE)))
+        self.tile_overlap = min(0.9, max(0.0, float(self.model_setting('TILE_OVERLAP', TILE_OVERLAP))))
+        self.tile_merge_threshold = float(self.model_setting('TILE_MERGE_THRESHOLD', TILE_MERGE_THRESHOLD))
+        self.decode_scale = int(self.model_setting('DECODE_SCALE', 1))
+        if self.decode_scale not in DECODE_SCALES:
+            raise ValueError(f"Unsupported decode scale {self.decode_scale}, expected one of "
+                             f"{', '.join(str(scale) for scale in DECODE_SCALES)}")
+        
+        # Output: the full-size overlay, a bounded preview, mask shapes for the
+        # browser to draw, or the per-tooth numbers alone
+        self.output_mode = str(self.model_setting('OUTPUT', 'overlay')).lower()
+        if self.output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode {self.output_mode!r}, expected one of {', '.join(OUTPUT_MODES)}")
+        self.preview_size = max(64, int(self.model_setting('PREVIEW_SIZE', PREVIEW_SIZE)))
+        self.preview_quality = min(100, max(1, int(self.model_setting('PREVIEW_QUALITY', PREVIEW_QUALITY))))
+        self.preview_format = str(self.model_setting('PREVIEW_FORMAT', 'jpg')).lower().lstrip('.').replace('jpeg', 'jpg')
+        if self.preview_format not in PREVIEW_FORMATS:
+            raise ValueError(f"Unknown preview format {self.preview_format!r}, expected one of {', '.join(PREVIEW_FORMATS)}")
+        self.mask_encoding = str(self.model_setting('MASK_ENCODING', 'polygon')).lower()
+        if self.mask_encoding not in MASK_ENCODINGS:
+            raise ValueError(f"Unknown mask encoding {self.mask_encoding!r}, expected one of {', '.join(MASK_ENCODINGS)}")
+    
+    def with_overrides(self, **overrides):
+        """A detector sharing this one's models and cache with some ``MODEL`` settings replaced.
+        
+        Used for per-request settings such as ``OUTPUT``; load the models
+        first if this detector was created lazily, or the copy loads its own.
+        """
+        overrides = {key.upper(): value for key, value in overrides.items() if value is not None}
+        if not overrides:
+            return self
+        variant = copy.copy(self)
+        variant.overrides = dict(self.overrides, **overrides)
+        variant.apply_settings()
+        return variant
+    
+    def model_setting(self, key, default):
+        """A ``MODEL`` setting: constructor override, then ``CALCULUS_<KEY>``, then the config"""
+        if key in self.overrides:
+            return self.overrides[key]
+        value = os.environ.get(f'CALCULUS_{key}')
+        if value:
+            return value
+        return self.config.get('MODEL', {}).get(key, default)
+    
+    def settings(self):
+        """The inference settings recorded with every result"""
+        settings = {
+            'backend': self.backend,
+            'imgsz': self.imgsz,
+            'conf': self.conf,
+            'padding': self.padding,
+            'inference': self.inference,
+            'mask_mode': self.mask_mode,
+            'decode_scale': self.decode_scale,
+            'unet': self.unet_enabled
+        }
+        if self.inference == 'tiled':
+            settings['tile_size'] = self.tile_size
+            settings['tile_overlap'] = self.tile_overlap
+        settings['output'] = self.output_mode
+        if self.output_mode == 'preview':
+            settings['preview_size'] = self.preview_size
+            settings['preview_format'] = self.preview_format
+            settings['preview_quality'] = self.preview_quality
+        elif self.output_mode == 'masks':
+            settings['mask_encoding'] = self.mask_encoding
+        return settings
+    
+    def model_files(self):
+        """The YOLO and U-Net files used by the selected backend"""
+        if self.backend == 'torch':
+            return self.yolo_path, self.unet_path
+        
+        manifest_path = os.path.join(self.export_dir, EXPORT_MANIFEST)
+        try:
+            with open(manifest_path, 'r') as f:
+                files = json.load(f)[self.backend]
+        except (OSError, ValueError, KeyError):
+            raise RuntimeError(
+                f"No exported models for backend '{self.backend}' in {self.export_dir}; "
+                f"run python export_models.py"
+            )
+        return (os.path.join(self.export_dir, files['yolo']),
+                os.path.join(self.export_dir, files['unet']))
     
     def load_models(self):
-        """Load YOLO and U-Net models"""
+        """Load YOLO and U-Net models, each on its own thread"""
+        started = time.perf_counter()
         try:
-            # Load YOLO model
-            yolo_path = self.config['MODEL']['WEIGHTS']
-            if not os.path.exists(yolo_path):
-                yolo_path = os.path.join('..', yolo_path)
-            self.yolo_model = YOLO(yolo_path)
+            yolo_file, unet_file = self.model_files()
             
-            # Load U-Net model
-            unet_path = self.config['UNET']['WEIGHTS']
-            if not os.path.exists(unet_path):
-                unet_path = os.path.join('..', unet_path)
+            # torch underlies both loaders; import it once here rather than racing on it
+            get_device()
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix='load') as pool:
+                yolo = pool.submit(self.load_yolo, yolo_file)
+                unet = pool.submit(self.load_unet, unet_file)
+                self.yolo_model = yolo.result()
+                unet.result()
+            self.model_load_ms = round((time.perf_counter() - started) * 1000, 2)
+            self.models_loaded = True
             
-            self.unet_model = smp.Unet(
+        except Exception as e:
+            raise RuntimeError(f"Error loading models: {str(e)}")
+    
+    def load_yolo(self, yolo_file):
+        """Load the YOLO model; Ultralytics picks the runtime from the file type"""
+        YOLO = load_yolo_class()
+        if self.backend == 'torch':
+            return YOLO(yolo_file)
+        return YOLO(yolo_file, task='segment')
+    
+    def load_unet(self, unet_file):
+        """Load the U-Net for the selected backend"""
+        if self.backend == 'torch':
+            unet_model = smp.Unet(
                 encoder_name="resnet50", 
                 in_channels=3, 
                 classes=1
-            ).to(DEVICE)
+            ).to(get_device())
             
-            self.unet_model.load_state_dict(
-                torch.load(unet_path, map_location=DEVICE)
+            unet_model.load_state_dict(
+                torch.load(unet_file, map_location=get_device())
+            )
+            self.unet_model = unet_model.eval()
+        elif self.backend == 'torchscript':
+            self.unet_model = torch.jit.load(unet_file, map_location=get_device()).eval()
+        else:
+            try:
+                import onnxruntime
+            except ImportError:
+                raise RuntimeError("The onnx backends need onnxruntime (pip install onnxruntime)")
+            self.unet_session = onnxruntime.InferenceSession(
+                unet_file, providers=['CPUExecutionProvider']
             )
-            self.unet_model.eval()
-            
-        except Exception as e:
-            raise RuntimeError(f"Error loading models: {str(e)}")
     
-    def process_image(self, image_path):
-        """Process an image and return detection results"""
-        try:
-            # Read the image
-            original_image = cv2.imread(image_path)
-            if original_image is None:
-                raise ValueError(f"Could not load image from {image_path}")
-            
-            h, w, _ = original_image.shape
+    def ensure_models(self):
+        """Load the models on first use when the detector was created lazily"""
+        if not self.models_loaded:
+            with self._models_lock:
+                if not self.models_loaded:
+                    self.load_models()
+    
+    def run_unet(self, batch):
+        """Calculus probabilities (N, H, W) for an (N, 3, H, W) float32 batch"""
+        global _inference_started
+        self.ensure_models()
+        _inference_started = True
+        if self.unet_session is not None:
+            logits = self.unet_session.run(None, {'input': batch})[0][:, 0]
+            return 1.0 / (1.0 + np.exp(-logits))
+        
+        input_tensor = torch.from_numpy(batch).to(get_device())
+        with torch.inference_mode():
+            return torch.sigmoid(self.unet_model(input_tensor)).squeeze(1).cpu().numpy()
+    
+    def segment_teeth(self, tooth_crops):
+        """Run the U-Net on all tooth crops in batches and return one mask per crop"""
+        probabilities = self.unet_probabilities(tooth_crops)
+        return [self.calculus_mask(probability, crop) for crop, probability in zip(tooth_crops, probabilities)]
+    
+    def unet_probabilities(self, tooth_crops):
+        """U-Net calculus probabilities at the U-Net's resolution, one map per crop"""
+        self.ensure_models()
+        probabilities = []
+        for start in range(0, len(tooth_crops), self.unet_batch_size):
+            probabilities.extend(self.run_unet(unet_batch(tooth_crops[start:start + self.unet_batch_size])))
+        return probabilities
+    
+    def calculus_mask(self, probability, tooth_crop):
+        """Map a U-Net prediction back to the size of its tooth crop and threshold it"""
+        h_crop, w_crop = tooth_crop.shape[:2]
+        probability = cv2.resize(probability, (w_crop, h_crop))
+        return (probability > self.unet_threshold).astype(np.uint8) * 255
+    
+    def demo_calculus_mask(self, j, tooth_crop, crop_tooth_mask):
+        """Generate the placeholder calculus mask for tooth ``j``"""
+        # ⚠️  TEMPORARY DEMO SOLUTION ⚠️
+        # The U-Net model (best_model.pth) is not properly trained and produces no meaningful output.
+        # This code generates realistic demo results for presentation purposes.
+        # For production use, the U-Net model needs to be properly trained using the notebook
+        # and enabled with UNET.ENABLED in default.yaml.
+        
+        # Create a realistic calculus mask for demonstration
+        h_crop, w_crop = tooth_crop.shape[:2]
+        pred_mask = np.zeros((h_crop, w_crop), dtype=np.uint8)
+        
+        # Simulate realistic calculus patterns based on tooth position
+        import random
+        random.seed(42 + j)  # Consistent results for same tooth
+        
+        # Define realistic calculus percentages for different teeth
+        realistic_percentages = [0, 2.5, 5.1, 0.8, 3.2, 1.9, 0.0, 7.2, 4.6, 1.1, 0.3]
+        tooth_percentage = realistic_percentages[j] if j < len(realistic_percentages) else random.uniform(0, 5)
+        
+        if tooth_percentage > 0 and h_crop > 10 and w_crop > 10:
+            # Calculate how many pixels to mark as calculus
+            total_tooth_pixels = np.count_nonzero(crop_tooth_mask)
+            target_calculus_pixels = int((tooth_percentage / 100.0) * total_tooth_pixels)
             
-            # Run YOLO detection (suppress stdout)
-            results = self.yolo_model.predict(
-                source=image_path, 
+            if target_calculus_pixels > 0:
+                # Create calculus primarily near the gum line (bottom 30% of tooth)
+                gum_line_start = int(h_crop * 0.7)
+                
+                # Add calculus regions
+                pixels_added = 0
+                attempts = 0
+                while pixels_added < target_calculus_pixels and attempts < 50:
+                    # Random position in gum area
+                    y_pos = random.randint(gum_line_start, h_crop - 1)
+                    x_pos = random.randint(0, w_crop - 1)
+                    
+                    # Only add if it's within the tooth mask
+                    if crop_tooth_mask[y_pos, x_pos] > 0:
+                        # Add a small calculus region: fill the free tooth pixels of the
+                        # square window in row-major order until the target is reached
+                        region_size = random.randint(1, 3)
+                        ry1, ry2 = max(y_pos - region_size, 0), min(y_pos + region_size + 1, h_crop)
+                        rx1, rx2 = max(x_pos - region_size, 0), min(x_pos + region_size + 1, w_crop)
+                        region = pred_mask[ry1:ry2, rx1:rx2]
+                        free = (crop_tooth_mask[ry1:ry2, rx1:rx2] > 0) & (region == 0)
+                        fill = np.flatnonzero(free)[:target_calculus_pixels - pixels_added]
+                        region[np.unravel_index(fill, region.shape)] = 255
+                        pixels_added += fill.size
+                    attempts += 1
+        
+        return pred_mask
+    
+    def new_timer(self, observer=None):
+        """A stage timer for one image, detailed when profiling is enabled"""
+        return StageTimer(detailed=self.profile is not None, record_functions=self.profile == 'torch',
+                          observer=observer)
+    
+    def load_image(self, image, timer):
+        """Decode an image given as a path or in memory into a BGR array"""
+        image_path = source_path(image)
+        if image_path is not None:
+            return self.read_image(image_path, timer)
+        with timer.stage('decode'):
+            return decode_image(image, self.decode_scale)
+    
+    def read_image(self, image_path, timer):
+        """Decode an image from disk, raising ValueError if it is unreadable"""
+        with timer.stage('decode'):
+            image = cv2.imread(image_path, getattr(cv2, DECODE_SCALES[self.decode_scale]))
+        if image is None:
+            raise ValueError(f"Could not load image from {shorten(image_path)}")
+        return image
+    
+    def predict(self, images):
+        """Run YOLO on a list of decoded images and return one result per image"""
+        if self.inference == 'tiled':
+            return [self.predict_tiled(image) for image in images]
+        return self.run_yolo(images)
+    
+    def predict_tiled(self, image):
+        """Run YOLO on overlapping tiles and merge the teeth found in several tiles.
+        
+        Returns a YOLO-like result whose ``masks.xy`` holds the merged polygons in
+        image coordinates, ordered by confidence.
+        """
+        h, w = image.shape[:2]
+        tile_h, tile_w = min(self.tile_size, h), min(self.tile_size, w)
+        stride = max(1, int(self.tile_size * (1 - self.tile_overlap)))
+        # Edge tiles are shifted inwards so all tiles share one shape and batch cleanly
+        origins = [(x, y) for y in tile_origins(h, tile_h, stride) for x in tile_origins(w, tile_w, stride)]
+        
+        detections = []
+        for start in range(0, len(origins), self.yolo_batch_size):
+            batch = origins[start:start + self.yolo_batch_size]
+            results = self.run_yolo([image[y:y + tile_h, x:x + tile_w] for x, y in batch])
+            for (x, y), result in zip(batch, results):
+                if result.masks is None:
+                    continue
+                for polygon, score in zip(result.masks.xy, result.boxes.conf.tolist()):
+                    if len(polygon) < 3:
+                        continue
+                    polygon = polygon + np.array([x, y], dtype=polygon.dtype)
+                    bx1, by1 = polygon.min(axis=0)
+                    bx2, by2 = polygon.max(axis=0)
+                    # Teeth cut off by a tile edge inside the image lose against whole copies
+                    cut = ((x > 0 and bx1 <= x + 1) or (y > 0 and by1 <= y + 1)
+                           or (x + tile_w < w and bx2 >= x + tile_w - 2)
+                           or (y + tile_h < h and by2 >= y + tile_h - 2))
+                    detections.append({'polygon': polygon, 'score': score, 'cut': cut,
+                                       'box': (bx1, by1, bx2, by2)})
+        
+        kept = merge_tile_detections(detections, self.tile_merge_threshold)
+        kept.sort(key=lambda detection: -detection['score'])
+        polygons = [detection['polygon'] for detection in kept]
+        return TiledResult(polygons, [detection['score'] for detection in kept], len(origins))
+    
+    def run_yolo(self, images):
+        """One YOLO forward pass over a list of images"""
+        global _inference_started
+        self.ensure_models()
+        _inference_started = True
+        with self._yolo_lock:
+            return self.yolo_model.predict(
+                source=list(images), 
                 save=False, 
-                imgsz=640, 
-                conf=0.25, 
-                device=DEVICE.type,
+                imgsz=self.imgsz, 
+                conf=self.conf, 
+                device=get_device().type,
                 verbose=False  # Suppress YOLO output
             )
+    
+    def fingerprint(self):
+        """Everything apart from the image itself that determines a result"""
+        try:
+            yolo_file, unet_file = self.model_files()
+        except RuntimeError:
+            yolo_file, unet_file = self.yolo_path, self.unet_path
+        return {
+            'version': CACHE_VERSION,
+            'backend': self.backend,
+            'yolo_weights': file_fingerprint(yolo_file),
+            'unet_weights': file_fingerprint(unet_file),
+            'conf': self.conf,
+            'imgsz': self.imgsz,
+            'padding': self.padding,
+            'img_size': IMG_SIZE,
+            'mask_mode': self.mask_mode,
+            'inference': self.inference,
+            'tile_size': self.tile_size,
+            'tile_overlap': self.tile_overlap,
+            'tile_merge_threshold': self.tile_merge_threshold,
+            'decode_scale': self.decode_scale,
+            'output': self.output_mode,
+            'preview': [self.preview_size, self.preview_format, self.preview_quality],
+            'mask_encoding': self.mask_encoding,
+            'unet_enabled': self.unet_enabled,
+            'unet_threshold': self.unet_threshold
+        }
+    
+    def artifact_fingerprint(self):
+        """Everything apart from the image that determines the network outputs"""
+        try:
+            yolo_file, unet_file = self.model_files()
+        except RuntimeError:
+            yolo_file, unet_file = self.yolo_path, self.unet_path
+        return {
+            'version': ARTIFACT_VERSION,
+            'backend': self.backend,
+            'yolo_weights': file_fingerprint(yolo_file),
+            'unet_weights': file_fingerprint(unet_file),
+            'imgsz': self.imgsz,
+            'img_size': IMG_SIZE,
+            'mask_mode': self.mask_mode,
+            'inference': self.inference,
+            'tile_size': self.tile_size,
+            'tile_overlap': self.tile_overlap,
+            'tile_merge_threshold': self.tile_merge_threshold,
+            'decode_scale': self.decode_scale
+        }
+    
+    def lookup_artifacts(self, content, timer):
+        """Return the artifact key for encoded image content and a ``StoredResult``, if usable"""
+        with timer.stage('artifacts'):
+            artifact_key = ResultCache.key(content_digest(content), self.artifact_fingerprint())
+            arrays = self.artifacts.get(artifact_key)
+            stored = self.restore_artifacts(arrays) if arrays is not None else None
+        return artifact_key, stored
+    
+    def pack_artifacts(self, yolo_result, teeth):
+        """The arrays saved for an image: YOLO scores and masks, and U-Net probabilities"""
+        if hasattr(yolo_result, 'scores'):
+            scores = yolo_result.scores
+        else:
+            scores = yolo_result.boxes.conf.cpu().numpy() if yolo_result.boxes is not None else []
+        arrays = {
+            'conf': np.float32(self.conf),
+            'padding': np.int32(self.padding),
+            'scores': np.asarray(scores, dtype=np.float32)
+        }
+        
+        if yolo_result.masks is not None and self.mask_mode == 'polygon':
+            polygons = [np.asarray(polygon, dtype=np.float32).reshape(-1, 2) for polygon in yolo_result.masks.xy]
+            arrays['polygon_points'] = np.concatenate(polygons) if polygons else np.zeros((0, 2), np.float32)
+            arrays['polygon_offsets'] = np.cumsum([0] + [len(polygon) for polygon in polygons])
+        elif yolo_result.masks is not None:
+            masks = yolo_result.masks.data.cpu().numpy()
+            arrays['mask_width'] = np.int32(masks.shape[2])
+            arrays['mask_bits'] = np.packbits(masks != 0, axis=-1)
+        
+        probabilities = [(tooth['index'], tooth['probability']) for tooth in teeth if 'probability' in tooth]
+        if probabilities:
+            arrays['probability_teeth'] = np.array([index for index, _ in probabilities], dtype=np.int32)
+            arrays['probabilities'] = np.stack([probability for _, probability in probabilities]).astype(np.float32)
+        return arrays
+    
+    def restore_artifacts(self, arrays):
+        """A ``StoredResult`` reproducing a YOLO run at ``self.conf``, ``None`` if the artifacts can't.
+        
+        YOLO drops boxes at or below ``conf`` before NMS, and a box is only ever
+        suppressed by a higher-scoring one, so the detections at a higher
+        ``conf`` are exactly the saved ones scoring above it. Lower thresholds
+        need a new YOLO run. Tiled results are only reused at the same ``conf``
+        because merging prefers whole teeth over higher scores. The U-Net saw the
+        crops at the saved ``padding``; with another padding it runs again.
+        """
+        saved_conf = float(arrays['conf'])
+        if self.conf < saved_conf or (self.inference == 'tiled' and self.conf != saved_conf):
+            return None
+        scores = arrays['scores']
+        keep = np.flatnonzero(scores > self.conf) if self.conf > saved_conf else np.arange(len(scores))
+        
+        masks = None
+        if len(keep) and 'polygon_points' in arrays:
+            points, offsets = arrays['polygon_points'], arrays['polygon_offsets']
+            masks = StoredResult.Masks(polygons=[points[offsets[i]:offsets[i + 1]] for i in keep])
+        elif len(keep) and 'mask_bits' in arrays:
+            data = np.unpackbits(arrays['mask_bits'][keep], axis=-1, count=int(arrays['mask_width']))
+            masks = StoredResult.Masks(data=torch.from_numpy(data))
+        
+        probabilities = {}
+        if 'probabilities' in arrays and int(arrays['padding']) == self.padding:
+            # Tooth indices follow the detections, so renumber them after filtering
+            new_index = {int(old): new for new, old in enumerate(keep)}
+            probabilities = {
+                new_index[int(old)]: probability
+                for old, probability in zip(arrays['probability_teeth'], arrays['probabilities'])
+                if int(old) in new_index
+            }
+        return StoredResult(masks, scores[keep], probabilities)
+    
+    def lookup_cache(self, content, output_path, timer):
+        """Return the cache key for encoded image content and the cached result, if any"""
+        with timer.stage('cache'):
+            cache_key = ResultCache.key(content_digest(content), self.fingerprint())
+            cached = self.cache.get(cache_key, output_path)
+        if cached is not None:
+            cached['timings'] = timer.as_dict()
+        return cache_key, cached
+    
+    def process_image(self, image, output_path=None, observer=None):
+        """Process an image and return detection results
+        
+        ``image`` may be a file path or an in-memory image (see ``decode_image``).
+        The overlay is written to ``output_path``, by default next to the source
+        file; in-memory input without an ``output_path`` gets the overlay back as
+        base64 in ``processed_image_base64``. The ``masks`` and ``none`` output
+        modes produce no image at all. ``observer`` receives progress
+        updates (see ``StageTimer``).
+        """
+        timer = self.new_timer(observer)
+        if self.profile is not None and get_device().type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        image_path = source_path(image)
+        name = os.path.splitext(os.path.basename(image_path))[0] if image_path else 'image'
+        with request_peak_rss() as measurement, profiled(self.profile, self.profile_dir, name) as trace:
+            result = self._process_image(image, image_path, output_path, timer)
+        if 'trace' in trace:
+            result['profile_trace'] = trace['trace']
+        if 'memory' in result and 'peak_rss_mb' in measurement:
+            result['memory']['peak_rss_mb'] = measurement['peak_rss_mb']
+        return result
+    
+    def _process_image(self, image, image_path, output_path, timer):
+        """``process_image`` for one image, timed by ``timer``"""
+        try:
+            output_path = self.output_file(image_path, output_path)
+            
+            # Answer repeated images from the cache without touching the models
+            cache_key = None
+            if self.cache is not None or self.artifacts is not None:
+                with timer.stage('read'):
+                    image = read_image_content(image)
+            if self.cache is not None:
+                cache_key, cached = self.lookup_cache(image, output_path, timer)
+                if cached is not None:
+                    cached['original_image_path'] = image_path
+                    return cached
+            
+            # ...or re-analyse them from their saved network outputs
+            artifact_key, stored = None, None
+            if self.artifacts is not None:
+                artifact_key, stored = self.lookup_artifacts(image, timer)
+            
+            original_image = self.load_image(image, timer)
+            
+            # Run YOLO detection on the already decoded image
+            if stored is not None:
+                yolo_result = stored
+            else:
+                with timer.stage('yolo'):
+                    yolo_result = self.predict([original_image])[0]
+            
+            return self.analyse(image_path, original_image, yolo_result, timer, output_path, cache_key,
+                                artifact_key)
+            
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
+    def process_images(self, image_paths):
+        """Process many images, yielding one result per image as soon as it is ready.
+        
+        Images are decoded on a thread pool and run through YOLO in batches of
+        ``self.yolo_batch_size``. Results are yielded in completion order, so a
+        slow or corrupt file never holds up the rest.
+        """
+        paths = iter(image_paths)
+        max_in_flight = self.yolo_batch_size * 2
+        pending = set()
+        batch = []
+        exhausted = False
+        
+        with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as pool:
+            while True:
+                # Keep a bounded number of images decoded ahead of YOLO
+                while not exhausted and len(pending) + len(batch) < max_in_flight:
+                    image_path = next(paths, None)
+                    if image_path is None:
+                        exhausted = True
+                    else:
+                        pending.add(pool.submit(self.read_batch_item, image_path))
+                
+                if not pending:
+                    break
+                
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, outcome = future.result()
+                    if outcome is not None:
+                        yield outcome
+                    else:
+                        batch.append(job)
+                
+                if len(batch) >= self.yolo_batch_size:
+                    yield from self._process_batch(batch)
+                    batch = []
             
-            # Create processed image (with overlays) - copy of original
-            # IMPORTANT: Do NOT modify the original image file
-            processed_image = original_image.copy()
-            detection_results = []
+            if batch:
+                yield from self._process_batch(batch)
+    
+    def read_batch_item(self, image_path):
+        """Decode one image of a batch run, or answer it straight from the cache.
+        
+        Returns ``(job, outcome)`` where ``outcome`` is a finished result (cached
+        or error) when the image needs no inference, otherwise ``None``.
+        """
+        job = ImageJob(image_path, self.new_timer())
+        try:
+            if self.cache is None and self.artifacts is None:
+                job.image = self.read_image(image_path, job.timer)
+                return job, None
+            
+            with job.timer.stage('read'):
+                content = read_image_content(image_path)
+            if self.cache is not None:
+                job.cache_key, cached = self.lookup_cache(content, self.output_file(image_path), job.timer)
+                if cached is not None:
+                    cached['original_image_path'] = image_path
+                    return job, cached
+            if self.artifacts is not None:
+                job.artifact_key, job.stored = self.lookup_artifacts(content, job.timer)
+            
+            job.image = self.load_image(content, job.timer)
+            return job, None
+        except Exception as e:
+            return job, _error_result(image_path, e)
+    
+    def predict_batch(self, jobs):
+        """Run YOLO on decoded jobs, one forward pass per image shape.
+        
+        Yields ``(job, yolo_result)``; if an image could not be processed
+        ``yolo_result`` is the exception instead.
+        """
+        # Mixed shapes would be letterboxed to a square input and give
+        # different detections than a single-image run, so group by shape
+        groups = {}
+        for job in jobs:
+            if job.stored is not None:
+                yield job, job.stored
+                continue
+            groups.setdefault(job.image.shape, []).append(job)
+        
+        for group in groups.values():
+            try:
+                start = time.perf_counter()
+                yolo_results = self.predict([job.image for job in group])
+                # Share the batched YOLO time evenly between the images
+                yolo_ms = (time.perf_counter() - start) * 1000 / len(group)
+            except Exception:
+                # One bad image must not fail the whole batch: retry individually
+                yolo_results = None
             
-            total_teeth = 0
-            total_calculus_coverage = 0
+            for index, job in enumerate(group):
+                if yolo_results is not None:
+                    job.timer.add('yolo', yolo_ms)
+                    yield job, yolo_results[index]
+                    continue
+                try:
+                    with job.timer.stage('yolo'):
+                        yolo_result = self.predict([job.image])[0]
+                except Exception as e:
+                    yolo_result = e
+                yield job, yolo_result
+    
+    def _process_batch(self, jobs):
+        for job, yolo_result in self.predict_batch(jobs):
+            try:
+                if isinstance(yolo_result, Exception):
+                    raise yolo_result
+                yield self.analyse(job.image_path, job.image, yolo_result, job.timer,
+                                   cache_key=job.cache_key, artifact_key=job.artifact_key)
+            except Exception as e:
+                yield _error_result(job.image_path, e)
+    
+    def analyse(self, image_path, original_image, yolo_result, timer, output_path=None, cache_key=None,
+                artifact_key=None):
+        """Segment calculus on every tooth found by YOLO, draw the overlay and save it"""
+        teeth, total_teeth = self.infer_teeth(original_image, yolo_result, timer, artifact_key)
+        result = self.render(image_path, original_image, teeth, total_teeth, timer, output_path, cache_key)
+        if isinstance(yolo_result, StoredResult):
+            result['reanalysed'] = True
+        return result
+    
+    def crop_tooth(self, j, mask, original_image, box=None):
+        """Crop tooth ``j`` from a full-frame mask.
+        
+        ``mask`` is a uint8 numpy array or a YOLO mask tensor on any device and
+        ``box`` its tight (x1, y1, x2, y2) box if already known. For tensors only
+        the padded crop is copied off the device. Returns ``None`` for an empty
+        mask, otherwise the tooth dict from ``measure_tooth``.
+        """
+        h, w, _ = original_image.shape
+        if box is None:
+            bx, by, bw, bh = cv2.boundingRect(mask)
+            if bw == 0 or bh == 0:
+                return None
+            box = (bx, by, bx + bw - 1, by + bh - 1)
+        
+        x1, y1, x2, y2 = padded_box(box, h, w, self.padding)
+        crop_tooth_mask = mask[y1:y2, x1:x2]
+        if isinstance(crop_tooth_mask, torch.Tensor):
+            crop_tooth_mask = crop_tooth_mask.cpu().numpy().astype(np.uint8) * 255
+        return self.measure_tooth(j, original_image, (x1, y1, x2, y2), crop_tooth_mask)
+    
+    def crop_tooth_polygon(self, j, polygon, original_image):
+        """Crop tooth ``j`` from its YOLO polygon (original image coordinates).
+        
+        The mask is rasterized directly at crop size, so memory per tooth is
+        bounded by the tooth, not by the image.
+        """
+        if len(polygon) < 3:
+            return None
+        h, w, _ = original_image.shape
+        points = np.round(polygon).astype(np.int32)
+        bx, by, bw, bh = cv2.boundingRect(points)
+        x1, y1, x2, y2 = padded_box((bx, by, bx + bw - 1, by + bh - 1), h, w, self.padding)
+        
+        crop_tooth_mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+        cv2.fillPoly(crop_tooth_mask, [points - np.array([x1, y1], dtype=np.int32)], 255)
+        return self.measure_tooth(j, original_image, (x1, y1, x2, y2), crop_tooth_mask)
+    
+    def measure_tooth(self, j, original_image, bbox, crop_tooth_mask):
+        """Measure a cropped tooth mask in a single pass.
+        
+        Returns a dict with the padded bounding box, the image and mask crops,
+        the tooth area in pixels and the tooth centroid in crop coordinates.
+        """
+        x1, y1, x2, y2 = bbox
+        tooth_crop = original_image[y1:y2, x1:x2]
+        if crop_tooth_mask.shape != tooth_crop.shape[:2]:
+            crop_tooth_mask = cv2.resize(crop_tooth_mask, (x2 - x1, y2 - y1), interpolation=cv2.INTER_NEAREST)
+        
+        moments = cv2.moments(crop_tooth_mask, binaryImage=True)
+        area = int(moments['m00'])
+        centroid = (int(moments['m10'] / area), int(moments['m01'] / area)) if area else None
+        
+        return {
+            'index': j,
+            'bbox': bbox,
+            'crop': tooth_crop,
+            'crop_mask': crop_tooth_mask,
+            'area': area,
+            'centroid': centroid
+        }
+    
+    def infer_teeth(self, original_image, yolo_result, timer, artifact_key=None):
+        """Crop every tooth found by YOLO and attach its calculus mask.
+        
+        ``yolo_result`` may be a ``StoredResult``; otherwise the network outputs
+        are saved under ``artifact_key``. Returns the list of teeth and the
+        number of YOLO detections.
+        """
+        total_teeth = 0
+        
+        # Stage 1: crop every detected tooth
+        teeth = []
+        with timer.stage('crop'):
+            if yolo_result.masks is None:
+                candidates = []
+            elif self.mask_mode == 'polygon':
+                candidates = (
+                    self.crop_tooth_polygon(j, polygon, original_image)
+                    for j, polygon in enumerate(yolo_result.masks.xy)
+                )
+            else:
+                # Boxes for all masks in one pass on the device; only the
+                # padded crops are copied back, never full-frame masks
+                masks = yolo_result.masks.data
+                candidates = (
+                    self.crop_tooth(j, mask, original_image, box) if box is not None else None
+                    for j, (mask, box) in enumerate(zip(masks, mask_boxes(masks)))
+                )
             
-            for i, r in enumerate(results):
-                if r.masks is None:
+            produced = time.perf_counter()
+            for tooth in candidates:
+                # Candidates are produced lazily, so each gap is one tooth's crop time
+                timer.add_tooth(total_teeth, 'crop', (time.perf_counter() - produced) * 1000)
+                total_teeth += 1
+                if tooth is not None:
+                    teeth.append(tooth)
+                produced = time.perf_counter()
+        
+        # Stage 2: segment calculus for all teeth at once
+        with timer.stage('unet'):
+            if self.unet_enabled and teeth:
+                started = time.perf_counter()
+                known = getattr(yolo_result, 'probabilities', None) or {}
+                missing = [tooth for tooth in teeth if tooth['index'] not in known]
+                if missing:
+                    probabilities = self.unet_probabilities([tooth['crop'] for tooth in missing])
+                    known = dict(known)
+                    known.update((tooth['index'], probability) for tooth, probability in zip(missing, probabilities))
+                pred_masks = []
+                for tooth in teeth:
+                    tooth['probability'] = known[tooth['index']]
+                    pred_masks.append(self.calculus_mask(tooth['probability'], tooth['crop']))
+                # The U-Net runs in batches; share its time equally between the teeth
+                share = (time.perf_counter() - started) * 1000 / len(teeth)
+                for tooth in teeth:
+                    timer.add_tooth(tooth['index'], 'unet', share)
+            else:
+                pred_masks = []
+                for done, tooth in enumerate(teeth, 1):
+                    with timer.tooth_stage(tooth['index'], 'unet'):
+                        pred_masks.append(
+                            self.demo_calculus_mask(tooth['index'], tooth['crop'], tooth['crop_mask'])
+                        )
+                    timer.progress('unet', done, len(teeth))
+            for tooth, pred_mask in zip(teeth, pred_masks):
+                tooth['pred_mask'] = pred_mask
+        
+        if artifact_key is not None and self.artifacts is not None and not isinstance(yolo_result, StoredResult):
+            with timer.stage('artifacts'):
+                self.artifacts.put(artifact_key, self.pack_artifacts(yolo_result, teeth))
+        
+        return teeth, total_teeth
+    
+    def render_tooth(self, processed_image, tooth):
+        """Measure one tooth's calculus coverage and draw its overlay and label.
+        
+        Nothing is drawn when ``processed_image`` is ``None``. Returns the
+        tooth's entry for ``individual_results`` and its unrounded coverage
+        percentage.
+        """
+        j = tooth['index']
+        pred_mask = tooth['pred_mask']
+        x1, y1, x2, y2 = tooth['bbox']
+        
+        # Calculate percentage coverage from the tooth area measured at crop time
+        # and the overlap of the calculus mask with the tooth mask
+        tooth_mask_area = tooth['area']
+        calc_overlap = cv2.countNonZero(cv2.bitwise_and(tooth['crop_mask'], pred_mask))
+        percent_covered = 100 * calc_overlap / (tooth_mask_area + 1e-6)
+        
+        # Calculate better text positioning based on tooth center of mass
+        if tooth['centroid'] is not None:
+            # Center of mass relative to the crop
+            com_x, com_y = tooth['centroid']
+            # Convert to global coordinates
+            text_x = x1 + com_x
+            text_y = y1 + com_y
+        else:
+            # Fallback to bounding box center
+            text_x = (x1 + x2) // 2
+            text_y = (y1 + y2) // 2
+        
+        if processed_image is not None:
+            self.draw_tooth(processed_image, tooth, percent_covered, text_x, text_y)
+        
+        detection = {
+            'tooth_id': j + 1,
+            'calculus_percentage': round(percent_covered, 2),
+            'bounding_box': [int(x1), int(y1), int(x2), int(y2)],
+            'tooth_area': tooth_mask_area,
+            'calculus_area': calc_overlap,
+            'centroid': [int(x1 + com_x), int(y1 + com_y)] if tooth['centroid'] is not None else None
+        }
+        return detection, percent_covered
+    
+    def draw_tooth(self, processed_image, tooth, percent_covered, text_x, text_y):
+        """Blend one tooth's calculus mask into the overlay and label it with its coverage"""
+        pred_mask = tooth['pred_mask']
+        tooth_crop = tooth['crop']
+        x1, y1, x2, y2 = tooth['bbox']
+        
+        # Create red overlay for calculus with better visibility
+        red_mask = np.zeros_like(tooth_crop)
+        red_mask[:, :, 2] = pred_mask  # Red channel
+        
+        # Make calculus areas more prominent
+        blended = cv2.addWeighted(tooth_crop, 0.6, red_mask, 0.9, 0)
+        
+        # Also add some blue to make it more purple-red for better contrast
+        purple_mask = np.zeros_like(tooth_crop)
+        purple_mask[:, :, 0] = pred_mask // 2  # Blue channel (half intensity)
+        purple_mask[:, :, 2] = pred_mask  # Red channel
+        blended = cv2.addWeighted(blended, 0.7, purple_mask, 0.3, 0)
+        
+        processed_image[y1:y2, x1:x2] = blended
+        
+        text = f"{percent_covered:.1f}%"
+        
+        # Scale font size based on tooth size for better visibility
+        tooth_width = x2 - x1
+        tooth_height = y2 - y1
+        base_font_scale = min(tooth_width, tooth_height) / 80.0  # Reduced divisor for larger text
+        font_scale = max(1.0, min(3.0, base_font_scale))  # Increased minimum and maximum
+        
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_thickness = max(2, int(font_scale * 2))  # Scale thickness with font size
+        (text_width, text_height), baseline = cv2.getTextSize(text, font, font_scale, font_thickness)
+        
+        # FIXED: Better bounds checking - ensure text stays within tooth area, not image bounds
+        # Keep text within the tooth's bounding box
+        text_x = max(x1 + text_width//2 + 10, min(x2 - text_width//2 - 10, text_x))
+        text_y = max(y1 + text_height + 10, min(y2 - 10, text_y))
+        
+        # Draw black background rectangle with border for better visibility
+        bg_padding = max(8, int(font_scale * 8))  # Increased padding
+        cv2.rectangle(
+            processed_image,
+            (text_x - text_width//2 - bg_padding, text_y - text_height//2 - bg_padding),
+            (text_x + text_width//2 + bg_padding, text_y + text_height//2 + bg_padding),
+            (0, 0, 0),  # Black background
+            -1
+        )
+        
+        # Draw white border for better contrast
+        cv2.rectangle(
+            processed_image,
+            (text_x - text_width//2 - bg_padding, text_y - text_height//2 - bg_padding),
+            (text_x + text_width//2 + bg_padding, text_y + text_height//2 + bg_padding),
+            (255, 255, 255),  # White border
+            max(2, int(font_scale * 1.5))  # Thicker border
+        )
+        
+        # Draw text in bright yellow for maximum visibility
+        cv2.putText(
+            processed_image,
+            text,
+            (text_x - text_width//2, text_y + text_height//2),
+            font,
+            font_scale,
+            (0, 255, 255),  # Bright yellow
+            font_thickness,
+            cv2.LINE_AA
+        )
+    
+    def encode_masks(self, tooth):
+        """The tooth and calculus shapes of one tooth for masks output, in ``self.mask_encoding``"""
+        x1, y1, x2, y2 = tooth['bbox']
+        if self.mask_encoding == 'rle':
+            # Runs cover the tooth's bounding box row by row
+            return {
+                'bbox': [int(x1), int(y1), int(x2), int(y2)],
+                'tooth': mask_rle(tooth['crop_mask']),
+                'calculus': mask_rle(tooth['pred_mask'])
+            }
+        return {
+            'tooth': mask_polygons(tooth['crop_mask'], x1, y1),
+            'calculus': mask_polygons(tooth['pred_mask'], x1, y1)
+        }
+    
+    def output_file(self, image_path, output_path=None):
+        """Where the overlay goes; ``None`` when it is returned as base64 or not produced at all"""
+        if self.output_mode in ('masks', 'none'):
+            return None
+        if output_path is None and image_path is not None and self.output_mode == 'preview':
+            extension = PREVIEW_FORMATS[self.preview_format][0]
+            output_path = f"{os.path.splitext(image_path)[0]}_processed{extension}"
+        return overlay_path(image_path, output_path)
+    
+    def overlay_extension(self):
+        """File extension of an overlay that has no source image to take it from"""
+        if self.output_mode == 'preview':
+            return PREVIEW_FORMATS[self.preview_format][0]
+        return '.jpg'
+    
+    def write_overlay(self, processed_image, output_path):
+        """Write the overlay to ``output_path``, or return it base64 encoded when there is none.
+        
+        Previews are scaled down to ``self.preview_size`` on their longest side
+        and encoded at ``self.preview_quality``.
+        """
+        extension, params = self.overlay_extension(), []
+        if self.output_mode == 'preview':
+            h, w = processed_image.shape[:2]
+            scale = self.preview_size / max(h, w)
+            if scale < 1:
+                processed_image = cv2.resize(processed_image, (max(1, round(w * scale)), max(1, round(h * scale))),
+                                             interpolation=cv2.INTER_AREA)
+            quality_flag = PREVIEW_FORMATS[self.preview_format][1]
+            params = [getattr(cv2, quality_flag), self.preview_quality]
+        
+        if output_path is not None:
+            cv2.imwrite(output_path, processed_image, params)
+            return None
+        _, encoded = cv2.imencode(extension, processed_image, params)
+        return base64.b64encode(encoded.tobytes()).decode('ascii')
+    
+    def render(self, image_path, original_image, teeth, total_teeth, timer, output_path=None,
+               cache_key=None):
+        """Compute coverage statistics and produce the configured output (see ``OUTPUT_MODES``)"""
+        # Create processed image (with overlays) - copy of original
+        # IMPORTANT: Do NOT modify the original image file
+        # Masks and none modes report the same per-tooth data without drawing
+        drawing = self.output_mode in ('overlay', 'preview')
+        processed_image = original_image.copy() if drawing else None
+        masks = [] if self.output_mode == 'masks' else None
+        detection_results = []
+        total_calculus_coverage = 0
+        
+        # Stage 3: coverage statistics and overlay drawing
+        with timer.stage('render'):
+            for done, tooth in enumerate(teeth, 1):
+                with timer.tooth_stage(tooth['index'], 'render'):
+                    detection, percent_covered = self.render_tooth(processed_image, tooth)
+                    if masks is not None:
+                        masks.append(dict(self.encode_masks(tooth), tooth_id=detection['tooth_id']))
+                timer.progress('render', done, len(teeth))
+                total_calculus_coverage += percent_covered
+                detection_results.append(detection)
+        
+        # Save processed image with overlays
+        # Create a separate processed image path to avoid overwriting the original
+        output_path = self.output_file(image_path, output_path)
+        
+        processed_image_base64 = None
+        if drawing:
+            with timer.stage('write'):
+                processed_image_base64 = self.write_overlay(processed_image, output_path)
+        
+        # Calculate overall statistics
+        avg_calculus_coverage = total_calculus_coverage / total_teeth if total_teeth > 0 else 0
+        
+        result = {
+            'success': True,
+            'teeth_detected': total_teeth,
+            'average_calculus_coverage': round(avg_calculus_coverage, 2),
+            'individual_results': detection_results,
+            'processed_image_path': output_path,
+            'original_image_path': image_path,
+            'settings': dict(self.settings(), image_size=[original_image.shape[1], original_image.shape[0]])
+        }
+        if processed_image_base64 is not None:
+            result['processed_image_base64'] = processed_image_base64
+        if masks is not None:
+            result['masks'] = masks
+        
+        if cache_key is not None and self.cache is not None:
+            with timer.stage('cache'):
+                self.cache.put(cache_key, result)
+        
+        result['timings'] = timer.as_dict()
+        # The kernel counts the peak per process: with concurrent jobs it may be another job's.
+        # process_image adds the request's own peak_rss_mb when it ran alone
+        result['memory'] = {'process_peak_rss_mb': peak_rss_mb()}
+        if timer.detailed:
+            result['timings']['model_load'] = self.model_load_ms
+            if get_device().type == 'cuda':
+                result['memory']['peak_cuda_mb'] = round(torch.cuda.max_memory_allocated() / 2 ** 20, 1)
+        return result
+
+class PipelinedRunner:
+    """Overlap decoding, inference and overlay rendering for batch runs.
+    
+    JPEG decoding and rendering/encoding run on two thread pools (OpenCV
+    releases the GIL), while a single dedicated thread owns the models and
+    runs YOLO and the calculus segmentation. Bounded queues between the
+    stages keep every core busy without letting decoded images pile up.
+    """
+    
+    def __init__(self, detector, io_workers=None, torch_threads=None, queue_size=None):
+        cpu_count = os.cpu_count() or 1
+        self.detector = detector
+        self.io_workers = io_workers or PIPELINE_IO_WORKERS
+        self.torch_threads = torch_threads or max(1, cpu_count - self.io_workers)
+        self.queue_size = queue_size or detector.yolo_batch_size * 2
+    
+    def run(self, image_paths):
+        """Yield one result per image in completion order"""
+        torch.set_num_threads(self.torch_threads)
+        
+        decoded = queue.Queue(maxsize=self.queue_size)
+        finished = queue.Queue()
+        render_slots = threading.Semaphore(self.queue_size)
+        stop = threading.Event()
+        
+        decode_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='decode')
+        render_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='render')
+        
+        def put_unless_stopped(target, item):
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return
+                except queue.Full:
                     continue
+        
+        def decode(image_path):
+            put_unless_stopped(decoded, self.detector.read_batch_item(image_path))
+        
+        def feed():
+            futures = []
+            for image_path in image_paths:
+                if stop.is_set():
+                    break
+                futures.append(decode_pool.submit(decode, image_path))
+            wait(futures)
+            put_unless_stopped(decoded, _PIPELINE_DONE)
+        
+        def render(job, teeth, total_teeth):
+            try:
+                result = self.detector.render(
+                    job.image_path, job.image, teeth, total_teeth, job.timer,
+                    cache_key=job.cache_key
+                )
+                if job.stored is not None:
+                    result['reanalysed'] = True
+                finished.put(result)
+            except Exception as e:
+                finished.put(_error_result(job.image_path, e))
+            finally:
+                render_slots.release()
+        
+        def infer():
+            render_futures = []
+            done = False
+            while not done and not stop.is_set():
+                # Block for one image, then batch whatever else is already decoded
+                batch = [decoded.get()]
+                while len(batch) < self.detector.yolo_batch_size:
+                    try:
+                        batch.append(decoded.get_nowait())
+                    except queue.Empty:
+                        break
                 
-                for j, mask in enumerate(r.masks.data):
-                    total_teeth += 1
-                    mask_np = mask.cpu().numpy().astype(np.uint8) * 255
-                    ys, xs = np.where(mask_np > 0)
-                    
-                    if ys.size == 0 or xs.size == 0:
+                ready = []
+                for item in batch:
+                    if item is _PIPELINE_DONE:
+                        done = True
                         continue
-                    
-                    # Calculate bounding box with padding
-                    y1, y2 = max(ys.min() - PADDING, 0), min(ys.max() + PADDING, h)
-                    x1, x2 = max(xs.min() - PADDING, 0), min(xs.max() + PADDING, w)
-                    
-                    # Crop and resize tooth
-                    tooth_crop = original_image[y1:y2, x1:x2]
-                    resized_crop = cv2.resize(tooth_crop, IMG_SIZE) / 255.0
-                    input_tensor = torch.tensor(resized_crop, dtype=torch.float32).permute(2, 0, 1).unsqueeze(0).to(DEVICE)
-                    
-                    # ⚠️  TEMPORARY DEMO SOLUTION ⚠️
-                    # The U-Net model (best_model.pth) is not properly trained and produces no meaningful output.
-                    # This code generates realistic demo results for presentation purposes.
-                    # For production use, the U-Net model needs to be properly trained using the notebook.
-                    
-                    # Create a realistic calculus mask for demonstration
-                    h_crop, w_crop = tooth_crop.shape[:2]
-                    pred_mask = np.zeros((h_crop, w_crop), dtype=np.uint8)
-                    
-                    # Simulate realistic calculus patterns based on tooth position
-                    import random
-                    random.seed(42 + j)  # Consistent results for same tooth
-                    
-                    # Define realistic calculus percentages for different teeth
-                    realistic_percentages = [0, 2.5, 5.1, 0.8, 3.2, 1.9, 0.0, 7.2, 4.6, 1.1, 0.3]
-                    tooth_percentage = realistic_percentages[j] if j < len(realistic_percentages) else random.uniform(0, 5)
-                    
-                    if tooth_percentage > 0 and h_crop > 10 and w_crop > 10:
-                        # Calculate how many pixels to mark as calculus
-                        crop_tooth_mask = mask_np[y1:y2, x1:x2]
-                        if crop_tooth_mask.shape != pred_mask.shape:
-                            crop_tooth_mask = cv2.resize(crop_tooth_mask, (w_crop, h_crop), interpolation=cv2.INTER_NEAREST)
-                        
-                        total_tooth_pixels = np.count_nonzero(crop_tooth_mask)
-                        target_calculus_pixels = int((tooth_percentage / 100.0) * total_tooth_pixels)
-                        
-                        if target_calculus_pixels > 0:
-                            # Create calculus primarily near the gum line (bottom 30% of tooth)
-                            gum_line_start = int(h_crop * 0.7)
-                            
-                            # Add calculus regions
-                            pixels_added = 0
-                            attempts = 0
-                            while pixels_added < target_calculus_pixels and attempts < 50:
-                                # Random position in gum area
-                                y_pos = random.randint(gum_line_start, h_crop - 1)
-                                x_pos = random.randint(0, w_crop - 1)
-                                
-                                # Only add if it's within the tooth mask
-                                if crop_tooth_mask[y_pos, x_pos] > 0:
-                                    # Add a small calculus region
-                                    region_size = random.randint(1, 3)
-                                    for dy in range(-region_size, region_size + 1):
-                                        for dx in range(-region_size, region_size + 1):
-                                            ny, nx = y_pos + dy, x_pos + dx
-                                            if (0 <= ny < h_crop and 0 <= nx < w_crop and 
-                                                crop_tooth_mask[ny, nx] > 0 and pred_mask[ny, nx] == 0):
-                                                pred_mask[ny, nx] = 255
-                                                pixels_added += 1
-                                                if pixels_added >= target_calculus_pixels:
-                                                    break
-                                        if pixels_added >= target_calculus_pixels:
-                                            break
-                                attempts += 1
-                    
-                    # Create red overlay for calculus with better visibility
-                    red_mask = np.zeros_like(tooth_crop)
-                    red_mask[:, :, 2] = pred_mask  # Red channel
-                    
-                    # Make calculus areas more prominent
-                    blended = cv2.addWeighted(tooth_crop, 0.6, red_mask, 0.9, 0)
-                    
-                    # Also add some blue to make it more purple-red for better contrast
-                    purple_mask = np.zeros_like(tooth_crop)
-                    purple_mask[:, :, 0] = pred_mask // 2  # Blue channel (half intensity)
-                    purple_mask[:, :, 2] = pred_mask  # Red channel
-                    blended = cv2.addWeighted(blended, 0.7, purple_mask, 0.3, 0)
-                    
-                    processed_image[y1:y2, x1:x2] = blended
-                    
-                    # Calculate percentage coverage
-                    # Get the tooth mask in the cropped region
-                    crop_tooth_mask = mask_np[y1:y2, x1:x2]
-                    
-                    # Ensure shapes match
-                    if crop_tooth_mask.shape != pred_mask.shape:
-                        crop_tooth_mask = cv2.resize(crop_tooth_mask, (pred_mask.shape[1], pred_mask.shape[0]), interpolation=cv2.INTER_NEAREST)
-                    
-                    tooth_mask_area = np.count_nonzero(crop_tooth_mask)
-                    calc_overlap = np.count_nonzero((crop_tooth_mask > 0) & (pred_mask > 0))
-                    percent_covered = 100 * calc_overlap / (tooth_mask_area + 1e-6)
-                    
-                    total_calculus_coverage += percent_covered
-                    
-                    # Calculate better text positioning based on tooth center of mass
-                    # Find the center of mass of the tooth within the crop region
-                    crop_tooth_mask_for_com = mask_np[y1:y2, x1:x2]
-                    if crop_tooth_mask_for_com.shape != (y2-y1, x2-x1):
-                        crop_tooth_mask_for_com = cv2.resize(crop_tooth_mask_for_com, (x2-x1, y2-y1), interpolation=cv2.INTER_NEAREST)
-                    
-                    # Find center of mass of the tooth
-                    tooth_pixels = np.where(crop_tooth_mask_for_com > 0)
-                    if len(tooth_pixels[0]) > 0:
-                        # Center of mass relative to the crop
-                        com_y = int(np.mean(tooth_pixels[0]))
-                        com_x = int(np.mean(tooth_pixels[1]))
-                        # Convert to global coordinates
-                        text_x = x1 + com_x
-                        text_y = y1 + com_y
+                    job, outcome = item
+                    if outcome is not None:
+                        finished.put(outcome)
                     else:
-                        # Fallback to bounding box center
-                        text_x = (x1 + x2) // 2
-                        text_y = (y1 + y2) // 2
-                    
-                    text = f"{percent_covered:.1f}%"
-                    
-                    # Scale font size based on tooth size for better visibility
-                    tooth_width = x2 - x1
-                    tooth_height = y2 - y1
-                    base_font_scale = min(tooth_width, tooth_height) / 80.0  # Reduced divisor for larger text
-                    font_scale = max(1.0, min(3.0, base_font_scale))  # Increased minimum and maximum
-                    
-                    font = cv2.FONT_HERSHEY_SIMPLEX
-                    font_thickness = max(2, int(font_scale * 2))  # Scale thickness with font size
-                    (text_width, text_height), baseline = cv2.getTextSize(text, font, font_scale, font_thickness)
-                    
-                    # FIXED: Better bounds checking - ensure text stays within tooth area, not image bounds
-                    # Keep text within the tooth's bounding box
-                    text_x = max(x1 + text_width//2 + 10, min(x2 - text_width//2 - 10, text_x))
-                    text_y = max(y1 + text_height + 10, min(y2 - 10, text_y))
-                    
-                    # Draw black background rectangle with border for better visibility
-                    bg_padding = max(8, int(font_scale * 8))  # Increased padding
-                    cv2.rectangle(
-                        processed_image,
-                        (text_x - text_width//2 - bg_padding, text_y - text_height//2 - bg_padding),
-                        (text_x + text_width//2 + bg_padding, text_y + text_height//2 + bg_padding),
-                        (0, 0, 0),  # Black background
-                        -1
-                    )
-                    
-                    # Draw white border for better contrast
-                    cv2.rectangle(
-                        processed_image,
-                        (text_x - text_width//2 - bg_padding, text_y - text_height//2 - bg_padding),
-                        (text_x + text_width//2 + bg_padding, text_y + text_height//2 + bg_padding),
-                        (255, 255, 255),  # White border
-                        max(2, int(font_scale * 1.5))  # Thicker border
-                    )
-                    
-                    # Draw text in bright yellow for maximum visibility
-                    cv2.putText(
-                        processed_image,
-                        text,
-                        (text_x - text_width//2, text_y + text_height//2),
-                        font,
-                        font_scale,
-                        (0, 255, 255),  # Bright yellow
-                        font_thickness,
-                        cv2.LINE_AA
-                    )
-                    
-                    detection_results.append({
-                        'tooth_id': j + 1,
-                        'calculus_percentage': round(percent_covered, 2),
-                        'bounding_box': [int(x1), int(y1), int(x2), int(y2)]
-                    })
+                        ready.append(job)
+                
+                for job, yolo_result in self.detector.predict_batch(ready):
+                    try:
+                        if isinstance(yolo_result, Exception):
+                            raise yolo_result
+                        teeth, total_teeth = self.detector.infer_teeth(job.image, yolo_result, job.timer,
+                                                                       job.artifact_key)
+                    except Exception as e:
+                        finished.put(_error_result(job.image_path, e))
+                        continue
+                    render_slots.acquire()
+                    render_futures.append(render_pool.submit(render, job, teeth, total_teeth))
             
-            # Save processed image with overlays
-            # Create a separate processed image path to avoid overwriting the original
-            base_path, ext = os.path.splitext(image_path)
-            output_path = f"{base_path}_processed{ext}"
-            cv2.imwrite(output_path, processed_image)
+            wait(render_futures)
+            finished.put(_PIPELINE_DONE)
+        
+        threads = [
+            threading.Thread(target=feed, name='pipeline-feed', daemon=True),
+            threading.Thread(target=infer, name='pipeline-infer', daemon=True)
+        ]
+        for thread in threads:
+            thread.start()
+        
+        try:
+            while True:
+                result = finished.get()
+                if result is _PIPELINE_DONE:
+                    break
+                yield result
+        finally:
+            stop.set()
+            decode_pool.shutdown(wait=False)
+            render_pool.shutdown(wait=False)
+
+class JobCancelled(Exception):
+    """Raised inside a running detection once its job has been cancelled"""
+
+class DetectionJob:
+    """One queued detection and its progress"""
+    
+    def __init__(self, job_id, image, output_path=None, detector=None):
+        self.id = job_id
+        self.image = image
+        self.output_path = output_path
+        self.detector = detector  # Per-request settings, see CalculusDetector.with_overrides
+        self.status = 'queued'  # queued, running, done, failed or cancelled
+        self.stage = None
+        self.teeth_done = 0
+        self.teeth_total = None
+        self.result = None
+        self.cancel_requested = threading.Event()
+        self.done = threading.Event()
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+    
+    def update(self, stage, teeth_done=None, teeth_total=None):
+        """Progress observer passed to ``process_image``; aborts cancelled jobs"""
+        if self.cancel_requested.is_set():
+            raise JobCancelled('Job cancelled')
+        self.stage = stage
+        if teeth_total is not None:
+            self.teeth_done = teeth_done
+            self.teeth_total = teeth_total
+    
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+    
+    def as_dict(self):
+        now = self.finished_at or time.time()
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': {'teeth_done': self.teeth_done, 'teeth_total': self.teeth_total},
+            'queued_for': round((self.started_at or now) - self.submitted_at, 3),
+            'running_for': round(now - self.started_at, 3) if self.started_at else 0.0
+        }
+
+class JobQueue:
+    """Bounded pool of detection workers fed from a bounded queue.
+    
+    Workers are threads sharing one detector: decoding, cropping, the U-Net
+    and rendering overlap while YOLO takes turns. ``submit`` refuses new jobs
+    once ``max_queued`` are waiting, so load beyond capacity is pushed back to
+    the caller instead of piling up in memory. Finished jobs are kept for
+    ``result_ttl`` seconds or until fetched.
+    """
+    
+    def __init__(self, detector, workers=None, max_queued=None, result_ttl=JOB_RESULT_TTL):
+        self.detector = detector
+        self.workers = workers or default_job_workers()
+        self.max_queued = max_queued or JOB_QUEUE_SIZE
+        self.result_ttl = result_ttl
+        self.pending = queue.Queue(maxsize=self.max_queued)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.next_id = 1
+        self.completed = 0
+        self.average_seconds = None
+        self.threads = [
+            threading.Thread(target=self.work, name=f'job-worker-{index}', daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+    
+    def submit(self, image, output_path=None, detector=None):
+        """Queue a detection; raises ``queue.Full`` when the queue is at capacity"""
+        self.expire()
+        with self.lock:
+            job = DetectionJob(f'job-{self.next_id}', image, output_path, detector)
+            self.pending.put_nowait(job)
+            self.next_id += 1
+            self.jobs[job.id] = job
+        return job
+    
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def fetch(self, job_id):
+        """Remove and return a finished job, ``None`` if it is unknown or still running"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or not job.finished:
+                return None
+            return self.jobs.pop(job_id)
+    
+    def cancel(self, job_id):
+        """Cancel a queued or running job; finished jobs are left alone"""
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel_requested.set()
+            with self.lock:
+                if job.status == 'queued':
+                    self.finish(job, 'cancelled', {'success': False, 'error': 'Job cancelled'})
+        return job
+    
+    def retry_after(self):
+        """Rough seconds until a queue slot frees up, for backpressure responses"""
+        return round((self.average_seconds or 1.0) * max(1, self.pending.qsize()) / self.workers, 1)
+    
+    def stats(self):
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {
+            'workers': self.workers,
+            'queued': statuses.count('queued'),
+            'running': statuses.count('running'),
+            'finished': len(statuses) - statuses.count('queued') - statuses.count('running'),
+            'max_queued': self.max_queued,
+            'completed': self.completed
+        }
+    
+    def expire(self):
+        """Forget finished jobs nobody fetched within ``result_ttl``"""
+        cutoff = time.time() - self.result_ttl
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job.finished and job.finished_at < cutoff]:
+                del self.jobs[job_id]
+    
+    def finish(self, job, status, result):
+        job.status = status
+        job.result = result
+        job.image = None
+        job.detector = None
+        job.finished_at = time.time()
+        job.done.set()
+    
+    def work(self):
+        while not self.stop.is_set():
+            try:
+                job = self.pending.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if job.finished:
+                    continue  # cancelled while queued
+                job.status = 'running'
+                job.started_at = time.time()
+            
+            detector = job.detector or self.detector
+            result = detector.process_image(job.image, job.output_path, observer=job.update)
+            if job.cancel_requested.is_set():
+                status = 'cancelled'
+                result = {'success': False, 'error': 'Job cancelled'}
+            else:
+                status = 'done' if result.get('success') else 'failed'
+            with self.lock:
+                self.finish(job, status, result)
+                self.completed += 1
+                seconds = job.finished_at - job.started_at
+                self.average_seconds = (seconds if self.average_seconds is None
+                                        else 0.8 * self.average_seconds + 0.2 * seconds)
+    
+    def shutdown(self):
+        """Cancel unfinished jobs and stop the workers"""
+        self.stop.set()
+        with self.lock:
+            for job in self.jobs.values():
+                job.cancel_requested.set()
+                if job.status == 'queued':
+                    self.finish(job, 'cancelled', {'success': False, 'error': 'Job cancelled'})
+        for thread in self.threads:
+            thread.join()
+
+class PoolWorker:
+    """Parent-side handle of one forked pool process"""
+    
+    def __init__(self, index, cores, threads):
+        self.index = index
+        self.cores = cores
+        self.threads = threads
+        self.process = None
+        self.connection = None
+        self.cancel = None
+        self.alive = True
+        self.tasks = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+
+class DetectorPool:
+    """Worker processes forked from a detector after its models are loaded.
+    
+    The forks share the model weights copy-on-write instead of loading their
+    own. Each one is pinned to its own set of cores, with matching torch and
+    OpenCV thread counts, so workers don't contend for cores. ``process_image``
+    blocks the calling thread until a free worker has processed the image,
+    which makes the pool a drop-in detector for ``JobQueue``. CPU only: CUDA
+    does not survive a fork.
+    """
+    
+    def __init__(self, detector, workers=None, threads=None):
+        if get_device().type != 'cpu':
+            raise ValueError('The process pool needs the CPU device; use job workers on a GPU')
+        detector.ensure_models()
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        self.detector = detector
+        self.size = workers or default_pool_workers(threads or POOL_THREADS)
+        self.started_at = time.time()
+        self.idle = queue.Queue()
+        self.workers = []
+        
+        # Contiguous core sets; workers share cores only when there are more workers than cores
+        per_worker = threads or (max(1, len(cores) // self.size) if cores else 1)
+        # Fork, not spawn, so the workers share the loaded weights. That is only safe
+        # before the first forward pass: a fork after torch's OpenMP pool has started
+        # deadlocks the child in libgomp
+        assert_fork_safe()
+        context = multiprocessing.get_context('fork')
+        for index in range(self.size):
+            worker_cores = ([cores[(index * per_worker + offset) % len(cores)] for offset in range(per_worker)]
+                            if cores else None)
+            worker = PoolWorker(index, sorted(set(worker_cores)) if worker_cores else None, per_worker)
+            worker.connection, child_connection = context.Pipe()
+            worker.cancel = context.Event()
+            worker.process = context.Process(target=self.serve_worker, args=(worker, child_connection),
+                                             name=f'detector-pool-{index}', daemon=True)
+            worker.process.start()
+            child_connection.close()
+            self.workers.append(worker)
+            self.idle.put(worker)
+    
+    def serve_worker(self, worker, connection):
+        """Main loop of a forked worker process"""
+        # Only the parent may hold the other workers' pipes, or they never see EOF
+        for other in self.workers:
+            other.connection.close()
+        worker.connection.close()
+        if worker.cores and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, worker.cores)
+        torch.set_num_threads(worker.threads)
+        cv2.setNumThreads(worker.threads)
+        
+        while True:
+            try:
+                task = connection.recv()
+            except (EOFError, OSError):
+                break
+            if task is None:
+                break
+            image, output_path, overrides, report_progress = task
             
-            # Calculate overall statistics
-            avg_calculus_coverage = total_calculus_coverage / total_teeth if total_teeth > 0 else 0
+            def observer(stage, teeth_done=None, teeth_total=None):
+                if worker.cancel.is_set():
+                    raise JobCancelled('Job cancelled')
+                if report_progress:
+                    connection.send(('progress', stage, teeth_done, teeth_total))
             
+            try:
+                result = self.detector.with_overrides(**overrides).process_image(image, output_path,
+                                                                                 observer=observer)
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+            connection.send(('result', result))
+    
+    def process_image(self, image, output_path=None, observer=None, overrides=None):
+        """Process one image on the next free worker; see ``CalculusDetector.process_image``"""
+        if isinstance(image, memoryview):
+            image = image.tobytes()  # mapped buffers can't be pickled
+        worker = self.idle.get()
+        started = time.perf_counter()
+        try:
+            worker.cancel.clear()
+            worker.connection.send((image, output_path, overrides or {}, observer is not None))
+            while True:
+                message = worker.connection.recv()
+                if message[0] == 'result':
+                    result = message[1]
+                    break
+                if observer is not None and not worker.cancel.is_set():
+                    try:
+                        observer(*message[1:])
+                    except JobCancelled:
+                        worker.cancel.set()  # the worker stops at its next stage or tooth
+        except (EOFError, OSError) as e:
+            worker.alive = False
+            result = {'success': False, 'error': f'Pool worker {worker.index} failed: {str(e)}'}
+        finally:
+            worker.busy_seconds += time.perf_counter() - started
+            worker.tasks += 1
+        
+        if not result.get('success'):
+            worker.errors += 1
+        if worker.alive:
+            self.idle.put(worker)
+        elif not any(other.alive for other in self.workers):
+            # Keep later callers from waiting forever on an empty pool
+            self.idle.put(worker)
+        return result
+    
+    def with_overrides(self, **overrides):
+        """A view of the pool that applies per-request settings in the workers"""
+        overrides = {key.upper(): value for key, value in overrides.items() if value is not None}
+        if not overrides:
+            return self
+        # Validated here, not in a worker
+        return PoolRequest(self, overrides, self.detector.with_overrides(**overrides))
+    
+    def overlay_extension(self):
+        return self.detector.overlay_extension()
+    
+    def stats(self):
+        """Per-worker load, for sizing instances: wall-clock busy share, CPU use and memory"""
+        uptime = max(time.time() - self.started_at, 1e-6)
+        workers = []
+        for worker in self.workers:
+            usage = process_usage(worker.process.pid)
+            stats = {
+                'index': worker.index,
+                'pid': worker.process.pid,
+                'alive': worker.alive and worker.process.is_alive(),
+                'cores': worker.cores,
+                'threads': worker.threads,
+                'tasks': worker.tasks,
+                'errors': worker.errors,
+                'busy_seconds': round(worker.busy_seconds, 3),
+                'utilization': round(min(1.0, worker.busy_seconds / uptime), 3)
+            }
+            if usage is not None:
+                stats['cpu_seconds'] = round(usage['cpu_seconds'], 3)
+                stats['cpu_utilization'] = round(usage['cpu_seconds'] / (uptime * worker.threads), 3)
+                stats['rss_mb'] = usage['rss_mb']
+                stats['private_mb'] = usage['private_mb']
+            workers.append(stats)
+        return {
+            'workers': self.size,
+            'idle': self.idle.qsize(),
+            'uptime': round(uptime, 3),
+            'per_worker': workers
+        }
+    
+    def shutdown(self):
+        """Ask every worker to exit, terminating the ones that don't"""
+        for worker in self.workers:
+            try:
+                worker.connection.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.connection.close()
+
+class PoolRequest:
+    """``DetectorPool`` bound to per-request settings"""
+    
+    def __init__(self, pool, overrides, settings):
+        self.pool = pool
+        self.overrides = overrides
+        self.settings = settings  # The parent's detector with the overrides applied
+    
+    def process_image(self, image, output_path=None, observer=None):
+        return self.pool.process_image(image, output_path, observer, self.overrides)
+    
+    def with_overrides(self, **overrides):
+        """The pool with these settings replaced on top of the request's own"""
+        return self.pool.with_overrides(**dict(self.overrides, **{key.upper(): value
+                                                                 for key, value in overrides.items()}))
+    
+    def overlay_extension(self):
+        return self.settings.overlay_extension()
+
+def degradation_overrides(detector, level):
+    """``MODEL`` overrides of degradation ``level`` (an index into ``DEGRADATION_LEVELS``).
+    
+    Levels are cumulative: ``reduced`` runs YOLO at ``DEGRADED_IMGSZ``,
+    ``no_unet`` also skips the U-Net and ``masks`` also returns mask shapes
+    instead of drawing and encoding an overlay. ``detector`` is the
+    ``CalculusDetector`` holding the request's settings, which are never
+    made more expensive.
+    """
+    overrides = {}
+    if level >= 1:
+        overrides['IMGSZ'] = min(detector.imgsz, DEGRADED_IMGSZ)
+    if level >= 2:
+        overrides['UNET'] = 'off'
+    if level >= 3 and detector.output_mode in ('overlay', 'preview'):
+        overrides['OUTPUT'] = 'masks'
+    return overrides
+
+class DeadlinePlanner:
+    """Latency estimates per degradation level, used to fit detections into a deadline.
+    
+    A level's estimate is a moving average of its measured detections; levels
+    not measured yet are extrapolated from the nearest measured one with
+    ``DEGRADATION_COSTS``. Without any measurement the full level is tried.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.estimates = [None] * len(DEGRADATION_LEVELS)  # seconds
+        self.chosen = [0] * len(DEGRADATION_LEVELS)
+        self.exceeded = 0
+    
+    def estimate(self, level):
+        if self.estimates[level] is not None:
+            return self.estimates[level]
+        measured = [(known, seconds) for known, seconds in enumerate(self.estimates) if seconds is not None]
+        if not measured:
+            return None
+        known, seconds = min(measured, key=lambda item: abs(item[0] - level))
+        return seconds * DEGRADATION_COSTS[level] / DEGRADATION_COSTS[known]
+    
+    def choose(self, budget, queued=0, workers=1, max_level=len(DEGRADATION_LEVELS) - 1):
+        """``(level, estimated seconds)`` of the least degraded level that fits ``budget`` seconds.
+        
+        With ``queued`` jobs waiting for ``workers``, the estimate is stretched
+        by the queue: a deep queue degrades early, so the jobs behind this one
+        get their turn in time as well. ``max_level`` is used when no level up
+        to it fits.
+        """
+        load = 1 + queued / max(1, workers)
+        with self.lock:
+            for level in range(max_level + 1):
+                estimate = self.estimate(level)
+                if estimate is None or estimate * load <= budget * DEADLINE_HEADROOM:
+                    break
+            self.chosen[level] += 1
+        return level, estimate
+    
+    def observe(self, level, seconds):
+        with self.lock:
+            previous = self.estimates[level]
+            self.estimates[level] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+    
+    def missed(self):
+        with self.lock:
+            self.exceeded += 1
+    
+    def stats(self):
+        with self.lock:
             return {
-                'success': True,
-                'teeth_detected': total_teeth,
-                'average_calculus_coverage': round(avg_calculus_coverage, 2),
-                'individual_results': detection_results,
-                'processed_image_path': output_path,
-                'original_image_path': image_path
+                'levels': [{
+                    'name': name,
+                    'estimated_ms': round(self.estimate(level) * 1000, 1) if self.estimate(level) is not None else None,
+                    'chosen': self.chosen[level]
+                } for level, name in enumerate(DEGRADATION_LEVELS)],
+                'exceeded': self.exceeded
             }
+
+class DeadlineRequest:
+    """A detector that degrades its settings to finish by a deadline.
+    
+    ``detector`` is a ``CalculusDetector``, ``DetectorPool`` or ``PoolRequest``
+    carrying the request's own settings. The level is chosen when the job
+    starts, from the time left and the depth of ``jobs``' queue, and is
+    reported in the result's ``degradation``. It goes no deeper than
+    ``max_degradation``, a name from ``DEGRADATION_LEVELS``.
+    """
+    
+    def __init__(self, detector, planner, jobs, deadline_ms, max_degradation=MAX_DEGRADATION):
+        self.detector = detector
+        self.planner = planner
+        self.jobs = jobs
+        self.deadline_ms = deadline_ms
+        self.max_level = DEGRADATION_LEVELS.index(max_degradation)
+        self.deadline = time.monotonic() + deadline_ms / 1000
+        self.degradation = {'level': None, 'name': None, 'deadline_ms': deadline_ms}
+    
+    def resolved(self):
+        """The ``CalculusDetector`` holding this request's settings"""
+        if isinstance(self.detector, DetectorPool):
+            return self.detector.detector
+        if isinstance(self.detector, PoolRequest):
+            return self.detector.settings
+        return self.detector
+    
+    def process_image(self, image, output_path=None, observer=None):
+        budget = self.deadline - time.monotonic()
+        if budget <= 0:
+            return {'success': False, 'error': f'Deadline of {self.deadline_ms} ms exceeded while queued',
+                    'deadline_exceeded': True, 'degradation': dict(self.degradation)}
+        
+        queued = self.jobs.pending.qsize()
+        level, estimate = self.planner.choose(budget, queued, self.jobs.workers, self.max_level)
+        self.degradation.update(
+            level=level,
+            name=DEGRADATION_LEVELS[level],
+            budget_ms=round(budget * 1000),
+            estimated_ms=round(estimate * 1000) if estimate is not None else None,
+            queued=queued
+        )
+        target = self.detector.with_overrides(**degradation_overrides(self.resolved(), level))
+        started = time.perf_counter()
+        result = target.process_image(image, output_path, observer)
+        # Answers from the cache or saved network outputs say nothing about the models' speed
+        if result.get('success') and not result.get('cached') and not result.get('reanalysed'):
+            self.planner.observe(level, time.perf_counter() - started)
+        result['degradation'] = dict(self.degradation)
+        return result
+    
+    def overlay_extension(self):
+        return self.resolved().overlay_extension()
+
+def process_usage(pid):
+    """CPU seconds and resident / private memory of a process (Linux), ``None`` elsewhere"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # Fields after the parenthesised command name; utime and stime are 14th and 15th
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        memory = {}
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Private_Clean', 'Private_Dirty'):
+                    memory[name] = int(value.split()[0]) / 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    return {
+        'cpu_seconds': cpu_seconds,
+        'rss_mb': round(memory.get('Rss', 0), 1),
+        # Pages not shared with the parent: what each extra worker really costs
+        'private_mb': round(memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0), 1)
+    }
+
+def available_memory_mb():
+    """MemAvailable in MB (Linux), ``None`` where unknown"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def default_job_workers():
+    """Job workers for this host: half the cores, as many as memory allows"""
+    workers = max(1, (os.cpu_count() or 1) // 2)
+    available = available_memory_mb()
+    if available is not None:
+        workers = min(workers, max(1, int(available // JOB_MEMORY_MB)))
+    return workers
+
+def default_pool_workers(threads=POOL_THREADS):
+    """Pool processes for this host: one per ``threads`` usable cores, as many as memory allows.
+    
+    Call it once the models are loaded: the forks share the weights, so only
+    the per-image working memory (``JOB_MEMORY_MB``) has to fit.
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    workers = max(1, cores // max(1, threads))
+    available = available_memory_mb()
+    if available is not None:
+        workers = min(workers, max(1, int(available // JOB_MEMORY_MB)))
+    return workers
+
+def benchmark_postprocess(teeth=30, image_size=(3000, 4000), repeats=3):
+    """Time the per-tooth post-processing on synthetic tooth masks.
+    
+    No models are needed: full-resolution elliptical masks stand in for the
+    YOLO output. Returns the mean and p95 milliseconds per tooth for the crop
+    and measurement pass, the calculus mask and the overlay drawing.
+    """
+    detector = CalculusDetector(lazy=True)
+    h, w = image_size
+    image = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    columns = int(np.ceil(np.sqrt(teeth)))
+    cell_h, cell_w = h // columns, w // columns
+    samples = {'crop': [], 'calculus_mask': [], 'render': [], 'total': []}
+    
+    for _ in range(repeats):
+        processed_image = image.copy()
+        for j in range(teeth):
+            row, column = divmod(j, columns)
+            mask_np = np.zeros((h, w), dtype=np.uint8)
+            center = (column * cell_w + cell_w // 2, row * cell_h + cell_h // 2)
+            cv2.ellipse(mask_np, center, (cell_w // 3, cell_h // 3), 0, 0, 360, 255, -1)
             
-        except Exception as e:
-            return {
+            start = time.perf_counter()
+            tooth = detector.crop_tooth(j, mask_np, image)
+            cropped = time.perf_counter()
+            tooth['pred_mask'] = detector.demo_calculus_mask(j, tooth['crop'], tooth['crop_mask'])
+            segmented = time.perf_counter()
+            detector.render_tooth(processed_image, tooth)
+            rendered = time.perf_counter()
+            
+            samples['crop'].append((cropped - start) * 1000)
+            samples['calculus_mask'].append((segmented - cropped) * 1000)
+            samples['render'].append((rendered - segmented) * 1000)
+            samples['total'].append((rendered - start) * 1000)
+    
+    return {
+        'teeth': teeth,
+        'image_size': [h, w],
+        'repeats': repeats,
+        'per_tooth_ms': {
+            step: {
+                'mean': round(float(np.mean(values)), 3),
+                'p95': round(float(np.percentile(values, 95)), 3)
+            }
+            for step, values in samples.items()
+        }
+    }
+
+def request_detector(detector, request):
+    """The detector for a detect/submit request's ``output`` and ``settings``, or ``(None, error response)``"""
+    settings = request.get('settings') or {}
+    if not isinstance(settings, dict):
+        return None, {'success': False, 'error': 'settings must be a JSON object'}
+    overrides = {key.upper(): value for key, value in settings.items()}
+    unknown = sorted(set(overrides) - set(REQUEST_SETTINGS))
+    if unknown:
+        return None, {'success': False, 'error': f"Unknown settings: {', '.join(unknown)}"}
+    try:
+        return detector.with_overrides(output=request.get('output'), **overrides), None
+    except (TypeError, ValueError) as e:
+        return None, {'success': False, 'error': str(e)}
+
+def shared_memory_dir():
+    """Directory for shared-memory transport buffers: tmpfs where available"""
+    if os.environ.get('CALCULUS_SHM_DIR'):
+        return os.environ['CALCULUS_SHM_DIR']
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def shared_buffer_path(suffix):
+    """A fresh file name in the shared-memory directory"""
+    return os.path.join(shared_memory_dir(), f'calculus-{os.getpid()}-{uuid.uuid4().hex}{suffix}')
+
+def open_shared_buffer(ref):
+    """Map the bytes described by an ``image_shm`` reference without copying them.
+    
+    ``ref`` is ``{"path": ..., "offset": 0, "size": n}``; ``offset`` and ``size``
+    default to the whole file. The mapping lives as long as the returned
+    memoryview, so the writer may unlink the file as soon as we answer.
+    """
+    offset = int(ref.get('offset') or 0)
+    with open(ref['path'], 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    size = int(ref['size']) if ref.get('size') is not None else len(mapped) - offset
+    if offset < 0 or size <= 0 or offset + size > len(mapped):
+        raise ValueError(f"{size} bytes at offset {offset} do not fit in {ref['path']}")
+    return memoryview(mapped)[offset:offset + size]
+
+def share_result(result):
+    """Hand a result's overlay and masks over as shared-memory buffers.
+    
+    The overlay was already written to a buffer file; masks are moved out of
+    the JSON. The caller reads and unlinks the ``*_shm`` files.
+    """
+    output_path = result.get('processed_image_path')
+    if output_path and os.path.exists(output_path):
+        result['processed_image_shm'] = {
+            'path': output_path,
+            'size': os.path.getsize(output_path),
+            'format': os.path.splitext(output_path)[1].lstrip('.')
+        }
+        result['processed_image_path'] = None
+    if 'masks' in result:
+        data = json.dumps(result.pop('masks')).encode()
+        masks_path = shared_buffer_path('-masks.json')
+        with open(masks_path, 'wb') as f:
+            f.write(data)
+        result['masks_shm'] = {'path': masks_path, 'size': len(data), 'format': 'json'}
+    return result
+
+def request_image(request):
+    """The image of a detect/submit request, or ``(None, error response)``"""
+    image_path = request.get('image_path')
+    if request.get('image_base64'):
+        # Upload buffers can be passed without writing a temp file
+        try:
+            return decode_base64_image(request['image_base64']), None
+        except ValueError as e:
+            return None, {'success': False, 'error': f'Invalid image_base64: {str(e)}'}
+    if request.get('image_shm'):
+        # ...or through a shared-memory file, keeping the control line small
+        try:
+            return open_shared_buffer(request['image_shm']), None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            return None, {'success': False, 'error': f'Invalid image_shm: {str(e)}'}
+    if not image_path or not os.path.exists(image_path):
+        return None, {
+            'success': False,
+            'error': f'Image file not found: {shorten(image_path)}'
+        }
+    return image_path, None
+
+def serve(input_stream=None, output_stream=None, profile=None, job_workers=None, processes=None,
+          pool_threads=None):
+    """Run a long-lived worker that keeps the models loaded between requests.
+
+    The protocol is one JSON object per line. Once the models are loaded the
+    worker writes a ``{"event": "ready"}`` line; every request line gets exactly
+    one response line echoing the request ``id``. Supported commands:
+
+        {"id": 1, "cmd": "detect", "image_path": "uploads/images/x.jpg"}
+        {"id": 1, "cmd": "detect", "image_base64": "...", "output_path": "out.jpg"}
+        {"id": 1, "cmd": "detect", "image_path": "uploads/images/x.jpg", "output": "masks"}
+        {"id": 1, "cmd": "detect", "image_path": "uploads/images/x.jpg", "settings": {"conf": 0.5}}
+        {"id": 1, "cmd": "detect", "image_shm": {"path": "/dev/shm/x", "size": 52311}, "transport": "shm"}
+
+    With ``"transport": "shm"`` the overlay and masks come back as
+    ``processed_image_shm`` / ``masks_shm`` buffer files (see ``share_result``).
+    With ``"deadline_ms"`` (default ``CALCULUS_DEADLINE_MS``) the answer comes
+    within that many milliseconds of the request: the detection runs on the
+    job pool at the least degraded level expected to fit (see
+    ``DeadlinePlanner``), and if it still runs late it is cancelled and the
+    answer carries ``"deadline_exceeded": true``.
+        {"id": 2, "cmd": "health"}
+        {"id": 3, "cmd": "shutdown"}
+
+    ``detect`` answers when the image is done. With ``processes`` (0 picks a
+    size from cores and memory) images run on a ``DetectorPool`` of forked
+    workers, and ``detect`` answers may come out of order. For many or slow
+    images, queue them on the job pool instead and poll (see ``JobQueue``):
+
+        {"id": 4, "cmd": "submit", "image_path": "uploads/images/x.jpg"}
+        {"id": 5, "cmd": "poll", "job_id": "job-1"}
+        {"id": 6, "cmd": "fetch", "job_id": "job-1"}
+        {"id": 7, "cmd": "cancel", "job_id": "job-1"}
+    """
+    input_stream = input_stream or sys.stdin
+    output_stream = output_stream or sys.stdout
+    # Anything printed by the libraries must not corrupt the protocol stream
+    sys.stdout = sys.stderr
+
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            output_stream.write(json.dumps(message) + "\n")
+            output_stream.flush()
+
+    if processes is None and os.environ.get('CALCULUS_PROCESSES'):
+        processes = int(os.environ['CALCULUS_PROCESSES'])
+    started_at = time.time()
+    pool = None
+    try:
+        detector = CalculusDetector(profile=profile)
+        if processes is not None:
+            # Fork before any other thread exists
+            pool = DetectorPool(detector, workers=processes or None,
+                                threads=pool_threads or int(os.environ.get('CALCULUS_POOL_THREADS') or 0) or None)
+            detector = pool
+    except Exception as e:
+        send({
+            'event': 'error',
+            'success': False,
+            'error': f'Model initialization failed: {str(e)}'
+        })
+        return 1
+
+    jobs = JobQueue(
+        detector,
+        workers=(job_workers or int(os.environ.get('CALCULUS_JOB_WORKERS') or 0)
+                 or (pool.size if pool is not None else None)),
+        max_queued=int(os.environ.get('CALCULUS_JOB_QUEUE_SIZE') or 0) or None
+    )
+    # Pool workers answer detect requests in parallel; one thread per worker waits on each
+    answering = ThreadPoolExecutor(max_workers=pool.size) if pool is not None else None
+    # Detect requests with a deadline wait for their job here, one thread per queued or running job
+    planner = DeadlinePlanner()
+    waiting = ThreadPoolExecutor(max_workers=jobs.max_queued + jobs.workers, thread_name_prefix='deadline')
+    default_deadline_ms = float(os.environ.get('CALCULUS_DEADLINE_MS') or 0) or None
+
+    def detect(request_id, target, image, output_path, shared):
+        response = target.process_image(image, output_path)
+        if shared:
+            share_result(response)
+        response['id'] = request_id
+        send(response)
+
+    def detect_by_deadline(request_id, job, bounded, output_path, shared):
+        if job.done.wait(max(0.0, bounded.deadline - time.monotonic())):
+            jobs.fetch(job.id)
+            response = job.result
+        else:
+            jobs.cancel(job.id)  # stops at the next stage or tooth
+            planner.missed()
+            response = {
                 'success': False,
-                'error': str(e)
+                'error': f'Deadline of {bounded.deadline_ms} ms exceeded',
+                'deadline_exceeded': True,
+                'degradation': dict(bounded.degradation)
             }
+        if shared:
+            share_result(response)
+        response['id'] = request_id
+        send(response)
 
-def main():
-    """Main function to process command line arguments"""
-    if len(sys.argv) != 2:
+        if not response.get('success') and output_path is not None:
+            # A late detection may still write its overlay; nobody will read it
+            job.done.wait(JOB_RESULT_TTL)
+            try:
+                os.unlink(output_path)
+            except OSError:
+                pass
+
+    send({
+        'event': 'ready',
+        'pid': os.getpid(),
+        'device': get_device().type,
+        'load_time': round(time.time() - started_at, 3),
+        'startup_time': round(startup_ms() / 1000, 3),
+        'job_workers': jobs.workers,
+        'processes': pool.size if pool is not None else None
+    })
+
+    requests_served = 0
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as e:
+            send({'success': False, 'error': f'Invalid request: {str(e)}'})
+            continue
+
+        request_id = request.get('id')
+        command = request.get('cmd', 'detect')
+
+        if command == 'health':
+            response = {
+                'success': True,
+                'status': 'ok',
+                'pid': os.getpid(),
+                'device': get_device().type,
+                'uptime': round(time.time() - started_at, 3),
+                'requests_served': requests_served,
+                'jobs': jobs.stats(),
+                'deadlines': planner.stats()
+            }
+            if pool is not None:
+                response['pool'] = pool.stats()
+        elif command == 'shutdown':
+            send({'id': request_id, 'success': True, 'status': 'shutting_down'})
+            break
+        elif command == 'detect':
+            target, response = request_detector(detector, request)
+            deadline_ms = request.get('deadline_ms', default_deadline_ms)
+            max_degradation = request.get('max_degradation', MAX_DEGRADATION)
+            if target is not None and deadline_ms is not None:
+                if isinstance(deadline_ms, bool) or not isinstance(deadline_ms, (int, float)) or deadline_ms <= 0:
+                    target, response = None, {'success': False, 'error': 'deadline_ms must be a positive number'}
+                elif max_degradation not in DEGRADATION_LEVELS:
+                    target, response = None, {'success': False, 'error': f"Unknown max_degradation {max_degradation!r}, "
+                                                                         f"expected one of {', '.join(DEGRADATION_LEVELS)}"}
+                else:
+                    target = DeadlineRequest(target, planner, jobs, deadline_ms, max_degradation)
+            image = None
+            if target is not None:
+                image, response = request_image(request)
+            if image is not None:
+                output_path = request.get('output_path')
+                shared = request.get('transport') == 'shm'
+                if shared:
+                    output_path = shared_buffer_path(target.overlay_extension())
+                if deadline_ms is not None:
+                    try:
+                        job = jobs.submit(image, output_path, target)
+                    except queue.Full:
+                        # Answered below; the server maps busy to 429 with Retry-After
+                        response = {
+                            'success': False,
+                            'error': 'Job queue is full',
+                            'busy': True,
+                            'retry_after': jobs.retry_after()
+                        }
+                    else:
+                        requests_served += 1
+                        waiting.submit(detect_by_deadline, request_id, job, target,
+                                       output_path if shared else None, shared)
+                        continue
+                else:
+                    requests_served += 1
+                    if answering is not None:
+                        answering.submit(detect, request_id, target, image, output_path, shared)
+                    else:
+                        detect(request_id, target, image, output_path, shared)
+                    continue
+        elif command == 'submit':
+            target, response = request_detector(detector, request)
+            image = None
+            if target is not None:
+                image, response = request_image(request)
+            if image is not None:
+                try:
+                    job = jobs.submit(image, request.get('output_path'), target)
+                    response = dict(job.as_dict(), success=True)
+                    requests_served += 1
+                except queue.Full:
+                    response = {
+                        'success': False,
+                        'error': 'Job queue is full',
+                        'busy': True,
+                        'retry_after': jobs.retry_after()
+                    }
+        elif command in ('poll', 'fetch', 'cancel'):
+            job_id = request.get('job_id')
+            if command == 'cancel':
+                job = jobs.cancel(job_id)
+            elif command == 'fetch':
+                job = jobs.fetch(job_id) or jobs.get(job_id)
+            else:
+                job = jobs.get(job_id)
+            
+            if job is None:
+                response = {'success': False, 'error': f'Unknown job: {job_id}'}
+            elif command == 'fetch' and not job.finished:
+                response = dict(job.as_dict(), success=False, error='Job not finished')
+            elif command == 'fetch':
+                response = dict(job.result, **job.as_dict())
+            else:
+                response = dict(job.as_dict(), success=True)
+                if command == 'cancel' and not job.finished:
+                    response['cancel_requested'] = True  # stops at the next stage or tooth
+        else:
+            response = {'success': False, 'error': f'Unknown command: {command}'}
+
+        response['id'] = request_id
+        send(response)
+
+    jobs.shutdown()
+    waiting.shutdown()
+    if pool is not None:
+        answering.shutdown()
+        pool.shutdown()
+    return 0
+
+def is_glob_pattern(path):
+    return any(char in path for char in '*?[')
+
+def expand_image_paths(arguments):
+    """Expand files, directories and glob patterns into image paths"""
+    for argument in arguments:
+        if os.path.isdir(argument):
+            candidates = [os.path.join(argument, name) for name in sorted(os.listdir(argument))]
+        elif is_glob_pattern(argument):
+            candidates = sorted(glob.glob(argument))
+        else:
+            # Explicit files are passed through so missing ones get an error line
+            yield argument
+            continue
+        
+        for path in candidates:
+            name, ext = os.path.splitext(os.path.basename(path))
+            # Skip our own overlay outputs from previous runs
+            if ext.lower() in IMAGE_EXTENSIONS and not name.endswith('_processed') and os.path.isfile(path):
+                yield path
+
+def process_many(args):
+    """Process several images, printing one JSON result per line as each finishes"""
+    try:
+        detector = CalculusDetector(cache=make_cache(args), profile=args.profile,
+                                    overrides=model_overrides(args), artifacts=make_artifacts(args))
+    except Exception as e:
+        print(json.dumps({
+            'success': False,
+            'error': f'Model initialization failed: {str(e)}'
+        }))
+        return 1
+    
+    image_paths = expand_image_paths(args.images)
+    if args.pipeline:
+        runner = PipelinedRunner(detector, io_workers=args.io_workers, torch_threads=args.threads)
+        results = runner.run(image_paths)
+    else:
+        results = detector.process_images(image_paths)
+    
+    for result in results:
+        print(json.dumps(result), flush=True)
+    return 0
+
+def check_setup(config_path="../default.yaml"):
+    """Report installed packages and model files without importing torch & co.
+    
+    Packages are looked up through import metadata only, so this answers in
+    milliseconds even where the real imports take seconds.
+    """
+    packages = {}
+    for distribution, module in REQUIRED_PACKAGES:
+        installed = importlib.util.find_spec(module) is not None
+        try:
+            version = metadata.version(distribution) if installed else None
+        except metadata.PackageNotFoundError:
+            version = None  # e.g. opencv-python-headless provides cv2
+        packages[distribution] = {'installed': installed, 'version': version}
+    
+    detector = CalculusDetector(config_path, lazy=True)
+    try:
+        yolo_file, unet_file = detector.model_files()
+        model_error = None
+    except RuntimeError as e:
+        yolo_file, unet_file = detector.yolo_path, detector.unet_path
+        model_error = str(e)
+    models = {
+        name: {'path': path, 'exists': os.path.isfile(path)}
+        for name, path in (('yolo', yolo_file), ('unet', unet_file))
+    }
+    
+    result = {
+        'success': (all(package['installed'] for package in packages.values())
+                    and all(model['exists'] for model in models.values()) and model_error is None),
+        'python': sys.version.split()[0],
+        'backend': detector.backend,
+        'packages': packages,
+        'models': models,
+        'startup_ms': startup_ms()
+    }
+    if model_error is not None:
+        result['error'] = model_error
+    return result
+
+def model_overrides(args):
+    """``MODEL`` settings given on the command line"""
+    return {
+        'IMGSZ': args.imgsz,
+        'CONF': args.conf,
+        'PADDING': args.padding,
+        'UNET_THRESHOLD': args.unet_threshold,
+        'INFERENCE': 'tiled' if args.tiled else None,
+        'TILE_SIZE': args.tile_size,
+        'TILE_OVERLAP': args.tile_overlap,
+        'DECODE_SCALE': args.decode_scale,
+        'OUTPUT': args.output,
+        'PREVIEW_SIZE': args.preview_size,
+        'PREVIEW_QUALITY': args.preview_quality,
+        'PREVIEW_FORMAT': args.preview_format,
+        'MASK_ENCODING': args.mask_encoding
+    }
+
+def make_cache(args):
+    """The result cache requested on the command line, if any"""
+    if args.cache_dir:
+        return ResultCache(args.cache_dir)
+    return None
+
+def make_artifacts(args):
+    """The artifact store requested on the command line, if any"""
+    if args.artifact_dir:
+        return ArtifactStore(args.artifact_dir)
+    return None
+
+class JsonArgumentParser(argparse.ArgumentParser):
+    """Report usage errors as JSON on stdout, like every other failure"""
+    
+    def error(self, message):
         print(json.dumps({
             'success': False,
-            'error': 'Usage: python ai_model.py <image_path>'
+            'error': f"{message}. {' '.join(self.format_usage().split())}"
         }))
         sys.exit(1)
+
+def parse_args(argv=None):
+    parser = JsonArgumentParser(
+        prog='ai_model.py',
+        description='Detect dental calculus with the YOLO + U-Net pipeline'
+    )
+    parser.add_argument('images', nargs='*',
+                        help='image files, directories or glob patterns')
+    parser.add_argument('--check', action='store_true',
+                        help='report installed packages and model files without loading anything')
+    parser.add_argument('--serve', action='store_true',
+                        help='run a persistent worker speaking JSON lines on stdin/stdout')
+    parser.add_argument('--job-workers', type=int,
+                        help='detection workers for queued jobs in --serve mode '
+                             '(default: $CALCULUS_JOB_WORKERS or sized to cores and memory)')
+    parser.add_argument('--processes', type=int,
+                        help='in --serve mode, fork this many model workers after loading, '
+                             'pinned to their own cores; 0 sizes the pool to cores and memory '
+                             '(default: $CALCULUS_PROCESSES or no pool)')
+    parser.add_argument('--pool-threads', type=int,
+                        help=f'cores and torch threads per pool worker (default: {POOL_THREADS} when '
+                             f'sizing automatically, otherwise the cores divided between the workers)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='overlap decode, inference and rendering in batch runs')
+    parser.add_argument('--threads', type=int,
+                        help='torch intra-op threads for the pipelined inference thread')
+    parser.add_argument('--io-workers', type=int,
+                        help='decode/encode threads per pool in pipelined runs')
+    parser.add_argument('--bench-postprocess', action='store_true',
+                        help='time the per-tooth post-processing on synthetic masks and exit')
+    parser.add_argument('--cache-dir',
+                        help='reuse results for repeated images (default: $CALCULUS_CACHE_DIR)')
+    parser.add_argument('--artifact-dir',
+                        help='save network outputs for re-analysis without the models '
+                             '(default: $CALCULUS_ARTIFACT_DIR)')
+    parser.add_argument('--imgsz', type=int,
+                        help=f'YOLO input size (default: MODEL.IMGSZ or {YOLO_IMGSZ})')
+    parser.add_argument('--conf', type=float,
+                        help=f'YOLO confidence threshold (default: MODEL.CONF or {YOLO_CONF})')
+    parser.add_argument('--padding', type=int,
+                        help=f'pixels added around each tooth crop (default: MODEL.PADDING or {PADDING})')
+    parser.add_argument('--unet-threshold', type=float,
+                        help=f'U-Net calculus probability threshold (default: UNET.THRESHOLD or {UNET_THRESHOLD})')
+    parser.add_argument('--tiled', action='store_true',
+                        help='run YOLO on overlapping tiles and merge the teeth across tiles')
+    parser.add_argument('--tile-size', type=int,
+                        help=f'tile side in image pixels (default: MODEL.TILE_SIZE or {TILE_SIZE})')
+    parser.add_argument('--tile-overlap', type=float,
+                        help=f'fraction of a tile shared with its neighbours (default: {TILE_OVERLAP})')
+    parser.add_argument('--decode-scale', type=int, choices=sorted(DECODE_SCALES),
+                        help='decode images reduced by this factor (JPEG reduced decoding)')
+    parser.add_argument('--output', choices=OUTPUT_MODES,
+                        help='full-size overlay, bounded preview, mask shapes only or no image '
+                             '(default: MODEL.OUTPUT or overlay)')
+    parser.add_argument('--preview-size', type=int,
+                        help=f'longest preview side in pixels (default: {PREVIEW_SIZE})')
+    parser.add_argument('--preview-quality', type=int,
+                        help=f'preview JPEG/WebP quality 1-100 (default: {PREVIEW_QUALITY})')
+    parser.add_argument('--preview-format', choices=sorted(PREVIEW_FORMATS),
+                        help='preview image format (default: jpg)')
+    parser.add_argument('--mask-encoding', choices=MASK_ENCODINGS,
+                        help='shape encoding for --output masks (default: polygon)')
+    parser.add_argument('--profile', action='store_true',
+                        help='add per-tooth timings and the model load time (default: $CALCULUS_PROFILE)')
+    parser.add_argument('--trace', choices=PROFILE_MODES[1:],
+                        help='also dump a cProfile or torch.profiler trace per image to $CALCULUS_PROFILE_DIR')
+    args = parser.parse_args(argv)
+    args.profile = args.trace or ('timings' if args.profile else None)
+    
+    if not (args.serve or args.bench_postprocess or args.check) and not args.images:
+        parser.error('an image path is required')
+    return args
+
+def main():
+    """Main function to process command line arguments"""
+    args = parse_args()
+    if args.check:
+        result = check_setup()
+        print(json.dumps(result))
+        sys.exit(0 if result['success'] else 1)
+    if args.serve:
+        sys.exit(serve(profile=args.profile, job_workers=args.job_workers, processes=args.processes,
+                       pool_threads=args.pool_threads))
+    if args.bench_postprocess:
+        print(json.dumps(benchmark_postprocess()))
+        sys.exit(0)
+    
+    # Several paths, a directory, a glob or a pipelined run: stream JSON lines
+    if (len(args.images) > 1 or args.pipeline or os.path.isdir(args.images[0])
+            or is_glob_pattern(args.images[0])):
+        sys.exit(process_many(args))
     
-    image_path = sys.argv[1]
+    image_path = args.images[0]
     
     if not os.path.exists(image_path):
         print(json.dumps({
@@ -323,7 +3130,11 @@ def main():
         sys.exit(1)
     
     try:
-        detector = CalculusDetector()
+        # Load the models up front unless a cache hit or saved artifacts might make them unnecessary
+        detector = CalculusDetector(cache=make_cache(args), lazy=True, profile=args.profile,
+                                    overrides=model_overrides(args), artifacts=make_artifacts(args))
+        if detector.cache is None and detector.artifacts is None:
+            detector.load_models()
         result = detector.process_image(image_path)
         print(json.dumps(result))
     except Exception as e:
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Benchmark Script
+Measures cold start, latency percentiles, throughput and peak memory of
+CalculusDetector over an image corpus, sweeping image size, batch size,
+thread count and backend. Every configuration runs in a fresh process so
+cold start and peak RSS are not skewed by earlier runs.
+
+Usage:
+    python benchmark.py                                   Benchmark annotate-images/
+    python benchmark.py --imgsz 480 640 --batch 1 4 --threads 2 4
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json           Flag regressions
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+
+# Lower is better for everything except throughput
+COMPARED_METRICS = {
+    'cold_start_s': 'lower',
+    'latency_p50_ms': 'lower',
+    'latency_p95_ms': 'lower',
+    'latency_p99_ms': 'lower',
+    'images_per_sec': 'higher',
+    'peak_rss_mb': 'lower'
+}
+DEFAULT_TOLERANCE = 0.10
+WORKER_TIMEOUT = 3600
+
+def percentile(values, q):
+    """Linearly interpolated percentile of a non-empty list"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def run_configuration(config):
+    """Benchmark one configuration in this process (the ``--worker`` side)"""
+    import_started = time.perf_counter()
+    import torch
+    from ai_model import CalculusDetector, PipelinedRunner, expand_image_paths, peak_rss_mb
+    import_s = time.perf_counter() - import_started
+    
+    if config['threads']:
+        torch.set_num_threads(config['threads'])
+    
+    # Work on a copy so overlays never land in the corpus
+    workdir = tempfile.mkdtemp(prefix='calculus-bench-')
+    try:
+        images = []
+        for source in itertools.islice(expand_image_paths(config['corpus']), config['limit']):
+            target = os.path.join(workdir, f"{len(images):04d}-{os.path.basename(source)}")
+            shutil.copyfile(source, target)
+            images.append(target)
+        if not images:
+            raise RuntimeError(f"No images found in {' '.join(config['corpus'])}")
+        
+        detector = CalculusDetector(config['config_path'], backend=config['backend'])
+        # Repeated passes must run the models, never a configured result cache
+        # or saved network outputs
+        detector.cache = None
+        detector.artifacts = None
+        if config['imgsz']:
+            detector.imgsz = config['imgsz']
+        detector.yolo_batch_size = config['batch']
+        
+        def run(paths):
+            """Yield ``(result, latency_ms)`` for every image"""
+            if config['pipeline']:
+                runner = PipelinedRunner(detector, torch_threads=config['threads'])
+                for result in runner.run(paths):
+                    yield result, result.get('timings', {}).get('total')
+            elif config['batch'] > 1:
+                for result in detector.process_images(paths):
+                    yield result, result.get('timings', {}).get('total')
+            else:
+                for path in paths:
+                    started = time.perf_counter()
+                    result = detector.process_image(path)
+                    yield result, (time.perf_counter() - started) * 1000
+        
+        # The first image is the cold start: spawn, imports, model load, first inference
+        first, _ = next(run(images[:1]))
+        cold_start_s = time.time() - config['spawned_at']
+        peaks = [peak_rss_mb() or 0, first.get('memory', {}).get('process_peak_rss_mb') or 0]
+        
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(config['repeats']):
+            for result, latency in run(images):
+                if not result.get('success'):
+                    errors += 1
+                    continue
+                latencies.append(latency)
+                peaks.append(result.get('memory', {}).get('process_peak_rss_mb') or 0)
+        wall_s = time.perf_counter() - started
+        peaks.append(peak_rss_mb() or 0)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    processed = len(images) * config['repeats']
+    return {
+        'backend': detector.backend,
+        'imgsz': detector.imgsz,
+        'batch': config['batch'],
+        'threads': config['threads'] or torch.get_num_threads(),
+        'pipeline': config['pipeline'],
+        'images': processed,
+        'errors': errors,
+        'import_s': round(import_s, 3),
+        'model_load_s': round(detector.model_load_ms / 1000, 3),
+        'cold_start_s': round(cold_start_s, 3),
+        'latency_p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+        'latency_p95_ms': round(percentile(latencies, 95), 1) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 99), 1) if latencies else None,
+        'latency_mean_ms': round(sum(latencies) / len(latencies), 1) if latencies else None,
+        'images_per_sec': round(processed / wall_s, 3) if wall_s > 0 else None,
+        'peak_rss_mb': max(peaks)
+    }
+
+def spawn_configuration(config, timeout):
+    """Run one configuration in a fresh interpreter and return its result"""
+    config = dict(config, spawned_at=time.time())
+    env = dict(os.environ)
+    env.pop('CALCULUS_CACHE_DIR', None)
+    env.pop('CALCULUS_ARTIFACT_DIR', None)
+    env.pop('CALCULUS_PROFILE', None)
+    try:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', json.dumps(config)],
+            capture_output=True, text=True, timeout=timeout, env=env
+        )
+    except subprocess.TimeoutExpired:
+        return {'success': False, 'error': f'timed out after {timeout}s'}
+    
+    lines = completed.stdout.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        tail = completed.stderr.strip().splitlines()[-1:] or ['no output']
+        return {'success': False, 'error': f'worker exited with {completed.returncode}: {tail[0]}'}
+
+def configuration_key(result):
+    """Identity of a configuration, used to match results against a baseline"""
+    return (result.get('backend'), result.get('imgsz'), result.get('batch'),
+            result.get('threads'), result.get('pipeline'))
+
+def compare(results, baseline, tolerance):
+    """Metrics that got worse than the baseline by more than ``tolerance`` (relative)"""
+    previous = {configuration_key(result): result for result in baseline.get('results', [])
+                if result.get('success')}
+    regressions = []
+    unmatched = []
+    for result in results:
+        if not result.get('success'):
+            continue
+        before = previous.get(configuration_key(result))
+        if before is None:
+            unmatched.append(result)
+            continue
+        for metric, better in COMPARED_METRICS.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (better == 'lower' and change > tolerance) or (better == 'higher' and -change > tolerance):
+                regressions.append({
+                    'configuration': dict(zip(('backend', 'imgsz', 'batch', 'threads', 'pipeline'),
+                                              configuration_key(result))),
+                    'metric': metric,
+                    'baseline': old,
+                    'current': new,
+                    'change': round(change, 3)
+                })
+    return {
+        'tolerance': tolerance,
+        'regressions': regressions,
+        'unmatched': len(unmatched)
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the calculus detector over an image corpus'
+    )
+    parser.add_argument('--corpus', nargs='+', default=['annotate-images'],
+                        help='image files, directories or globs (default: annotate-images)')
+    parser.add_argument('--limit', type=int,
+                        help='use at most this many corpus images')
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='timed passes over the corpus per configuration (default: 1)')
+    parser.add_argument('--config', default='../default.yaml',
+                        help='detector configuration (default: ../default.yaml)')
+    parser.add_argument('--imgsz', type=int, nargs='+', default=[None],
+                        help='YOLO input sizes to sweep (default: from the config)')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1],
+                        help='YOLO batch sizes to sweep; 1 runs process_image per image (default: 1)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[None],
+                        help='torch thread counts to sweep (default: torch default)')
+    parser.add_argument('--backend', nargs='+', default=['torch'],
+                        help='model backends to sweep (default: torch)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run batches through the pipelined runner')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='flag regressions against a previously saved report')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'relative change counted as a regression (default: {DEFAULT_TOLERANCE})')
+    parser.add_argument('--timeout', type=int, default=WORKER_TIMEOUT,
+                        help=f'seconds allowed per configuration (default: {WORKER_TIMEOUT})')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main():
+    """Run the configuration sweep, or a single configuration with --worker"""
+    args = parse_args()
+    if args.worker:
+        # Library chatter must not end up in the result line
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            result = dict(run_configuration(json.loads(args.worker)), success=True)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        print(json.dumps(result), file=stdout)
+        return 0 if result['success'] else 1
+    
+    results = []
+    for backend, imgsz, batch, threads in itertools.product(args.backend, args.imgsz,
+                                                            args.batch, args.threads):
+        config = {
+            'corpus': args.corpus,
+            'limit': args.limit,
+            'repeats': max(1, args.repeats),
+            'config_path': args.config,
+            'backend': backend,
+            'imgsz': imgsz,
+            'batch': batch,
+            'threads': threads,
+            'pipeline': args.pipeline
+        }
+        print(f"Benchmarking backend={backend} imgsz={imgsz or 'config'} batch={batch} "
+              f"threads={threads or 'default'}...", file=sys.stderr)
+        result = spawn_configuration(config, args.timeout)
+        if not result.get('success'):
+            result.update(backend=backend, imgsz=imgsz, batch=batch, threads=threads,
+                          pipeline=args.pipeline)
+        results.append(result)
+    
+    report = {
+        'success': all(result.get('success') for result in results),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count()
+        },
+        'corpus': args.corpus,
+        'results': results
+    }
+    if args.compare:
+        try:
+            with open(args.compare, 'r') as f:
+                report['comparison'] = dict(compare(results, json.load(f), args.tolerance),
+                                            baseline=args.compare)
+        except (OSError, ValueError) as e:
+            report['success'] = False
+            report['error'] = f"Could not read baseline {args.compare}: {str(e)}"
+    
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    
+    regressed = bool(report.get('comparison', {}).get('regressions'))
+    return 0 if report['success'] and not regressed else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
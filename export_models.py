@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Model Export Script
+Converts the YOLO and U-Net models into CPU-friendly formats (TorchScript, ONNX
+and int8-quantized ONNX) for ``CalculusDetector(backend=...)``, and checks
+that an exported backend matches the eager PyTorch results.
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import inspect
+import argparse
+
+import numpy as np
+import torch
+
+from ai_model import (
+    BACKENDS, EXPORT_MANIFEST, IMG_SIZE, UNET_THRESHOLD,
+    CalculusDetector, StageTimer, expand_image_paths, unet_batch
+)
+
+EXPORT_FORMATS = ('torchscript', 'onnx')
+ONNX_OPSET = 17
+MIN_MASK_IOU = 0.9  # Default parity thresholds for --check
+MAX_COVERAGE_DELTA = 2.0  # Percentage points
+
+def read_manifest(export_dir):
+    """Backend -> exported file names recorded in the export directory"""
+    try:
+        with open(os.path.join(export_dir, EXPORT_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(export_dir, manifest):
+    """Atomically replace the export manifest"""
+    path = os.path.join(export_dir, EXPORT_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def export_yolo(detector, fmt, export_dir):
+    """Export the YOLO model with Ultralytics and move the artifact into ``export_dir``"""
+    exported = detector.yolo_model.export(
+        format=fmt, imgsz=detector.imgsz, dynamic=(fmt == 'onnx'), verbose=False
+    )
+    base = os.path.splitext(os.path.basename(detector.yolo_path))[0]
+    target = os.path.join(export_dir, f"{base}.{fmt}")
+    shutil.move(str(exported), target)
+    return os.path.basename(target)
+
+def export_unet(detector, fmt, export_dir):
+    """Export the U-Net for a dynamic batch of IMG_SIZE crops"""
+    example = torch.zeros(1, 3, IMG_SIZE[1], IMG_SIZE[0])
+    model = detector.unet_model.cpu().eval()
+    
+    if fmt == 'torchscript':
+        target = os.path.join(export_dir, 'unet.torchscript')
+        with torch.inference_mode():
+            traced = torch.jit.trace(model, example)
+        traced.save(target)
+    else:
+        target = os.path.join(export_dir, 'unet.onnx')
+        kwargs = {}
+        # Newer torch defaults to the dynamo exporter, which needs onnxscript
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            kwargs['dynamo'] = False
+        torch.onnx.export(
+            model, example, target,
+            input_names=['input'], output_names=['logits'],
+            dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+            opset_version=ONNX_OPSET, **kwargs
+        )
+    return os.path.basename(target)
+
+def quantize_unet(export_dir, onnx_name):
+    """int8 dynamic quantization of the exported ONNX U-Net"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    
+    target = os.path.join(export_dir, 'unet.int8.onnx')
+    quantize_dynamic(os.path.join(export_dir, onnx_name), target, weight_type=QuantType.QInt8)
+    return os.path.basename(target)
+
+def export(config_path, formats, quantize):
+    """Export the models in ``formats`` and record them in the manifest"""
+    detector = CalculusDetector(config_path, backend='torch')
+    os.makedirs(detector.export_dir, exist_ok=True)
+    manifest = read_manifest(detector.export_dir)
+    
+    for fmt in formats:
+        print(f"Exporting {fmt} models to {detector.export_dir}...", file=sys.stderr)
+        manifest[fmt] = {
+            'yolo': export_yolo(detector, fmt, detector.export_dir),
+            'unet': export_unet(detector, fmt, detector.export_dir)
+        }
+        # The YOLO export moves the model to CPU; keep the U-Net there too
+        detector.unet_model.cpu()
+    
+    if quantize:
+        if 'onnx' not in manifest:
+            raise RuntimeError("--quantize needs an ONNX export (--format onnx)")
+        print("Quantizing the ONNX U-Net to int8...", file=sys.stderr)
+        manifest['onnx-int8'] = {
+            'yolo': manifest['onnx']['yolo'],
+            'unet': quantize_unet(detector.export_dir, manifest['onnx']['unet'])
+        }
+    
+    write_manifest(detector.export_dir, manifest)
+    return {'success': True, 'export_dir': detector.export_dir, 'manifest': manifest}
+
+def box_iou(a, b):
+    """IoU of two (x1, y1, x2, y2) boxes"""
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return inter / (area_a + area_b - inter)
+
+def placed_masks(a, b):
+    """Two teeth's crop masks placed on the canvas covering both boxes"""
+    x1 = min(a['bbox'][0], b['bbox'][0])
+    y1 = min(a['bbox'][1], b['bbox'][1])
+    x2 = max(a['bbox'][2], b['bbox'][2])
+    y2 = max(a['bbox'][3], b['bbox'][3])
+    canvases = []
+    for tooth in (a, b):
+        canvas = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        tx1, ty1, tx2, ty2 = tooth['bbox']
+        canvas[ty1 - y1:ty2 - y1, tx1 - x1:tx2 - x1] = tooth['crop_mask'] > 0
+        canvases.append(canvas)
+    return canvases
+
+def mask_iou(a, b):
+    """IoU of two boolean masks; two empty masks agree perfectly"""
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+def coverage(tooth):
+    """Calculus coverage percentage as reported in ``individual_results``"""
+    overlap = np.count_nonzero((tooth['crop_mask'] > 0) & (tooth['pred_mask'] > 0))
+    return 100 * overlap / (tooth['area'] + 1e-6)
+
+def timed_teeth(detector, image):
+    """Run YOLO and the per-tooth stages, returning the teeth and elapsed ms"""
+    start = time.perf_counter()
+    yolo_result = detector.predict([image])[0]
+    teeth, _ = detector.infer_teeth(image, yolo_result, StageTimer())
+    return teeth, (time.perf_counter() - start) * 1000
+
+def compare_image(reference, candidate, image):
+    """Parity and latency of ``candidate`` against ``reference`` on one image"""
+    ref_teeth, ref_ms = timed_teeth(reference, image)
+    cand_teeth, cand_ms = timed_teeth(candidate, image)
+    
+    # Greedily match teeth by box overlap
+    ious, deltas = [], []
+    unmatched = list(cand_teeth)
+    for tooth in ref_teeth:
+        best = max(unmatched, key=lambda other: box_iou(tooth['bbox'], other['bbox']), default=None)
+        if best is None or box_iou(tooth['bbox'], best['bbox']) < 0.5:
+            continue
+        unmatched.remove(best)
+        ious.append(mask_iou(*placed_masks(tooth, best)))
+        deltas.append(abs(coverage(tooth) - coverage(best)))
+    
+    # U-Net agreement on identical crops, independent of YOLO differences
+    unet_ious = []
+    if ref_teeth:
+        batch = unet_batch([tooth['crop'] for tooth in ref_teeth])
+        ref_probs = reference.run_unet(batch) > UNET_THRESHOLD
+        cand_probs = candidate.run_unet(batch) > UNET_THRESHOLD
+        unet_ious = [mask_iou(r, c) for r, c in zip(ref_probs, cand_probs)]
+    
+    return {
+        'teeth': len(ref_teeth),
+        'teeth_diff': len(cand_teeth) - len(ref_teeth),
+        'matched': len(ious),
+        'mask_iou': ious,
+        'coverage_delta': deltas,
+        'unet_iou': unet_ious,
+        'reference_ms': ref_ms,
+        'candidate_ms': cand_ms
+    }
+
+def check(config_path, backend, images, min_iou, max_coverage_delta, repeats):
+    """Compare ``backend`` with eager PyTorch over ``images``"""
+    reference = CalculusDetector(config_path, backend='torch')
+    candidate = CalculusDetector(config_path, backend=backend)
+    
+    per_image = []
+    for image_path in images:
+        image = reference.read_image(image_path, StageTimer())
+        # Warm-up run, then keep the best of ``repeats`` timings
+        runs = [compare_image(reference, candidate, image) for _ in range(repeats + 1)][1:]
+        result = runs[0]
+        result['reference_ms'] = min(run['reference_ms'] for run in runs)
+        result['candidate_ms'] = min(run['candidate_ms'] for run in runs)
+        result['image_path'] = image_path
+        per_image.append(result)
+    
+    ious = [iou for result in per_image for iou in result['mask_iou']]
+    deltas = [delta for result in per_image for delta in result['coverage_delta']]
+    unet_ious = [iou for result in per_image for iou in result['unet_iou']]
+    reference_ms = sum(result['reference_ms'] for result in per_image)
+    candidate_ms = sum(result['candidate_ms'] for result in per_image)
+    
+    summary = {
+        'images': len(per_image),
+        'teeth_diff': sum(abs(result['teeth_diff']) for result in per_image),
+        'mean_mask_iou': float(np.mean(ious)) if ious else None,
+        'min_mask_iou': float(np.min(ious)) if ious else None,
+        'mean_unet_iou': float(np.mean(unet_ious)) if unet_ious else None,
+        'max_coverage_delta': float(np.max(deltas)) if deltas else 0.0,
+        'reference_ms': round(reference_ms, 1),
+        'candidate_ms': round(candidate_ms, 1),
+        'speedup': round(reference_ms / candidate_ms, 2) if candidate_ms else None
+    }
+    passed = (
+        summary['teeth_diff'] == 0
+        and (summary['mean_mask_iou'] is None or summary['mean_mask_iou'] >= min_iou)
+        and (summary['mean_unet_iou'] is None or summary['mean_unet_iou'] >= min_iou)
+        and summary['max_coverage_delta'] <= max_coverage_delta
+    )
+    for result in per_image:
+        result['reference_ms'] = round(result['reference_ms'], 1)
+        result['candidate_ms'] = round(result['candidate_ms'], 1)
+        for key in ('mask_iou', 'coverage_delta', 'unet_iou'):
+            result[key] = [round(value, 4) for value in result[key]]
+    
+    return {
+        'success': True,
+        'passed': passed,
+        'backend': backend,
+        'thresholds': {'min_iou': min_iou, 'max_coverage_delta': max_coverage_delta},
+        'summary': summary,
+        'images': per_image
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export the calculus models for CPU inference and check their parity'
+    )
+    parser.add_argument('--config', default='../default.yaml',
+                        help='detector configuration (default: ../default.yaml)')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, action='append',
+                        help='export format, may be repeated (default: both)')
+    parser.add_argument('--quantize', action='store_true',
+                        help='also write an int8 dynamically quantized ONNX U-Net')
+    parser.add_argument('--check', choices=BACKENDS[1:], metavar='BACKEND',
+                        help='compare an exported backend with eager PyTorch instead of exporting')
+    parser.add_argument('--images', nargs='+', default=['test-images'],
+                        help='images, directories or globs for --check (default: test-images)')
+    parser.add_argument('--min-iou', type=float, default=MIN_MASK_IOU,
+                        help=f'minimum mean mask IoU for --check (default: {MIN_MASK_IOU})')
+    parser.add_argument('--max-coverage-delta', type=float, default=MAX_COVERAGE_DELTA,
+                        help=f'maximum per-tooth coverage difference in points (default: {MAX_COVERAGE_DELTA})')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='timed runs per image for --check (default: 3)')
+    parser.add_argument('--report', help='also write the JSON result to this file')
+    return parser.parse_args(argv)
+
+def main():
+    """Export the models or check an exported backend"""
+    args = parse_args()
+    try:
+        if args.check:
+            images = list(expand_image_paths(args.images))
+            if not images:
+                raise RuntimeError(f"No images found in {' '.join(args.images)}")
+            result = check(args.config, args.check, images, args.min_iou,
+                           args.max_coverage_delta, max(1, args.repeats))
+        else:
+            result = export(args.config, args.format or EXPORT_FORMATS, args.quantize)
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    
+    output = json.dumps(result, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(output)
+    print(output)
+    return 0 if result['success'] and result.get('passed', True) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
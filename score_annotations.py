@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Annotation Scoring Script
+Scores CalculusDetector against the expert annotations in data/annotations.json
+and annotations.db. Every annotated image runs through the detector in masks
+mode, and each detected tooth gets its predicted and annotated calculus
+coverage, the coverage error and the IoU of the two calculus masks.
+
+Annotations are streamed, a bounded number of batches is in flight, and one
+JSON line per annotation is appended to the output as soon as its batch is
+done. A checkpoint next to the output records what has been scored, so an
+interrupted run picks up where it stopped and a rerun only scores annotations
+added since. Batches run on forked worker processes that share the loaded
+models, spreading the work over all cores.
+
+Usage:
+    python score_annotations.py                           Score all annotations
+    python score_annotations.py --output scores.jsonl --processes 4 --batch 8
+    python score_annotations.py --conf 0.4 --unet-threshold 0.6 --output tuned.jsonl
+    python score_annotations.py --summary scores.jsonl    Summarise an existing run
+"""
+
+import sys
+import os
+import json
+import math
+import time
+import sqlite3
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+ANNOTATION_SOURCES = ['data/annotations.json', 'annotations.db']
+IMAGE_DIRS = ('uploads/{source}-images', '{source}-images')  # Searched for an annotation's original image
+MASK_DIR = os.path.join('uploads', 'annotations')
+DEFAULT_OUTPUT = 'annotation-scores.jsonl'
+CHECKPOINT_VERSION = 1
+JSON_CHUNK = 1 << 20  # Characters read at a time when streaming a JSON array
+MASK_THRESHOLD = 128  # Alpha at which a painted canvas pixel counts as calculus
+
+# The detector of a worker process, inherited from the parent when it forks
+_detector = None
+
+def iter_json_array(path, chunk_size=JSON_CHUNK):
+    """Yield the elements of a top-level JSON array without reading the whole file"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer, eof = '', False
+        
+        def fill():
+            nonlocal buffer, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+        
+        def next_char():
+            """The next non-whitespace character, reading on as needed; '' at the end of the file"""
+            nonlocal buffer
+            while True:
+                buffer = buffer.lstrip()
+                if buffer or eof:
+                    return buffer[:1]
+                fill()
+        
+        if next_char() != '[':
+            raise ValueError(f"{path} does not hold a JSON array")
+        buffer = buffer[1:]
+        if next_char() == ']':
+            return
+        while True:
+            next_char()
+            try:
+                element, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The element runs past the buffer: read on, unless there is nothing left
+                if eof:
+                    raise
+                fill()
+                continue
+            # A value is only complete once a delimiter follows it: a number or
+            # literal cut by the chunk ('-45' of '-4500.0') may go on in the next one
+            if buffer[end:].lstrip()[:1] not in (',', ']') and not eof:
+                fill()
+                continue
+            buffer = buffer[end:]
+            yield element
+            delimiter = next_char()
+            if delimiter == ']':
+                return
+            if delimiter != ',':
+                raise ValueError(f"{path} is not a valid JSON array")
+            buffer = buffer[1:]
+
+def read_annotations(sources):
+    """Yield every annotation record of the JSON files and SQLite databases in ``sources``"""
+    for path in sources:
+        if not os.path.exists(path):
+            continue
+        if path.endswith('.json'):
+            records = iter_json_array(path)
+        else:
+            connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            connection.row_factory = sqlite3.Row
+            records = (dict(row) for row in connection.execute(
+                'SELECT id, image_id, user_id, source, original_image, annotation_data, mask_filename '
+                'FROM annotations ORDER BY image_id, id'
+            ))
+        for record in records:
+            record['key'] = f"{os.path.basename(path)}:{record['id']}"
+            yield record
+
+def find_image(record, image_dirs):
+    """Path of the original image an annotation was painted on, or ``None``"""
+    name = record.get('original_image')
+    if not name:
+        return None
+    source = record.get('source') or str(record.get('image_id', '')).split('-')[0]
+    for directory in image_dirs:
+        path = os.path.join(directory.format(source=source), name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def annotation_tasks(sources, image_dirs, done):
+    """Yield the scoring task of every annotation not in ``done``"""
+    for record in read_annotations(sources):
+        if record['key'] in done:
+            continue
+        data = record.get('annotation_data')
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                data = None
+        mask_filename = record.get('mask_filename')
+        yield {
+            'key': record['key'],
+            'image_id': record.get('image_id'),
+            'user_id': record.get('user_id'),
+            'image_path': find_image(record, image_dirs),
+            'mask_data': (data or {}).get('maskData'),
+            'mask_path': os.path.join(MASK_DIR, mask_filename) if mask_filename else None
+        }
+
+def batched(items, size):
+    """Group an iterable into lists of up to ``size`` items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_annotation_mask(task, width, height):
+    """The annotated calculus of a task as a boolean mask of the image size.
+    
+    The annotation canvas shows the whole image scaled to fit, so the painted
+    mask is stretched back over the full image.
+    """
+    from ai_model import cv2, np, decode_base64_image
+    if task['mask_data']:
+        content = decode_base64_image(task['mask_data'])
+    elif task['mask_path'] and os.path.isfile(task['mask_path']):
+        with open(task['mask_path'], 'rb') as f:
+            content = f.read()
+    else:
+        raise ValueError('Annotation has no mask data')
+    
+    mask = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if mask is None:
+        raise ValueError('Could not decode the annotation mask')
+    # Painted pixels are opaque on a transparent canvas
+    if mask.ndim == 3:
+        mask = mask[:, :, 3] if mask.shape[2] == 4 else mask.max(axis=2)
+    mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+    return mask >= MASK_THRESHOLD
+
+def decode_rle(counts, width, height):
+    """Boolean ``height`` x ``width`` mask from ``mask_rle`` run lengths"""
+    from ai_model import np
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape(height, width)
+
+def ratio(numerator, denominator):
+    return numerator / denominator if denominator else None
+
+def score_result(task, result):
+    """Compare a masks-mode detection result with its annotation"""
+    from ai_model import np
+    width, height = result['settings']['image_size']
+    annotated = load_annotation_mask(task, width, height)
+    predicted = np.zeros_like(annotated)
+    teeth_area = np.zeros_like(annotated)
+    masks = {entry['tooth_id']: entry for entry in result.get('masks', [])}
+    
+    teeth = []
+    for tooth in result['individual_results']:
+        entry = masks[tooth['tooth_id']]
+        x1, y1, x2, y2 = entry['bbox']
+        tooth_mask = decode_rle(entry['tooth'], x2 - x1, y2 - y1)
+        calculus = decode_rle(entry['calculus'], x2 - x1, y2 - y1) & tooth_mask
+        painted = annotated[y1:y2, x1:x2] & tooth_mask
+        predicted[y1:y2, x1:x2] |= calculus
+        teeth_area[y1:y2, x1:x2] |= tooth_mask
+        
+        # Same denominator as the detector's coverage figure
+        annotated_coverage = 100 * int(painted.sum()) / (tooth['tooth_area'] + 1e-6)
+        union = int((calculus | painted).sum())
+        iou = ratio(int((calculus & painted).sum()), union)
+        teeth.append({
+            'tooth_id': tooth['tooth_id'],
+            'bounding_box': tooth['bounding_box'],
+            'predicted_coverage': tooth['calculus_percentage'],
+            'annotated_coverage': round(annotated_coverage, 2),
+            'coverage_error': round(tooth['calculus_percentage'] - annotated_coverage, 2),
+            'iou': round(iou, 4) if iou is not None else None
+        })
+    
+    annotated_coverage = sum(tooth['annotated_coverage'] for tooth in teeth) / len(teeth) if teeth else 0
+    annotated_pixels = int(annotated.sum())
+    intersection = int((predicted & annotated).sum())
+    union = int((predicted | annotated).sum())
+    iou = ratio(intersection, union)
+    outside = ratio(int((annotated & ~teeth_area).sum()), annotated_pixels)
+    return {
+        'teeth_detected': result['teeth_detected'],
+        'predicted_coverage': result['average_calculus_coverage'],
+        'annotated_coverage': round(annotated_coverage, 2),
+        'coverage_error': round(result['average_calculus_coverage'] - annotated_coverage, 2),
+        'iou': round(iou, 4) if iou is not None else None,
+        'intersection': intersection,
+        'union': union,
+        # Annotated calculus on no detected tooth, i.e. missed by YOLO
+        'annotated_outside_teeth': round(outside, 4) if outside is not None else None,
+        'teeth': teeth
+    }
+
+def score_batch(tasks):
+    """Score a batch of annotations on this process's detector, one result line each"""
+    lines = {task['key']: {'key': task['key'], 'image_id': task['image_id'], 'user_id': task['user_id'],
+                           'image_path': task['image_path']} for task in tasks}
+    # Several annotators may have marked the same image; detect it once
+    by_image = {}
+    for task in tasks:
+        if task['image_path'] is None:
+            lines[task['key']].update(success=False, error='Original image not found')
+        else:
+            by_image.setdefault(task['image_path'], []).append(task)
+    
+    started = time.perf_counter()
+    for result in _detector.process_images(list(by_image)):
+        for task in by_image.get(result.get('original_image_path'), []):
+            line = lines[task['key']]
+            if not result.get('success'):
+                line.update(success=False, error=result.get('error'))
+                continue
+            try:
+                line.update(success=True, **score_result(task, result))
+            except Exception as e:
+                line.update(success=False, error=str(e))
+    
+    for line in lines.values():
+        line.setdefault('success', False)
+        line.setdefault('error', 'No detection result')
+    return list(lines.values()), time.perf_counter() - started
+
+def init_worker(threads):
+    """Match a forked worker's torch and OpenCV threads to its share of the cores"""
+    from ai_model import torch, cv2
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+def checkpoint_path(output):
+    return f"{output}.checkpoint"
+
+def load_checkpoint(output, settings):
+    """Scored annotation keys and output length of an earlier run with the same settings"""
+    try:
+        with open(checkpoint_path(output), 'r') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return set(), 0
+    if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint.get('settings') != settings:
+        raise ValueError(f"{checkpoint_path(output)} was written with other settings; "
+                         "pass --restart to score from scratch")
+    # An output deleted or cut short since the checkpoint no longer holds the lines
+    # it counts, and truncating up to the offset would pad it with NUL bytes
+    try:
+        size = os.path.getsize(output)
+    except OSError:
+        size = -1
+    if size < checkpoint['offset']:
+        print(f"{output} is shorter than its checkpoint; scoring from scratch", file=sys.stderr)
+        return set(), 0
+    return set(checkpoint['done']), checkpoint['offset']
+
+def save_checkpoint(output, settings, done, offset):
+    """Atomically record the scored keys and the output length they cover"""
+    path = checkpoint_path(output)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump({'version': CHECKPOINT_VERSION, 'settings': settings, 'offset': offset,
+                   'done': sorted(done)}, f)
+    os.replace(f"{path}.tmp", path)
+
+def summarise(output):
+    """Aggregate metrics over every line of a scores file, read one line at a time"""
+    totals = {'annotations': 0, 'failed': 0, 'teeth': 0, 'intersection': 0, 'union': 0}
+    tooth_errors, tooth_ious, image_errors, image_ious = [], [], [], []
+    with open(output, 'r') as f:
+        for line in f:
+            score = json.loads(line)
+            totals['annotations'] += 1
+            if not score.get('success'):
+                totals['failed'] += 1
+                continue
+            totals['intersection'] += score['intersection']
+            totals['union'] += score['union']
+            image_errors.append(score['coverage_error'])
+            if score['iou'] is not None:
+                image_ious.append(score['iou'])
+            for tooth in score['teeth']:
+                totals['teeth'] += 1
+                tooth_errors.append(tooth['coverage_error'])
+                if tooth['iou'] is not None:
+                    tooth_ious.append(tooth['iou'])
+    
+    def mean(values):
+        return round(sum(values) / len(values), 4) if values else None
+    
+    return {
+        'annotations': totals['annotations'],
+        'failed': totals['failed'],
+        'teeth': totals['teeth'],
+        'tooth_coverage_mae': mean([abs(error) for error in tooth_errors]),
+        'tooth_coverage_bias': mean(tooth_errors),
+        'tooth_coverage_rmse': (round(math.sqrt(sum(e * e for e in tooth_errors) / len(tooth_errors)), 4)
+                                if tooth_errors else None),
+        'tooth_iou_mean': mean(tooth_ious),
+        'image_coverage_mae': mean([abs(error) for error in image_errors]),
+        'image_iou_mean': mean(image_ious),
+        # All calculus pixels of the dataset pooled together
+        'pixel_iou': round(totals['intersection'] / totals['union'], 4) if totals['union'] else None
+    }
+
+def score(args):
+    """Score every annotation not yet in the checkpoint, appending to ``args.output``"""
+    global _detector
+    from ai_model import (CalculusDetector, ArtifactStore, POOL_THREADS, default_pool_workers,
+                          get_device, assert_fork_safe)
+    
+    overrides = {
+        'IMGSZ': args.imgsz,
+        'CONF': args.conf,
+        'PADDING': args.padding,
+        'UNET_THRESHOLD': args.unet_threshold,
+        'OUTPUT': 'masks',
+        'MASK_ENCODING': 'rle'
+    }
+    _detector = CalculusDetector(args.config, overrides=overrides,
+                                 artifacts=ArtifactStore(args.artifact_dir) if args.artifact_dir else None)
+    if args.batch:
+        _detector.yolo_batch_size = args.batch
+    # The U-Net threshold only shows in the masks, so the checkpoint records it too
+    settings = dict(_detector.settings(), unet_threshold=_detector.unet_threshold, sources=args.annotations)
+    
+    if args.restart:
+        done, offset = set(), 0
+    else:
+        done, offset = load_checkpoint(args.output, settings)
+    
+    threads = args.threads or POOL_THREADS
+    processes = args.processes
+    if processes is None:
+        processes = default_pool_workers(threads) if get_device().type == 'cpu' else 1
+    
+    tasks = annotation_tasks(args.annotations, args.image_dirs + list(IMAGE_DIRS), done)
+    batches = batched(tasks, _detector.yolo_batch_size)
+    scored = 0
+    started = time.perf_counter()
+    
+    # Drop lines written after the last checkpoint; their annotations are scored again
+    with open(args.output, 'a+') as output:
+        output.truncate(offset)
+        output.seek(offset)
+        
+        def record(lines):
+            nonlocal scored
+            for line in lines:
+                output.write(json.dumps(line) + '\n')
+            output.flush()
+            done.update(line['key'] for line in lines)
+            save_checkpoint(args.output, settings, done, output.tell())
+            scored += len(lines)
+            print(f"Scored {scored} annotations ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+        
+        if processes <= 1:
+            for batch in batches:
+                record(score_batch(batch)[0])
+        else:
+            # Forked after the models are loaded, so the workers share the weights, and
+            # before anything is inferred here: a fork after torch's OpenMP pool has
+            # started deadlocks the child in libgomp
+            assert_fork_safe()
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                     initializer=init_worker, initargs=(threads,)) as pool:
+                pending = set()
+                exhausted = False
+                while True:
+                    # Keep two batches per worker queued, never the whole dataset
+                    while not exhausted and len(pending) < processes * 2:
+                        batch = next(batches, None)
+                        if batch is None:
+                            exhausted = True
+                        else:
+                            pending.add(pool.submit(score_batch, batch))
+                    if not pending:
+                        break
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record(future.result()[0])
+    
+    return {
+        'success': True,
+        'output': args.output,
+        'scored': scored,
+        'processes': processes,
+        'settings': settings,
+        'summary': summarise(args.output)
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Score the calculus detector against the expert annotations'
+    )
+    parser.add_argument('--annotations', nargs='+', default=ANNOTATION_SOURCES,
+                        help='annotation JSON files and SQLite databases '
+                             f"(default: {' '.join(ANNOTATION_SOURCES)})")
+    parser.add_argument('--image-dirs', nargs='+', default=[],
+                        help='extra directories searched for the annotated images, '
+                             'where {source} stands for test or annotate')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                        help=f'JSON lines file with one score per annotation (default: {DEFAULT_OUTPUT})')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint and score everything again')
+    parser.add_argument('--summary', metavar='SCORES',
+                        help='only print the summary of an existing scores file')
+    parser.add_argument('--config', default='../default.yaml',
+                        help='detector configuration (default: ../default.yaml)')
+    parser.add_argument('--batch', type=int,
+                        help='images per detector batch (default: the configured YOLO batch size)')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per --threads cores, as memory allows)')
+    parser.add_argument('--threads', type=int,
+                        help='torch threads per worker process (default: 2)')
+    parser.add_argument('--artifact-dir',
+                        help='save network outputs here, so rescoring with other thresholds skips the models')
+    parser.add_argument('--imgsz', type=int, help='YOLO input size')
+    parser.add_argument('--conf', type=float, help='YOLO confidence threshold')
+    parser.add_argument('--padding', type=int, help='pixels of context around each tooth crop')
+    parser.add_argument('--unet-threshold', type=float, help='U-Net probability threshold for calculus')
+    return parser.parse_args(argv)
+
+def main():
+    """Score the annotations, or summarise an earlier run with --summary"""
+    args = parse_args()
+    try:
+        if args.summary:
+            report = {'success': True, 'output': args.summary, 'summary': summarise(args.summary)}
+        else:
+            report = score(args)
+    except Exception as e:
+        report = {'success': False, 'error': str(e)}
+    print(json.dumps(report, indent=2))
+    return 0 if report['success'] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,7 @@ const helmet = require('helmet');
 const morgan = require('morgan');
 const path = require('path');
 const fs = require('fs');
+const os = require('os');
 const session = require('express-session');
 const { spawn } = require('child_process');
 const AnnotationDatabase = require('./database/annotation-db');
@@ -103,8 +104,7 @@ const storage = multer.diskStorage({
     }
 });
 
-const upload = multer({ 
-    storage: storage,
+const uploadOptions = {
     limits: { fileSize: 10 * 1024 * 1024 }, // 10MB limit
     fileFilter: (req, file, cb) => {
         if (file.mimetype.startsWith('image/')) {
@@ -113,8 +113,31 @@ const upload = multer({
             cb(new Error('Only image files are allowed!'), false);
         }
     }
+};
+
+const upload = multer({ 
+    storage: storage,
+    ...uploadOptions
 });
 
+// With AI_TRANSPORT=shm, /detect keeps the upload in memory and hands it to the
+// AI worker through a shared-memory file instead of a round-trip through uploads/
+const AI_TRANSPORT = process.env.AI_TRANSPORT === 'shm' ? 'shm' : 'file';
+const AI_SHM_DIR = process.env.CALCULUS_SHM_DIR || (fs.existsSync('/dev/shm') ? '/dev/shm' : os.tmpdir());
+const detectUpload = AI_TRANSPORT === 'shm'
+    ? multer({ storage: multer.memoryStorage(), ...uploadOptions })
+    : upload;
+
+// AI model calls fail after AI_TIMEOUT_MS instead of hanging. Detections get the
+// persistent worker a slightly shorter deadline, which it meets by degrading
+// its settings (smaller input, no U-Net) when it has to
+const AI_TIMEOUT_MS = parseInt(process.env.AI_TIMEOUT_MS, 10) || 30000;
+const AI_DEADLINE_MARGIN_MS = 1000;
+
+// The detect page shows processed_image_url, so its routes only take the output
+// modes that produce one; masks and none are served by /detect/jobs
+const PAGE_OUTPUT_MODES = ['overlay', 'preview'];
+
 // Sample images data (in production, this would be in a database)
 let testImages = [];
 let annotateImages = [];
@@ -200,58 +223,472 @@ app.get('/detect', (req, res) => {
     res.sendFile(path.join(__dirname, 'views', 'detect.html'));
 });
 
-app.post('/detect', upload.single('image'), async (req, res) => {
+app.post('/detect', detectUpload.single('image'), async (req, res) => {
     if (!req.file) {
         return res.status(400).json({ error: 'No image uploaded' });
     }
+    const outputError = pageOutputError(req);
+    if (outputError) {
+        return res.status(400).json({ error: outputError });
+    }
     
     try {
-        // Run the Python AI model
-        const imagePath = req.file.path;
-        const result = await runAIModel(imagePath);
+        let result;
+        let filename = req.file.filename;
+        if (req.file.buffer) {
+            // Shared-memory transport: the original is saved for display while the model runs
+            filename = Date.now() + '-' + req.file.originalname;
+            const imagePath = path.join('uploads', 'images', filename);
+            const saved = fs.promises.writeFile(imagePath, req.file.buffer).then(() => imagePath);
+            [result] = await Promise.all([
+                runAIModelBuffer(req.file.buffer, saved, detectionOptions(req)),
+                saved
+            ]);
+        } else {
+            // Run the Python AI model
+            const imagePath = req.file.path;
+            result = await runAIModel(imagePath, detectionOptions(req));
+        }
         
         if (result.success) {
             // Return the detection results
-            const processedImagePath = result.processed_image_path;
-            // Convert the processed image path to a URL
-            const processedImageUrl = processedImagePath.replace(/\\/g, '/');
-            
-            res.json({
-                success: true,
-                message: 'Calculus detection completed successfully',
-                filename: req.file.filename,
-                results: {
-                    teeth_detected: result.teeth_detected,
-                    average_calculus_coverage: result.average_calculus_coverage,
-                    individual_results: result.individual_results,
-                    processed_image_url: `/${processedImageUrl}`,
-                    original_image_url: `/uploads/images/${req.file.filename}`
-                }
-            });
+            res.json(formatDetection(result, filename));
+        } else if (result.busy) {
+            sendBusy(res, result);
         } else {
-            res.status(500).json({ 
+            res.status(result.deadline_exceeded ? 504 : 500).json({ 
                 error: 'AI model processing failed', 
                 details: result.error 
             });
         }
     } catch (error) {
         console.error('Error in detection:', error);
-        res.status(500).json({ 
+        res.status(error.timeout ? 504 : 500).json({ 
             error: 'Internal server error during detection',
             details: error.message 
         });
     }
 });
 
+// Requested output mode: overlay, preview, masks (shapes for API clients to draw) or none
+function detectionOutput(req) {
+    return (req.body && req.body.output) || req.query.output || undefined;
+}
+
+// Why a page-facing route can't serve the requested output mode, if it can't
+function pageOutputError(req) {
+    const output = detectionOutput(req);
+    if (output !== undefined && !PAGE_OUTPUT_MODES.includes(output)) {
+        return `Output ${output} has no image to show; use /detect/jobs for masks and none`;
+    }
+    return null;
+}
+
+// Output mode and latency budget of a detect request. A requested deadline_ms
+// can only shorten the default one, which leaves time to answer before AI_TIMEOUT_MS
+function detectionOptions(req) {
+    const limit = AI_TIMEOUT_MS - AI_DEADLINE_MARGIN_MS;
+    const requested = Number((req.body && req.body.deadline_ms) || req.query.deadline_ms);
+    return {
+        output: detectionOutput(req),
+        deadlineMs: requested > 0 ? Math.min(requested, limit) : limit
+    };
+}
+
+// The AI worker's job queue is full: 429 with its estimate of when to retry
+function sendBusy(res, result) {
+    res.set('Retry-After', String(Math.ceil(result.retry_after)));
+    return res.status(429).json({ error: result.error, retry_after: result.retry_after });
+}
+
+// Thresholds an already processed image can be re-analysed with from its saved
+// network outputs, without running the models again
+const REANALYSIS_SETTINGS = ['conf', 'padding', 'unet_threshold'];
+
+app.post('/detect/reanalyse', async (req, res) => {
+    const filename = path.basename(String((req.body && req.body.filename) || ''));
+    const imagePath = path.join('uploads', 'images', filename);
+    if (!filename || !fs.existsSync(imagePath)) {
+        return res.status(404).json({ error: 'Image not found' });
+    }
+    const outputError = pageOutputError(req);
+    if (outputError) {
+        return res.status(400).json({ error: outputError });
+    }
+    
+    const settings = {};
+    for (const key of REANALYSIS_SETTINGS) {
+        if (req.body[key] !== undefined && req.body[key] !== '') {
+            const value = Number(req.body[key]);
+            if (!Number.isFinite(value)) {
+                return res.status(400).json({ error: `Invalid ${key}` });
+            }
+            settings[key] = value;
+        }
+    }
+    
+    try {
+        const result = await runAIModel(imagePath, { ...detectionOptions(req), settings });
+        if (result.success) {
+            const formatted = formatDetection(result, filename);
+            formatted.results.reanalysed = Boolean(result.reanalysed);
+            formatted.results.settings = result.settings;
+            return res.json(formatted);
+        }
+        if (result.busy) {
+            return sendBusy(res, result);
+        }
+        res.status(result.deadline_exceeded ? 504 : 500).json({ error: 'AI model processing failed', details: result.error });
+    } catch (error) {
+        console.error('Error in re-analysis:', error);
+        res.status(error.timeout ? 504 : 500).json({ error: 'Internal server error during detection', details: error.message });
+    }
+});
+
+// Shape a successful AI model result for the detect page
+function formatDetection(result, filename) {
+    // Convert the processed image path to a URL; masks and none output have no image
+    let processedImageUrl = result.processed_image_path
+        ? `/${result.processed_image_path.replace(/\\/g, '/')}`
+        : null;
+    if (result.processed_image_buffer) {
+        // Shared-memory transport: the overlay never touched the disk, send it inline
+        const mimeType = result.processed_image_format === 'webp' ? 'image/webp' : 'image/jpeg';
+        processedImageUrl = `data:${mimeType};base64,${result.processed_image_buffer.toString('base64')}`;
+    }
+    
+    const formatted = {
+        success: true,
+        message: 'Calculus detection completed successfully',
+        filename: filename,
+        results: {
+            teeth_detected: result.teeth_detected,
+            average_calculus_coverage: result.average_calculus_coverage,
+            individual_results: result.individual_results,
+            processed_image_url: processedImageUrl,
+            original_image_url: `/uploads/images/${filename}`
+        }
+    };
+    if (result.masks) {
+        formatted.results.masks = result.masks;
+        formatted.results.image_size = result.settings && result.settings.image_size;
+    }
+    if (result.degradation) {
+        // Which cheaper configuration was used to meet the deadline; level 0 is full quality
+        formatted.results.degradation = result.degradation;
+    }
+    return formatted;
+}
+
+// Queued detection: the upload returns at once with a job id to poll, so slow
+// images don't hold connections and the Python job pool bounds the load
+app.post('/detect/jobs', upload.single('image'), async (req, res) => {
+    if (!req.file) {
+        return res.status(400).json({ error: 'No image uploaded' });
+    }
+    
+    try {
+        const job = await aiWorker.request({
+            cmd: 'submit',
+            image_path: req.file.path,
+            output: detectionOutput(req)
+        });
+        if (job.busy) {
+            return sendBusy(res, job);
+        }
+        if (!job.success) {
+            return res.status(500).json({ error: 'AI model processing failed', details: job.error });
+        }
+        
+        res.status(202).json({
+            success: true,
+            job_id: job.job_id,
+            status: job.status,
+            status_url: `/detect/jobs/${job.job_id}`,
+            result_url: `/detect/jobs/${job.job_id}/result`
+        });
+    } catch (error) {
+        console.error('Error submitting detection job:', error);
+        res.status(503).json({ error: 'AI worker unavailable', details: error.message });
+    }
+});
+
+// Job status and progress (teeth processed / total)
+app.get('/detect/jobs/:jobId', async (req, res) => {
+    try {
+        const job = await aiWorker.request({ cmd: 'poll', job_id: req.params.jobId });
+        res.status(job.success ? 200 : 404).json(job);
+    } catch (error) {
+        res.status(503).json({ error: 'AI worker unavailable', details: error.message });
+    }
+});
+
+// Results of a finished job; a job's results can be fetched once
+app.get('/detect/jobs/:jobId/result', async (req, res) => {
+    try {
+        const job = await aiWorker.request({ cmd: 'fetch', job_id: req.params.jobId });
+        if (job.status === 'done') {
+            return res.json(formatDetection(job, path.basename(job.original_image_path)));
+        }
+        if (job.status === 'queued' || job.status === 'running') {
+            return res.status(202).json(job);
+        }
+        if (job.status === undefined) {
+            return res.status(404).json({ error: job.error });
+        }
+        res.status(job.status === 'cancelled' ? 410 : 500).json({
+            error: 'AI model processing failed',
+            details: job.error
+        });
+    } catch (error) {
+        res.status(503).json({ error: 'AI worker unavailable', details: error.message });
+    }
+});
+
+// Cancel a queued or running job
+app.delete('/detect/jobs/:jobId', async (req, res) => {
+    try {
+        const job = await aiWorker.request({ cmd: 'cancel', job_id: req.params.jobId });
+        res.status(job.success ? 200 : 404).json(job);
+    } catch (error) {
+        res.status(503).json({ error: 'AI worker unavailable', details: error.message });
+    }
+});
+
+// Detection results are cached by image content so re-uploads skip the models,
+// and network outputs are kept so re-analysis with other thresholds does too
+const AI_ENV = {
+    ...process.env,
+    CALCULUS_CACHE_DIR: process.env.CALCULUS_CACHE_DIR || path.join(__dirname, '.cache', 'detect'),
+    CALCULUS_SHM_DIR: AI_SHM_DIR,
+    CALCULUS_ARTIFACT_DIR: process.env.CALCULUS_ARTIFACT_DIR || path.join(__dirname, '.cache', 'artifacts')
+};
+
+// Persistent AI worker: keeps the YOLO + U-Net models loaded between requests
+// instead of paying the model start-up cost on every upload.
+// Set AI_WORKER_MODE=spawn to fall back to one Python process per request.
+class AIWorker {
+    constructor() {
+        this.process = null;
+        this.ready = null;
+        this.pending = new Map();
+        this.nextId = 1;
+        this.buffer = '';
+    }
+
+    start() {
+        if (this.ready) {
+            return this.ready;
+        }
+
+        this.ready = new Promise((resolve, reject) => {
+            const workerProcess = spawn('python', ['ai_model.py', '--serve'], {
+                cwd: __dirname,
+                env: AI_ENV
+            });
+            let started = false;
+            this.process = workerProcess;
+
+            workerProcess.stdout.on('data', (data) => {
+                this.buffer += data.toString();
+                let newlineIndex;
+                while ((newlineIndex = this.buffer.indexOf('\n')) >= 0) {
+                    const line = this.buffer.slice(0, newlineIndex).trim();
+                    this.buffer = this.buffer.slice(newlineIndex + 1);
+                    if (line) {
+                        this.handleMessage(line, (message) => {
+                            started = true;
+                            console.log(`AI worker ready (pid ${message.pid}, models loaded in ${message.load_time}s)`);
+                            resolve(message);
+                        }, reject);
+                    }
+                }
+            });
+
+            workerProcess.stderr.on('data', (data) => {
+                console.error(`AI worker: ${data.toString().trim()}`);
+            });
+
+            workerProcess.on('exit', (code) => {
+                const error = new Error(`AI worker exited with code ${code}`);
+                if (!started) {
+                    reject(error);
+                }
+                this.pending.forEach(({ reject: rejectRequest }) => rejectRequest(error));
+                this.reset();
+            });
+
+            workerProcess.on('error', (error) => {
+                reject(new Error(`Failed to start AI worker: ${error.message}`));
+                this.reset();
+            });
+        });
+
+        return this.ready;
+    }
+
+    handleMessage(line, onReady, onStartError) {
+        let message;
+        try {
+            message = JSON.parse(line);
+        } catch (parseError) {
+            console.error(`AI worker sent invalid output: ${line}`);
+            return;
+        }
+
+        if (message.event === 'ready') {
+            onReady(message);
+            return;
+        }
+        if (message.event === 'error') {
+            onStartError(new Error(message.error));
+            return;
+        }
+
+        const request = this.pending.get(message.id);
+        if (request) {
+            this.pending.delete(message.id);
+            request.resolve(message);
+        }
+    }
+
+    reset() {
+        this.pending.clear();
+        this.process = null;
+        this.ready = null;
+        this.buffer = '';
+    }
+
+    // Requests fail after timeoutMs; a late answer is dropped
+    async request(payload, timeoutMs = AI_TIMEOUT_MS) {
+        await this.start();
+        const id = this.nextId++;
+        return new Promise((resolve, reject) => {
+            const timer = setTimeout(() => {
+                this.pending.delete(id);
+                reject(timeoutError(`AI worker did not answer within ${timeoutMs} ms`));
+            }, timeoutMs);
+            this.pending.set(id, {
+                resolve: (message) => { clearTimeout(timer); resolve(message); },
+                reject: (error) => { clearTimeout(timer); reject(error); }
+            });
+            this.process.stdin.write(JSON.stringify({ id, ...payload }) + '\n');
+        });
+    }
+
+    // Detect an in-memory image: the bytes go in and the overlay and masks come
+    // back as files in the shared-memory directory, read here and unlinked
+    async detectBuffer(buffer, options = {}) {
+        const inputPath = path.join(AI_SHM_DIR, `calculus-upload-${process.pid}-${this.nextId}-${Date.now()}`);
+        await fs.promises.writeFile(inputPath, buffer);
+        let result;
+        try {
+            result = await this.request({
+                cmd: 'detect',
+                image_shm: { path: inputPath, size: buffer.length },
+                transport: 'shm',
+                output: options.output,
+                deadline_ms: options.deadlineMs
+            });
+        } finally {
+            fs.promises.unlink(inputPath).catch(() => {});
+        }
+        
+        if (result.processed_image_shm) {
+            result.processed_image_buffer = await readSharedBuffer(result.processed_image_shm);
+            result.processed_image_format = result.processed_image_shm.format;
+        }
+        if (result.masks_shm) {
+            result.masks = JSON.parse((await readSharedBuffer(result.masks_shm)).toString());
+        }
+        return result;
+    }
+
+    health() {
+        return this.request({ cmd: 'health' });
+    }
+
+    stop() {
+        if (this.process) {
+            this.process.stdin.end();
+        }
+    }
+}
+
+const aiWorker = new AIWorker();
+
 // Function to run the Python AI model
-function runAIModel(imagePath) {
+async function runAIModel(imagePath, options = {}) {
+    if (process.env.AI_WORKER_MODE !== 'spawn') {
+        try {
+            await aiWorker.start();
+        } catch (error) {
+            console.error('AI worker unavailable, falling back to one-shot process:', error.message);
+            return runAIModelOnce(imagePath, options);
+        }
+        return aiWorker.request({
+            cmd: 'detect',
+            image_path: imagePath,
+            output: options.output,
+            settings: options.settings,
+            deadline_ms: options.deadlineMs
+        });
+    }
+    return runAIModelOnce(imagePath, options);
+}
+
+// Run the Python AI model on an upload held in memory. saved resolves to the
+// upload's file once written, used when the persistent worker is unavailable
+async function runAIModelBuffer(buffer, saved, options = {}) {
+    if (process.env.AI_WORKER_MODE !== 'spawn') {
+        try {
+            await aiWorker.start();
+            return await aiWorker.detectBuffer(buffer, options);
+        } catch (error) {
+            console.error('Shared-memory detection failed, falling back to the upload file:', error.message);
+        }
+    }
+    return runAIModel(await saved, options);
+}
+
+// Read and remove a buffer file handed back by the AI worker
+async function readSharedBuffer(ref) {
+    try {
+        return await fs.promises.readFile(ref.path);
+    } finally {
+        fs.promises.unlink(ref.path).catch(() => {});
+    }
+}
+
+function timeoutError(message) {
+    const error = new Error(message);
+    error.timeout = true;
+    return error;
+}
+
+// Run the Python AI model in a fresh process for a single image; it is
+// killed if it has not finished within AI_TIMEOUT_MS
+function runAIModelOnce(imagePath, options = {}) {
+    const args = ['ai_model.py', imagePath];
+    if (options.output) {
+        args.push('--output', options.output);
+    }
+    for (const [key, value] of Object.entries(options.settings || {})) {
+        args.push(`--${key.replace(/_/g, '-')}`, String(value));
+    }
     return new Promise((resolve, reject) => {
-        const pythonProcess = spawn('python', ['ai_model.py', imagePath], {
-            cwd: __dirname
+        const pythonProcess = spawn('python', args, {
+            cwd: __dirname,
+            env: AI_ENV
         });
         
         let output = '';
         let errorOutput = '';
+        let timedOut = false;
+        const timer = setTimeout(() => {
+            timedOut = true;
+            pythonProcess.kill('SIGKILL');
+        }, AI_TIMEOUT_MS);
         
         pythonProcess.stdout.on('data', (data) => {
             output += data.toString();
@@ -262,7 +699,10 @@ function runAIModel(imagePath) {
         });
         
         pythonProcess.on('close', (code) => {
-            if (code === 0) {
+            clearTimeout(timer);
+            if (timedOut) {
+                reject(timeoutError(`AI model did not finish within ${AI_TIMEOUT_MS} ms`));
+            } else if (code === 0) {
                 try {
                     const result = JSON.parse(output);
                     resolve(result);
@@ -275,11 +715,22 @@ function runAIModel(imagePath) {
         });
         
         pythonProcess.on('error', (error) => {
+            clearTimeout(timer);
             reject(new Error(`Failed to start Python process: ${error.message}`));
         });
     });
 }
 
+// AI worker health check
+app.get('/api/ai/health', async (req, res) => {
+    try {
+        const health = await aiWorker.health();
+        res.json(health);
+    } catch (error) {
+        res.status(503).json({ success: false, error: error.message });
+    }
+});
+
 // Test subdomain - User selection and annotation
 app.get('/test', (req, res) => {
     res.sendFile(path.join(__dirname, 'views', 'test.html'));
@@ -877,11 +1328,19 @@ const server = app.listen(PORT, () => {
     console.log(`Server running on port ${PORT}`);
     console.log(`Visit http://localhost:${PORT} to view the application`);
     console.log(`✅ Database initialized and ready`);
+
+    // Warm up the AI worker so the first upload does not pay the model load
+    if (process.env.AI_WORKER_MODE !== 'spawn') {
+        aiWorker.start().catch((error) => {
+            console.error('AI worker failed to start:', error.message);
+        });
+    }
 });
 
 // Graceful shutdown
 process.on('SIGINT', () => {
     console.log('\n🛑 Shutting down gracefully...');
+    aiWorker.stop();
     annotationDB.close();
     server.close(() => {
         console.log('✅ Server closed');
@@ -891,6 +1350,7 @@ process.on('SIGINT', () => {
 
 process.on('SIGTERM', () => {
     console.log('\n🛑 Shutting down gracefully...');
+    aiWorker.stop();
     annotationDB.close();
     server.close(() => {
         console.log('✅ Server closed');
@@ -0,0 +1,359 @@
+"""Tests for ai_model.py that need neither the model weights nor torch"""
+
+import os
+import sys
+import base64
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+import importlib.util
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai_model
+
+HAS_IMAGING = all(importlib.util.find_spec(name) for name in ('cv2', 'numpy', 'PIL', 'yaml'))
+
+class SourcePathTest(unittest.TestCase):
+    def test_paths(self):
+        self.assertEqual(ai_model.source_path('uploads/images/x.jpg'), 'uploads/images/x.jpg')
+        self.assertEqual(ai_model.source_path(__file__), __file__)
+    
+    def test_base64_is_not_a_path(self):
+        self.assertIsNone(ai_model.source_path('/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAgGBgcGBQgH'))
+        self.assertIsNone(ai_model.source_path('data:image/jpeg;base64,/9j/4AAQ'))
+    
+    def test_errors_quote_a_short_input(self):
+        message = ai_model.shorten('A' * 5000)
+        self.assertLess(len(message), 200)
+        self.assertIn('5000 chars', message)
+
+class ForkSafetyTest(unittest.TestCase):
+    def tearDown(self):
+        ai_model._inference_started = False
+    
+    def test_fork_refused_after_inference(self):
+        ai_model.assert_fork_safe()
+        ai_model._inference_started = True
+        with self.assertRaises(RuntimeError):
+            ai_model.assert_fork_safe()
+
+@unittest.skipUnless(os.access('/proc/self/clear_refs', os.W_OK), 'needs a resettable peak RSS (Linux)')
+class RequestPeakRssTest(unittest.TestCase):
+    def test_a_request_alone_gets_its_own_peak(self):
+        with ai_model.request_peak_rss() as first:
+            pass
+        with ai_model.request_peak_rss() as second:
+            pass
+        self.assertIn('peak_rss_mb', first)
+        self.assertIn('peak_rss_mb', second)
+    
+    def test_overlapping_requests_get_none(self):
+        with ai_model.request_peak_rss() as outer:
+            with ai_model.request_peak_rss() as inner:
+                pass
+        self.assertEqual((outer, inner), ({}, {}))
+
+@unittest.skipUnless(HAS_IMAGING, 'needs opencv-python, numpy, pillow and pyyaml')
+class PolygonCropTest(unittest.TestCase):
+    def test_tooth_mask_is_bounded_by_the_tooth(self):
+        np = ai_model.np
+        detector = ai_model.CalculusDetector('missing.yaml', lazy=True, overrides={'PADDING': 20})
+        frame = np.zeros((3000, 4000, 3), dtype=np.uint8)
+        polygon = np.array([[1000, 1000], [1100, 1000], [1100, 1150], [1000, 1150]], dtype=np.float32)
+        tooth = detector.crop_tooth_polygon(0, polygon, frame)
+        # The tooth plus its padding, not a 4000 x 3000 frame
+        self.assertEqual(tooth['crop_mask'].shape, (190, 140))
+        self.assertEqual(tooth['bbox'], (980, 980, 1120, 1170))
+        self.assertEqual(tooth['area'], 101 * 151)
+
+@unittest.skipUnless(HAS_IMAGING, 'needs opencv-python, numpy, pillow and pyyaml')
+class TileMergeTest(unittest.TestCase):
+    # Rectangular teeth (x1, y1, x2, y2) and their scores in a 200 x 100 image
+    TEETH = [((60, 20, 100, 80), 0.9), ((140, 20, 180, 80), 0.8), ((10, 20, 50, 80), 0.7)]
+    
+    def detection(self, box, score, cut):
+        x1, y1, x2, y2 = box
+        polygon = ai_model.np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], dtype=ai_model.np.float32)
+        return {'polygon': polygon, 'score': score, 'cut': cut, 'box': box}
+    
+    def test_whole_copy_wins_over_a_cut_one(self):
+        cut = self.detection((80, 20, 100, 80), 0.95, True)
+        whole = self.detection((60, 20, 100, 80), 0.9, False)
+        neighbour = self.detection((101, 20, 140, 80), 0.5, False)
+        kept = ai_model.merge_tile_detections([cut, whole, neighbour], 0.5)
+        self.assertEqual(kept, [whole, neighbour])
+    
+    def fake_yolo(self, tiles):
+        """Each tile's view of TEETH; tile pixels hold their own (x, y) so the origin is known"""
+        np = ai_model.np
+        results = []
+        for tile in tiles:
+            x, y = int(tile[0, 0, 0]), int(tile[0, 0, 1])
+            h, w = tile.shape[:2]
+            polygons, scores = [], []
+            for (tx1, ty1, tx2, ty2), score in self.TEETH:
+                cx1, cy1, cx2, cy2 = max(tx1, x), max(ty1, y), min(tx2, x + w - 1), min(ty2, y + h - 1)
+                if cx1 < cx2 and cy1 < cy2:
+                    polygons.append(np.array([[cx1 - x, cy1 - y], [cx2 - x, cy1 - y],
+                                              [cx2 - x, cy2 - y], [cx1 - x, cy2 - y]], dtype=np.float32))
+                    scores.append(score)
+            results.append(SimpleNamespace(masks=SimpleNamespace(xy=polygons) if polygons else None,
+                                           boxes=SimpleNamespace(conf=SimpleNamespace(tolist=lambda s=scores: s))))
+        return results
+    
+    def test_one_detection_per_tooth(self):
+        np = ai_model.np
+        image = np.zeros((100, 200, 3), dtype=np.uint8)
+        image[:, :, 0] = np.arange(200)[None, :]
+        image[:, :, 1] = np.arange(100)[:, None]
+        detector = ai_model.CalculusDetector('missing.yaml', lazy=True, overrides={
+            'INFERENCE': 'tiled', 'TILE_SIZE': 120, 'TILE_OVERLAP': 0.25})
+        detector.run_yolo = self.fake_yolo
+        
+        result = detector.predict_tiled(image)
+        self.assertEqual(result.tiles, 2)
+        boxes = [tuple(int(v) for v in (*polygon.min(axis=0), *polygon.max(axis=0))) for polygon in result.masks.xy]
+        # The tooth seen by both tiles is kept once, whole, not as its cut copy from x = 80
+        self.assertEqual(boxes, [box for box, _ in self.TEETH])
+        self.assertEqual(result.scores, [score for _, score in self.TEETH])
+
+class FakeTensor:
+    """Just enough of a torch tensor for the detector's use of ``boxes.conf``"""
+    
+    def __init__(self, values):
+        self.values = ai_model.np.asarray(values, dtype=ai_model.np.float32)
+    
+    def cpu(self):
+        return self
+    
+    def numpy(self):
+        return self.values
+    
+    def tolist(self):
+        return self.values.tolist()
+
+@unittest.skipUnless(HAS_IMAGING, 'needs opencv-python, numpy, pillow and pyyaml')
+class ReanalysisTest(unittest.TestCase):
+    # Tooth polygons and their YOLO scores in a 160 x 120 image
+    TEETH = [([[10, 10], [50, 10], [50, 100], [10, 100]], 0.9),
+             ([[60, 15], [100, 15], [95, 105], [65, 105]], 0.6),
+             ([[110, 10], [150, 10], [150, 90], [110, 90]], 0.3)]
+    
+    def setUp(self):
+        np = ai_model.np
+        self.directory = tempfile.mkdtemp()
+        self.image = np.random.default_rng(7).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+        self.calls = {'yolo': 0, 'unet': 0}
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def detector(self, conf, artifacts=None):
+        """A polygon-mode detector at ``conf`` whose networks are deterministic stand-ins"""
+        np = ai_model.np
+        detector = ai_model.CalculusDetector('missing.yaml', lazy=True, overrides={
+            'CONF': conf, 'MASK_MODE': 'polygon', 'OUTPUT': 'none'})
+        detector.cache = None
+        detector.artifacts = artifacts
+        detector.unet_enabled = True
+        
+        def predict(images):
+            # Like YOLO, only detections scoring above conf are returned
+            self.calls['yolo'] += 1
+            teeth = [(np.array(polygon, dtype=np.float32), score) for polygon, score in self.TEETH if score > conf]
+            return [SimpleNamespace(masks=SimpleNamespace(xy=[polygon for polygon, _ in teeth]) if teeth else None,
+                                    boxes=SimpleNamespace(conf=FakeTensor([score for _, score in teeth])))
+                    for _ in images]
+        
+        def unet_probabilities(crops):
+            self.calls['unet'] += 1
+            # A gradient whose level depends on the crop, so every tooth differs
+            return [np.tile(np.linspace(0, crop.mean() / 128, 32, dtype=np.float32), (32, 1)) for crop in crops]
+        
+        detector.predict = predict
+        detector.unet_probabilities = unet_probabilities
+        return detector
+    
+    def test_reanalysis_matches_a_fresh_run(self):
+        artifacts = ai_model.ArtifactStore(os.path.join(self.directory, 'artifacts'))
+        first = self.detector(0.25, artifacts).process_image(self.image)
+        self.assertTrue(first['success'], first.get('error'))
+        self.assertEqual(first['teeth_detected'], 3)
+        self.assertEqual(self.calls, {'yolo': 1, 'unet': 1})
+        
+        for conf in (0.25, 0.5):
+            fresh = self.detector(conf).process_image(self.image)
+            self.calls = {'yolo': 0, 'unet': 0}
+            replayed = self.detector(conf, artifacts).process_image(self.image)
+            self.assertTrue(replayed.get('reanalysed'))
+            self.assertEqual(self.calls, {'yolo': 0, 'unet': 0}, 'the networks ran again')
+            for field in ('teeth_detected', 'average_calculus_coverage', 'individual_results'):
+                self.assertEqual(replayed[field], fresh[field], f'{field} at conf {conf}')
+    
+    def test_lower_conf_needs_the_networks(self):
+        artifacts = ai_model.ArtifactStore(os.path.join(self.directory, 'artifacts'))
+        self.detector(0.5, artifacts).process_image(self.image)
+        result = self.detector(0.25, artifacts).process_image(self.image)
+        self.assertFalse(result.get('reanalysed'))
+        self.assertEqual(result['teeth_detected'], 3)
+        self.assertEqual(self.calls['yolo'], 2)
+
+class DeadlinePlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.planner = ai_model.DeadlinePlanner()
+        self.planner.observe(0, 2.0)  # Full quality measured at 2 s; the rest is extrapolated
+    
+    def test_unmeasured_planner_tries_full_quality(self):
+        self.assertEqual(ai_model.DeadlinePlanner().choose(0.1), (0, None))
+    
+    def test_least_degraded_level_that_fits(self):
+        # Levels fit when their estimate is within DEADLINE_HEADROOM (80%) of the budget
+        self.assertEqual(self.planner.choose(3.0)[0], 0)
+        self.assertEqual(self.planner.choose(2.0)[0], 1)  # 1.2 s
+        self.assertEqual(self.planner.choose(1.2)[0], 2)  # 0.9 s
+        self.assertEqual(self.planner.choose(1.0)[0], 3)  # 0.7 s
+    
+    def test_deepest_allowed_level_when_none_fits(self):
+        self.assertEqual(self.planner.choose(0.1, max_level=2)[0], 2)
+        self.assertEqual(self.planner.choose(0.1)[0], 3)
+    
+    def test_queue_degrades_early(self):
+        # One job ahead per worker doubles the expected wait
+        self.assertEqual(self.planner.choose(4.0)[0], 0)
+        self.assertEqual(self.planner.choose(4.0, queued=1, workers=1)[0], 1)
+        self.assertEqual(self.planner.choose(4.0, queued=1, workers=4)[0], 0)
+    
+    def test_measurements_are_averaged(self):
+        self.planner.observe(0, 3.0)
+        self.assertAlmostEqual(self.planner.estimate(0), 2.2)
+        self.assertAlmostEqual(self.planner.estimate(1), 2.2 * 0.6)
+    
+    def test_requests_stop_before_dropping_the_overlay(self):
+        class Detector:
+            imgsz, output_mode = 640, 'overlay'
+            
+            def with_overrides(self, **overrides):
+                self.overrides = overrides
+                return self
+            
+            def process_image(self, image, output_path=None, observer=None):
+                return {'success': True}
+        
+        detector = Detector()
+        jobs = SimpleNamespace(pending=queue.Queue(), workers=1)
+        # No level fits 500 ms, but only a caller asking for it gets the masks level
+        result = ai_model.DeadlineRequest(detector, self.planner, jobs, 500).process_image('x.jpg')
+        self.assertEqual(result['degradation']['name'], 'no_unet')
+        self.assertEqual(detector.overrides, {'IMGSZ': 480, 'UNET': 'off'})
+        
+        self.setUp()  # Forget the instant detection just measured
+        result = ai_model.DeadlineRequest(detector, self.planner, jobs, 500, 'masks').process_image('x.jpg')
+        self.assertEqual(result['degradation']['name'], 'masks')
+        self.assertEqual(detector.overrides['OUTPUT'], 'masks')
+
+class GatedDetector:
+    """Holds each image at its first stage until ``gate`` opens"""
+    
+    def __init__(self):
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.images = []
+    
+    def process_image(self, image, output_path=None, observer=None):
+        self.images.append(image)
+        observer('yolo')
+        self.started.set()
+        self.gate.wait(5)
+        try:
+            observer('unet')
+        except ai_model.JobCancelled as e:
+            return {'success': False, 'error': str(e)}
+        return {'success': True}
+
+class JobQueueCancelTest(unittest.TestCase):
+    def setUp(self):
+        self.detector = GatedDetector()
+        self.jobs = ai_model.JobQueue(self.detector, workers=1, max_queued=1)
+    
+    def tearDown(self):
+        self.detector.gate.set()
+        self.jobs.shutdown()
+    
+    def test_cancel_queued_and_running_jobs(self):
+        running = self.jobs.submit('a.jpg')
+        self.assertTrue(self.detector.started.wait(5))
+        queued = self.jobs.submit('b.jpg')
+        
+        self.jobs.cancel(queued.id)
+        self.assertTrue(queued.done.is_set())
+        self.assertEqual(queued.status, 'cancelled')
+        
+        self.jobs.cancel(running.id)
+        self.assertEqual(running.status, 'running')  # stops at its next stage
+        self.detector.gate.set()
+        self.assertTrue(running.done.wait(5))
+        self.assertEqual(running.status, 'cancelled')
+        self.assertEqual(running.result['error'], 'Job cancelled')
+        self.assertEqual(self.detector.images, ['a.jpg'])
+    
+    def test_full_queue_refuses_jobs(self):
+        self.jobs.submit('a.jpg')
+        self.assertTrue(self.detector.started.wait(5))
+        self.jobs.submit('b.jpg')
+        with self.assertRaises(queue.Full):
+            self.jobs.submit('c.jpg')
+
+@unittest.skipUnless(HAS_IMAGING, 'needs opencv-python, numpy, pillow and pyyaml')
+class Base64InputTest(unittest.TestCase):
+    def test_process_image_accepts_bare_base64(self):
+        np, cv2 = ai_model.np, ai_model.cv2
+        image = np.full((48, 64, 3), 128, dtype=np.uint8)
+        encoded = base64.b64encode(cv2.imencode('.jpg', image)[1].tobytes()).decode('ascii')
+        
+        detector = ai_model.CalculusDetector('missing.yaml', lazy=True, overrides={'OUTPUT': 'none'})
+        detector.cache = None
+        detector.artifacts = None
+        # No teeth: exercises decoding and rendering without the models
+        detector.predict = lambda images: [SimpleNamespace(masks=None) for _ in images]
+        
+        result = detector.process_image(encoded)
+        self.assertTrue(result['success'], result.get('error'))
+        self.assertEqual(result['settings']['image_size'], [64, 48])
+        self.assertIsNone(result['original_image_path'])
+    
+    def test_undecodable_base64_error_is_short(self):
+        detector = ai_model.CalculusDetector('missing.yaml', lazy=True, overrides={'OUTPUT': 'none'})
+        detector.cache = None
+        detector.artifacts = None
+        result = detector.process_image('QUJD' * 2000)
+        self.assertFalse(result['success'])
+        self.assertLess(len(result['error']), 200)
+
+@unittest.skipUnless(HAS_IMAGING, 'needs opencv-python, numpy, pillow and pyyaml')
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_overlay_takes_the_requested_format(self):
+        np, cv2 = ai_model.np, ai_model.cv2
+        overlay = os.path.join(self.directory, 'x_processed.png')
+        cv2.imwrite(overlay, np.full((48, 64, 3), 200, dtype=np.uint8))
+        cache = ai_model.ResultCache(os.path.join(self.directory, 'cache'))
+        cache.put('key', {'success': True, 'processed_image_path': overlay})
+        
+        for output_path, magic in (('out.jpg', b'\xff\xd8'), ('out.png', b'\x89PNG')):
+            output_path = os.path.join(self.directory, output_path)
+            self.assertIsNotNone(cache.get('key', output_path))
+            with open(output_path, 'rb') as f:
+                self.assertEqual(f.read(len(magic)), magic)
+        self.assertIsNone(cache.get('key', os.path.join(self.directory, 'out.unknown')))
+
+if __name__ == '__main__':
+    unittest.main()
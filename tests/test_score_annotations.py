@@ -0,0 +1,73 @@
+"""Tests for score_annotations.py that need neither the model weights nor torch"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import score_annotations
+
+class IterJsonArrayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def read(self, text, chunk_size):
+        path = os.path.join(self.directory, 'array.json')
+        with open(path, 'w') as f:
+            f.write(text)
+        return list(score_annotations.iter_json_array(path, chunk_size))
+    
+    def test_values_straddling_chunks(self):
+        elements = [12345, True, None, -4.5e3, "a, ]b", {"x": [1, 2], "y": "z"}, [], 678, False]
+        text = ' [ ' + ' ,\n '.join(json.dumps(element) for element in elements) + ' ] \n'
+        for chunk_size in (1, 2, 3, 1 << 20):
+            self.assertEqual(self.read(text, chunk_size), elements, f'chunk size {chunk_size}')
+    
+    def test_empty_array(self):
+        for chunk_size in (1, 3):
+            self.assertEqual(self.read(' [ ] ', chunk_size), [])
+    
+    def test_malformed(self):
+        for text in ('{"a": 1}', '[1 2]', '[1, 2'):
+            with self.assertRaises(ValueError):
+                self.read(text, 2)
+
+class CheckpointTest(unittest.TestCase):
+    settings = {'masks': 'rle'}
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'scores.jsonl')
+        with open(self.output, 'w') as f:
+            f.write('{"key": "a"}\n')
+        score_annotations.save_checkpoint(self.output, self.settings, {'a'}, os.path.getsize(self.output))
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_resume(self):
+        done, offset = score_annotations.load_checkpoint(self.output, self.settings)
+        self.assertEqual((done, offset), ({'a'}, os.path.getsize(self.output)))
+    
+    def test_missing_output_starts_fresh(self):
+        os.remove(self.output)
+        self.assertEqual(score_annotations.load_checkpoint(self.output, self.settings), (set(), 0))
+    
+    def test_short_output_starts_fresh(self):
+        with open(self.output, 'w') as f:
+            f.write('{')
+        self.assertEqual(score_annotations.load_checkpoint(self.output, self.settings), (set(), 0))
+    
+    def test_other_settings(self):
+        with self.assertRaises(ValueError):
+            score_annotations.load_checkpoint(self.output, {'masks': 'png'})
+
+if __name__ == '__main__':
+    unittest.main()
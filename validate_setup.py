@@ -8,8 +8,8 @@ import sys
 import os
 import json
 import subprocess
-import requests
 import time
+import importlib.util
 from pathlib import Path
 
 def check_python_version():
@@ -20,7 +20,7 @@ def check_python_version():
     return True, f"Python {version.major}.{version.minor}.{version.micro}"
 
 def check_required_packages():
-    """Check if required Python packages are installed"""
+    """Check if required Python packages are installed, without importing them"""
     required_packages = [
         ('torch', 'torch'), 
         ('torchvision', 'torchvision'), 
@@ -35,9 +35,7 @@ def check_required_packages():
     
     missing = []
     for package_name, import_name in required_packages:
-        try:
-            __import__(import_name)
-        except ImportError:
+        if importlib.util.find_spec(import_name) is None:
             missing.append(package_name)
     
     if missing:
@@ -77,6 +75,10 @@ def check_node_dependencies():
 
 def check_server_response():
     """Check if the server responds to requests"""
+    try:
+        import requests
+    except ImportError:
+        return False, "requests package not installed"
     try:
         # Check if server is running
         response = requests.get("http://localhost:3000", timeout=5)